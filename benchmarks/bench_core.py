@@ -0,0 +1,88 @@
+"""Verifies the same suite of signed requests through each way of running the core.
+
+    $ python benchmarks/bench_core.py [number of requests]
+
+`inlineCallbacks` is the way the provider verified requests before the core
+was split out, `twisted` is the Deferred adapter used by the cyclone handlers
+now, `sync` runs the core directly and `asyncio` is the adapter in
+cycloauth.aio, which is skipped when neither asyncio nor trollius is
+installed. Every path uses a BaseStorage and a MemoryNOnceStore.
+"""
+import sys, time, urllib
+from twisted.internet import defer
+from cycloauth import core
+from cycloauth.nonce import MemoryNOnceStore
+from cycloauth.provider import run_deferred
+from cycloauth.request import OAuthRequestParameters
+from cycloauth.signatures import HMAC_SHA1
+from cycloauth.storage import BaseStorage, get_consumer_and_token
+
+try:
+  from cycloauth import aio
+except ImportError:
+  aio = None
+
+
+def signed_requests(consumer, token, n):
+  "`n` requests signed by `consumer` and `token`, each with its own nonce"
+  method = HMAC_SHA1()
+  ret = []
+  for i in xrange(n):
+    oauth = dict(oauth_consumer_key=consumer.key, oauth_token=token.key, oauth_signature_method='HMAC-SHA1',
+                 oauth_timestamp=str(int(time.time())), oauth_nonce='nonce%d' % i, oauth_version='1.0')
+    header = 'OAuth ' + ', '.join('%s="%s"' % (k, urllib.quote(v, safe='~')) for k, v in sorted(oauth.items()))
+    unsigned = OAuthRequestParameters.from_parts('GET', 'http', 'api.example.com', '/1/statuses.json',
+                                                 'count=20', {'Authorization': header}, None)
+    signature = method.sign(unsigned.base_string(), consumer.secret, token.secret)
+    header += ', oauth_signature="%s"' % urllib.quote(signature, safe='~')
+    ret.append(('GET', 'http', 'api.example.com', '/1/statuses.json', 'count=20', {'Authorization': header}))
+  return ret
+
+
+def make_core():
+  storage = BaseStorage({})
+  consumer = storage.add_consumer().result
+  token = storage.add_access_token().result
+  nonces = MemoryNOnceStore({'nonce_cache_size': 1000000})
+  return core.OAuthCore({}, storage, nonces, {'HMAC-SHA1': HMAC_SHA1()}), consumer, token
+
+
+@defer.inlineCallbacks
+def inline_callbacks_verify(c, parsed):
+  consumer, token = yield get_consumer_and_token(c.storage, parsed.oauth['oauth_consumer_key'],
+                                                 parsed.oauth['oauth_token'])
+  fresh = yield c.nonce_store.check_and_add(consumer.key, parsed.oauth['oauth_nonce'],
+                                            parsed.oauth['oauth_timestamp'])
+  if not (fresh and c.signature_methods['HMAC-SHA1'].check(parsed.base_string(), consumer.secret,
+                                                           token.secret, parsed.oauth['oauth_signature'])):
+    raise ValueError('invalid request')
+  defer.returnValue((consumer, token))
+
+
+def bench(name, verify, requests):
+  failures = []
+  started = time.time()
+  for r in requests:
+    verify(OAuthRequestParameters.from_parts(*(r + (None,))), failures)
+  elapsed = time.time() - started
+  print '%s: %.2f us/request, %d failed' % (name, elapsed / len(requests) * 1e6, len(failures))
+
+
+def main(n=20000):
+  c, consumer, token = make_core()
+  paths = [
+    ('inlineCallbacks', lambda p, f: inline_callbacks_verify(c, p).addErrback(f.append)),
+    ('twisted', lambda p, f: run_deferred(c.verify(p)).addErrback(f.append)),
+    ('sync', lambda p, f: core.run_sync(c.verify(p)))]
+  if aio is not None:
+    loop = aio.asyncio.new_event_loop()
+    paths.append(('asyncio', lambda p, f: loop.run_until_complete(aio.run(c.verify(p), loop))))
+  requests = signed_requests(consumer, token, n)
+  for name, verify in paths:
+    # every path sees the same nonces, so each gets an empty store
+    c.nonce_store = MemoryNOnceStore({'nonce_cache_size': 1000000})
+    bench(name, verify, requests)
+
+
+if __name__ == '__main__':
+  main(*[int(a) for a in sys.argv[1:]])
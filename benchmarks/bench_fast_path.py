@@ -0,0 +1,75 @@
+"""Measures what the synchronous fast path saves per authenticated request.
+
+    $ python benchmarks/bench_fast_path.py [number of requests]
+
+Each path verifies the same signed requests through a handler's
+get_oauth_token. `deferred` hides the storage's and nonce store's nowait
+methods, so every lookup goes through a Deferred as before; `fast path` lets
+the in-memory storage answer synchronously and `cached` does the same through
+a warm CachingStorage.
+"""
+import sys, time
+from cycloauth.core import OAuthCore
+from cycloauth.nonce import MemoryNOnceStore
+from cycloauth.provider import OAuthRequestHandlerMixin
+from cycloauth.request import OAuthRequestParameters
+from cycloauth.signatures import HMAC_SHA1
+from cycloauth.storage.cache import CachingStorage
+from bench_core import make_core, signed_requests
+
+
+class DeferredOnly(object):
+  "exposes only the deferred-returning methods of a storage or nonce store"
+
+  def __init__(self, wrapped, *names):
+    for name in names:
+      setattr(self, name, getattr(wrapped, name))
+
+
+class Application(object):
+  settings = {}
+
+  def __init__(self, storage, nonce_store):
+    self.oauth_core = OAuthCore(self.settings, storage, nonce_store, {'HMAC-SHA1': HMAC_SHA1()})
+
+
+class Handler(OAuthRequestHandlerMixin):
+  def __init__(self, application, parsed):
+    self.application = application
+    self._oauth_request_parameters = parsed
+
+
+def deferred_result(d):
+  "the result of a deferred which has already fired"
+  ret = []
+  d.addCallback(ret.append)
+  return ret[0]
+
+
+def bench(name, application, requests, verify):
+  failures = 0
+  started = time.time()
+  for r in requests:
+    handler = Handler(application, OAuthRequestParameters.from_parts(*(r + (None,))))
+    if verify(handler) is None:
+      failures += 1
+  elapsed = time.time() - started
+  print '%s: %.2f us/request, %d failed' % (name, elapsed / len(requests) * 1e6, failures)
+
+
+def main(n=20000):
+  c, consumer, token = make_core()
+  requests = signed_requests(consumer, token, n)
+  nonces = lambda: MemoryNOnceStore({'nonce_cache_size': 1000000})
+  cached = CachingStorage({})
+  cached.storage = c.storage
+  cached.get_consumer_and_token(consumer.key, token.key)
+  storage = DeferredOnly(c.storage, 'get_consumer_and_token', 'get_consumer', 'get_access_token')
+  bench('deferred', Application(storage, DeferredOnly(nonces(), 'check_and_add')), requests,
+        lambda h: deferred_result(h.get_oauth_token()))
+  bench('fast path', Application(c.storage, nonces()), requests, lambda h: h._get_oauth_token())
+  bench('cached', Application(cached, nonces()), requests, lambda h: h._get_oauth_token())
+
+
+if __name__ == '__main__':
+  main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,148 @@
+"""Runs the whole OAuth dance concurrently against an in-process server.
+
+    $ python benchmarks/bench_load.py [-s base|mongo] [-c concurrency] [-n dances] [-o results.json]
+
+Every dance gets a request token, authorizes it, exchanges it for an access
+token and makes one protected call, each over HTTP to a cyclone server
+listening on a free local port. `-s mongo` uses MongoDBStorage backed by the
+`oauth_bench` database of a mongod on localhost. Reports p50/p99 latency of
+each step and of whole dances, requests per second and errors; with -o the
+results are also saved for benchmarks/compare.py.
+"""
+import optparse, time, urlparse
+import cyclone.web, cyclone.httpclient
+from twisted.internet import defer, reactor
+import cycloauth.provider
+from harness import authorization_header, latency_summary, save_results
+
+
+STORAGES = {
+  'base': {},
+  'mongo': {'oauth_storage_factory': 'cycloauth.storage.mongodb.MongoDBStorage',
+            'oauth_mongo_database': 'oauth_bench',
+            'oauth_nonce_store_factory': 'cycloauth.storage.mongodb.MongoNOnceStore'}
+}
+
+STEPS = ('request_token', 'authorize', 'access_token', 'protected')
+
+
+class ProtectedHandler(cyclone.web.RequestHandler, cycloauth.provider.OAuthRequestHandlerMixin):
+  @cycloauth.provider.oauth_authenticated
+  def get(self):
+    self.write('ok')
+    self.finish()
+
+
+class Application(cyclone.web.Application, cycloauth.provider.OAuthApplicationMixin):
+  def __init__(self, settings):
+    handlers = [(r'/protected', ProtectedHandler)] + cycloauth.provider.handlers(settings)
+    cyclone.web.Application.__init__(self, handlers, **settings)
+
+
+class Token(object):
+  def __init__(self, key, secret):
+    self.key = key
+    self.secret = secret
+
+
+def _first(value):
+  return value[0] if isinstance(value, list) else value
+
+
+class Client(object):
+  "does dances against the server at `port`, recording latencies and errors"
+
+  def __init__(self, port, consumer):
+    self.host = '127.0.0.1:%d' % port
+    self.consumer = consumer
+    self.latencies = dict((step, []) for step in STEPS + ('dance',))
+    self.errors = 0
+    self.requests = 0
+
+  @defer.inlineCallbacks
+  def fetch(self, step, path, query='', token=None, **oauth):
+    headers = {'Authorization': [authorization_header('GET', 'http', self.host, path, query,
+                                                      self.consumer, token, **oauth)]}
+    url = 'http://%s%s%s' % (self.host, path, '?' + query if query else '')
+    started = time.time()
+    self.requests += 1
+    response = yield cyclone.httpclient.fetch(url, headers=headers, followRedirect=0)
+    self.latencies[step].append(time.time() - started)
+    if response.code >= 400:
+      raise ValueError('%s failed with %s: %s' % (step, response.code, response.body))
+    defer.returnValue(response)
+
+  @defer.inlineCallbacks
+  def dance(self):
+    started = time.time()
+    r = yield self.fetch('request_token', '/oauth/request_token', oauth_callback='http://client.example/ready')
+    body = dict(urlparse.parse_qsl(r.body))
+    request_token = Token(body['oauth_token'], body['oauth_token_secret'])
+    r = yield self.fetch('authorize', '/oauth/authorize', 'oauth_token=' + request_token.key)
+    location = _first(r.headers.get('Location'))
+    verifier = dict(urlparse.parse_qsl(urlparse.urlparse(location).query))['oauth_verifier']
+    r = yield self.fetch('access_token', '/oauth/access_token', token=request_token, oauth_verifier=verifier)
+    body = dict(urlparse.parse_qsl(r.body))
+    access_token = Token(body['oauth_token'], body['oauth_token_secret'])
+    yield self.fetch('protected', '/protected', 'count=20', token=access_token)
+    self.latencies['dance'].append(time.time() - started)
+
+  @defer.inlineCallbacks
+  def worker(self, dances):
+    for i in xrange(dances):
+      try:
+        yield self.dance()
+      except Exception:
+        self.errors += 1
+
+
+@defer.inlineCallbacks
+def run(options):
+  settings = dict(STORAGES[options.storage])
+  app = Application(settings)
+  yield app.start_oauth()
+  port = reactor.listenTCP(0, app, interface='127.0.0.1')
+  try:
+    consumer = yield app.oauth_storage.add_consumer()
+    client = Client(port.getHost().port, consumer)
+    per_worker = max(1, options.dances // options.concurrency)
+    started = time.time()
+    yield defer.DeferredList([client.worker(per_worker) for i in xrange(options.concurrency)])
+    elapsed = time.time() - started
+    yield app.oauth_storage.remove_consumer(consumer.key)
+  finally:
+    yield port.stopListening()
+  report(options, client, elapsed)
+
+
+def report(options, client, elapsed):
+  metrics = {'rps': client.requests / elapsed, 'dances_per_second': len(client.latencies['dance']) / elapsed,
+             'errors': client.errors}
+  print '%s storage, concurrency %d: %.1f requests/s, %d errors' % (
+    options.storage, options.concurrency, metrics['rps'], client.errors)
+  for step in STEPS + ('dance',):
+    summary = latency_summary(client.latencies[step])
+    if summary['count']:
+      print '  %-14s p50 %7.2f ms  p99 %7.2f ms' % (step, summary['p50'], summary['p99'])
+      metrics['%s.p50_ms' % step] = summary['p50']
+      metrics['%s.p99_ms' % step] = summary['p99']
+  if options.output:
+    save_results(options.output, 'load', metrics, storage=options.storage,
+                 concurrency=options.concurrency, dances=options.dances)
+
+
+def main():
+  parser = optparse.OptionParser(usage='%prog [-s base|mongo] [-c concurrency] [-n dances] [-o results.json]')
+  parser.add_option('-s', '--storage', choices=sorted(STORAGES), default='base')
+  parser.add_option('-c', '--concurrency', type='int', default=10)
+  parser.add_option('-n', '--dances', type='int', default=1000)
+  parser.add_option('-o', '--output', help='save the results to this file')
+  options, args = parser.parse_args()
+  d = run(options)
+  d.addErrback(lambda f: f.printTraceback())
+  d.addBoth(lambda r: reactor.stop())
+  reactor.run()
+
+
+if __name__ == '__main__':
+  main()
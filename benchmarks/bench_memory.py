@@ -0,0 +1,60 @@
+"""Reports the memory used per access token by the in-memory storages.
+
+    $ python benchmarks/bench_memory.py [number of tokens]
+
+BaselineStorage holds tokens as earlier versions did, for comparison. Sizes
+are summed with sys.getsizeof over every object the storage holds for its
+access tokens, so shared objects such as interned strings are counted once
+per reference and the numbers are an upper bound.
+"""
+import sys
+from oauth2 import Token as OAuthToken
+from cycloauth.storage import BaseStorage
+from cycloauth.storage.compact import CompactStorage, PackedStorage
+from cycloauth.utils import generate_string
+
+
+class BaselineToken(OAuthToken):
+  "a frozen copy of the Token cycloauth used to have, with its per-instance verifier generator"
+  def __init__(self, key, secret, callback=None, verifier=None, **kwargs):
+    self.key = key
+    self.secret = secret
+    self.verifier_generator = kwargs.get('verifier_generator', lambda: generate_string(32))
+    if callback is not None:
+      self.set_callback(callback)
+    if verifier is not None:
+      self.set_verifier(verifier)
+
+
+class BaselineStorage(BaseStorage):
+  "the in-memory storage holding tokens as it used to"
+  access_token_factory = BaselineToken
+
+
+def object_size(o):
+  size = sys.getsizeof(o)
+  if hasattr(o, '__dict__'):
+    size += sys.getsizeof(o.__dict__)
+    size += sum(sys.getsizeof(v) for v in o.__dict__.itervalues())
+  for name in getattr(type(o), '__slots__', ()):
+    size += sys.getsizeof(getattr(o, name, None))
+  return size
+
+
+def table_size(table):
+  if isinstance(table, dict):
+    return sys.getsizeof(table) + sum(sys.getsizeof(k) + object_size(v) for k, v in table.iteritems())
+  # a PackedTable
+  return (sys.getsizeof(table.index) + sum(sys.getsizeof(k) + sys.getsizeof(i) for k, i in table.index.iteritems())
+          + sum(sys.getsizeof(b) for b in [table.data, table.offsets, table.created] + table.lengths))
+
+
+def main(n=100000):
+  for factory in (BaselineStorage, BaseStorage, CompactStorage, PackedStorage):
+    storage = factory({})
+    storage.add_access_tokens(n)
+    print '%s: %d bytes/token' % (factory.__name__, table_size(storage.access_tokens) / n)
+
+
+if __name__ == '__main__':
+  main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,87 @@
+"""Times the hot paths of request verification one at a time.
+
+    $ python benchmarks/bench_micro.py [-n number] [-o results.json]
+
+Each result is the mean time per call in microseconds. With PyCrypto
+installed `check_signature.rsa` times RSA-SHA1 checks with a 2048 bit key,
+on a tenth as many requests. With -o the results are also saved for
+benchmarks/compare.py.
+"""
+import optparse, os, tempfile, time, timeit
+from cycloauth import core
+from cycloauth.keygen import random_hex
+from cycloauth.nonce import MemoryNOnceStore, SharedMemoryNOnceStore
+from cycloauth.request import OAuthRequestParameters
+from cycloauth.signatures import HMAC_SHA1, RSA_SHA1, rsa_available
+from cycloauth.storage import BaseStorage
+from cycloauth.utils import generate_string
+from bench_params import FakeRequest, legacy_normalized_parameters
+from harness import authorization_header, save_results
+if rsa_available:
+  from Crypto.PublicKey import RSA
+  from bench_rsa import rsa_signed_requests
+
+
+def signed_parts(consumer, token, n):
+  "the parts of `n` requests signed by `consumer` and `token`, each with its own nonce"
+  return [('GET', 'http', 'api.example.com', '/1/statuses.json', 'count=20',
+           {'Authorization': authorization_header('GET', 'http', 'api.example.com', '/1/statuses.json',
+                                                  'count=20', consumer, token)}, None)
+          for i in xrange(n)]
+
+
+def per_call(fn, args):
+  "mean microseconds per call of `fn` over each of `args`"
+  started = time.time()
+  for a in args:
+    fn(a)
+  return (time.time() - started) / len(args) * 1e6
+
+
+def main(n=20000, output=None):
+  storage = BaseStorage({})
+  consumer = storage.add_consumer().result
+  token = storage.add_access_token().result
+  parts = signed_parts(consumer, token, n)
+  parsed = [OAuthRequestParameters.from_parts(*p) for p in parts]
+  c = core.OAuthCore({}, storage, MemoryNOnceStore({'nonce_cache_size': n * 2}), {'HMAC-SHA1': HMAC_SHA1()})
+  nonces = [random_hex(16) for i in xrange(n)]
+  timestamp = str(int(time.time()))
+  shm_path = os.path.join(tempfile.gettempdir(), 'cycloauth-bench-nonces-%d' % os.getpid())
+  shm = SharedMemoryNOnceStore({'oauth_nonce_shm_path': shm_path, 'nonce_cache_size': n * 2})
+  memory = MemoryNOnceStore({'nonce_cache_size': n * 2})
+  legacy_request = FakeRequest()
+  try:
+    metrics = {
+      'oauth_params': per_call(lambda p: OAuthRequestParameters.from_parts(*p).oauth, parts),
+      'base_string': per_call(lambda p: OAuthRequestParameters.from_parts(*p).base_string(), parts),
+      'check_nonce.memory': per_call(lambda v: memory.check_and_add_nowait(consumer.key, v, timestamp), nonces),
+      'check_nonce.shm': per_call(lambda v: shm.check_and_add_nowait(consumer.key, v, timestamp), nonces),
+      'check_signature': per_call(lambda p: core.run_sync(c.check_signature(p, consumer, token)), parsed),
+      'get_normalized_parameters': timeit.timeit(
+        lambda: legacy_normalized_parameters(legacy_request), number=n) / n * 1e6,
+      'generate_string': timeit.timeit(lambda: generate_string(32), number=n) / n * 1e6,
+    }
+    if rsa_available:
+      private_key = RSA.generate(2048)
+      rsa_consumer = storage.add_consumer(rsa_key=private_key.publickey().exportKey()).result
+      rsa_parsed = [OAuthRequestParameters.from_parts(*(p + (None,)))
+                    for p in rsa_signed_requests(rsa_consumer, token, private_key, max(1, n // 10))]
+      rsa_core = core.OAuthCore({}, storage, MemoryNOnceStore({'nonce_cache_size': n}), {'RSA-SHA1': RSA_SHA1()})
+      metrics['check_signature.rsa'] = per_call(
+        lambda p: core.run_sync(rsa_core.check_signature(p, rsa_consumer, token)), rsa_parsed)
+  finally:
+    shm.close()
+    os.remove(shm_path)
+  for name in sorted(metrics):
+    print '%s: %.2f us' % (name, metrics[name])
+  if output:
+    save_results(output, 'micro', metrics, n=n)
+
+
+if __name__ == '__main__':
+  parser = optparse.OptionParser(usage='%prog [-n number] [-o results.json]')
+  parser.add_option('-n', type='int', default=20000, help='calls per benchmark')
+  parser.add_option('-o', '--output', help='save the results to this file')
+  options, args = parser.parse_args()
+  main(options.n, options.output)
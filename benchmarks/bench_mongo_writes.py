@@ -0,0 +1,74 @@
+"""Compares MongoDBStorage's old save-and-reparse writes with in-place upserts.
+
+    $ python benchmarks/bench_mongo_writes.py [number of writes] [--mongo]
+
+Without --mongo only the work done in-process is timed: building the
+document and, for the old path, rebuilding a token from it. With --mongo both
+paths also write to the `oauth_bench` database of a mongod on localhost.
+"""
+import sys, time, timeit
+from twisted.internet import defer, reactor
+from cycloauth.keygen import generate_key, generate_secret
+from cycloauth.storage.mongodb import MongoDBStorage, MongoToken, ObjectId
+
+
+def make_token():
+  token = MongoToken(key=generate_key(), secret=generate_secret())
+  token.set_callback('http://printer.example.com/ready?job=%s' % generate_key())
+  token.set_verifier()
+  token.m_id = ObjectId()
+  return token
+
+
+def old_in_process(token):
+  r = token.to_dict()
+  return MongoToken.from_dict(r)
+
+
+def new_in_process(token):
+  doc = token.to_dict()
+  doc.pop('_id', None)
+  return token
+
+
+def old_save(storage, token):
+  "what save_access_token used to do"
+  r = token.to_dict()
+  d = storage.mongo_save(storage.access_token_collection, r)
+  return d.addCallback(lambda ignored: MongoToken.from_dict(r))
+
+
+def new_save(storage, token):
+  return storage.save_access_token(token)
+
+
+@defer.inlineCallbacks
+def bench_mongo(n):
+  storage = MongoDBStorage({'oauth_mongo_database': 'oauth_bench'})
+  yield storage.start()
+  try:
+    tokens = yield storage.add_access_tokens(n)
+    for name, save in (('old', old_save), ('new', new_save)):
+      started = time.time()
+      for token in tokens:
+        yield save(storage, token)
+      print '%s, with mongod: %.2f us/write' % (name, (time.time() - started) / n * 1e6)
+    yield storage.remove_access_tokens([t.key for t in tokens])
+  finally:
+    yield storage.stop()
+    reactor.stop()
+
+
+def main(n=10000, mongo=False):
+  token = make_token()
+  for name, fn in (('old', old_in_process), ('new', new_in_process)):
+    t = timeit.timeit(lambda: fn(token), number=n)
+    print '%s, in process: %.2f us/write' % (name, t / n * 1e6)
+  if mongo:
+    reactor.callWhenRunning(bench_mongo, n)
+    reactor.run()
+
+
+if __name__ == '__main__':
+  args = [a for a in sys.argv[1:] if a != '--mongo']
+  main(*[int(a) for a in args], mongo='--mongo' in sys.argv)
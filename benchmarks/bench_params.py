@@ -0,0 +1,86 @@
+"""Compares the old multi-pass OAuth parameter extraction with OAuthRequestParameters.
+
+    $ python benchmarks/bench_params.py
+
+Reports the time per request and, when the tracemalloc module is available,
+the peak memory allocated while each path handles a request.
+"""
+import timeit, urllib
+import oauth2
+from cycloauth.request import OAuthRequestParameters
+from cycloauth.signatures import signature_base_string
+from cycloauth.utils import oauth_request
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+
+class FakeRequest(object):
+  "just enough of cyclone's HTTPRequest"
+  method = 'POST'
+  protocol = 'http'
+  host = 'api.example.com'
+  path = '/1/statuses/update.json'
+
+  def __init__(self):
+    oauth = dict(oauth_consumer_key='dpf43f3p2l4k3l03', oauth_token='nnch734d00sl2jdk',
+                 oauth_signature_method='HMAC-SHA1', oauth_timestamp='1191242096',
+                 oauth_nonce='kllo9940pd9333jh', oauth_version='1.0',
+                 oauth_signature='tR3+Ty81lMeYAr/Fid0kMTYa/WM=')
+    self.headers = {
+      'Authorization': 'OAuth realm="http://api.example.com/", ' + ', '.join(
+        '%s="%s"' % (k, urllib.quote(v, safe='~')) for k, v in sorted(oauth.items())),
+      'Content-Type': 'application/x-www-form-urlencoded'
+    }
+    self.query = 'include_entities=true&trim_user=1'
+    self.body = 'status=Hello%20Ladies%20%2B%20Gentlemen%2C%20a%20signed%20OAuth%20request%21'
+    self.arguments = {'include_entities': ['true'], 'trim_user': ['1'],
+                      'status': ['Hello Ladies + Gentlemen, a signed OAuth request!']}
+
+
+def legacy_normalized_parameters(request):
+  """the normalized parameters of a cyclone request as the original provider built
+  them, through oauth2.SignatureMethod.signing_base"""
+  return oauth_request(request).get_normalized_parameters()
+
+
+def old_path(request):
+  header = request.headers['Authorization']
+  extracted = {}
+  extracted.update(oauth2.Request._split_header(header.lstrip('OAuth ')))
+  if True in [p.find('oauth_') >= 0 for p in request.arguments]:
+    extracted.update((k, request.arguments[k][0]) for k in request.arguments if k.find('oauth_') >= 0)
+  params = dict((k, extracted[k]) for k in extracted)
+  req = oauth_request(request)
+  return params, signature_base_string(req.method, req.normalized_url, legacy_normalized_parameters(request))
+
+
+def new_path(request):
+  parsed = OAuthRequestParameters.from_request(request)
+  return parsed.oauth, parsed.base_string()
+
+
+def allocated(fn, request):
+  "the peak memory allocated while handling one request"
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  fn(request)
+  peak = tracemalloc.get_traced_memory()[1] - before
+  tracemalloc.stop()
+  return peak
+
+
+def main(n=20000):
+  request = FakeRequest()
+  for name, fn in (('old', old_path), ('new', new_path)):
+    t = timeit.timeit(lambda: fn(request), number=n)
+    line = '%s: %.2f us/request' % (name, t / n * 1e6)
+    if tracemalloc is not None:
+      line += ', %d bytes peak' % allocated(fn, request)
+    print line
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,166 @@
+"""Verifies mixed HMAC-SHA1 and RSA-SHA1 traffic with RSA checks inline, in a thread pool and in worker processes.
+
+    $ python benchmarks/bench_rsa.py [-n requests] [-r percent RSA] [-c concurrency] [-t threads] [-p processes]
+                                     [-o results.json]
+
+Requests from an HMAC consumer and an RSA consumer with a 2048 bit key are
+verified through the core, `-c` at a time, each worker yielding to the
+reactor between requests as it would between network events. `inline`
+checks RSA signatures on the reactor thread, as the provider does by
+default, `pool` in a pool of `-t` threads as it does when
+`oauth_signature_threads` is set and `process` in `-p` worker processes as
+it does when `oauth_signature_processes` is set. Reports requests per second for each kind
+of consumer, their p50/p99 latency and how late a 1ms timer on the reactor
+fired, which is how long other requests would have waited. Needs PyCrypto.
+"""
+import multiprocessing, optparse, random, time, urllib
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+from Crypto.Hash import SHA
+from twisted.internet import defer, reactor, task, threads
+from twisted.python.threadpool import ThreadPool
+from cycloauth.core import OAuthCore
+from cycloauth.nonce import MemoryNOnceStore
+from cycloauth.provider import run_deferred
+from cycloauth.request import OAuthRequestParameters
+from cycloauth.signatures import HMAC_SHA1, RSA_SHA1, SignatureProcessPool
+from cycloauth.storage import BaseStorage
+from bench_core import signed_requests
+from harness import latency_summary, save_results
+
+
+def rsa_signed_requests(consumer, token, private_key, n):
+  "`n` requests signed with RSA-SHA1 by `consumer`'s `private_key` and `token`"
+  signer = PKCS1_v1_5.new(private_key)
+  ret = []
+  for i in xrange(n):
+    oauth = dict(oauth_consumer_key=consumer.key, oauth_token=token.key, oauth_signature_method='RSA-SHA1',
+                 oauth_timestamp=str(int(time.time())), oauth_nonce='rsa%d' % i, oauth_version='1.0')
+    header = 'OAuth ' + ', '.join('%s="%s"' % (k, urllib.quote(v, safe='~')) for k, v in sorted(oauth.items()))
+    unsigned = OAuthRequestParameters.from_parts('GET', 'http', 'api.example.com', '/1/statuses.json',
+                                                 'count=20', {'Authorization': header}, None)
+    signature = signer.sign(SHA.new(unsigned.base_string())).encode('base64').replace('\n', '')
+    header += ', oauth_signature="%s"' % urllib.quote(signature, safe='~')
+    ret.append(('GET', 'http', 'api.example.com', '/1/statuses.json', 'count=20', {'Authorization': header}))
+  return ret
+
+
+def traffic(options):
+  "the storage and a shuffled list of (kind, request parts) pairs"
+  storage = BaseStorage({})
+  private_key = RSA.generate(2048)
+  hmac_consumer = storage.add_consumer().result
+  rsa_consumer = storage.add_consumer(rsa_key=private_key.publickey().exportKey()).result
+  token = storage.add_access_token().result
+  n_rsa = options.requests * options.rsa // 100
+  requests = [('hmac', r) for r in signed_requests(hmac_consumer, token, options.requests - n_rsa)]
+  requests += [('rsa', r) for r in rsa_signed_requests(rsa_consumer, token, private_key, n_rsa)]
+  random.shuffle(requests)
+  return storage, requests
+
+
+class LagMonitor(object):
+  "records how late a timer firing every `interval` seconds runs"
+
+  def __init__(self, interval=0.001):
+    self.interval = interval
+    self.lags = []
+    self.last = None
+    self.loop = task.LoopingCall(self.tick)
+
+  def tick(self):
+    now = time.time()
+    if self.last is not None:
+      self.lags.append(max(0.0, now - self.last - self.interval))
+    self.last = now
+
+
+def to_process(processes, check):
+  "runs `check` in the worker processes as the provider does, returns a deferred firing its result"
+  d = defer.Deferred()
+  processes.submit(check, lambda ok, result: reactor.callFromThread(d.callback if ok else d.errback, result))
+  return d
+
+
+@defer.inlineCallbacks
+def bench(mode, storage, requests, options):
+  offload = None
+  pool = processes = None
+  if mode == 'pool':
+    pool = ThreadPool(0, options.threads, 'bench-signatures')
+    pool.start()
+    offload = lambda check: threads.deferToThreadPool(reactor, pool, check)
+  elif mode == 'process':
+    processes = SignatureProcessPool(options.processes)
+    offload = lambda check: to_process(processes, check)
+  c = OAuthCore({}, storage, MemoryNOnceStore({'nonce_cache_size': 1000000}),
+                {'HMAC-SHA1': HMAC_SHA1(), 'RSA-SHA1': RSA_SHA1()}, offload=offload)
+  latencies = {'hmac': [], 'rsa': []}
+  pending = iter(requests)
+  monitor = LagMonitor()
+
+  @defer.inlineCallbacks
+  def worker():
+    for kind, r in pending:
+      yield task.deferLater(reactor, 0, lambda: None)
+      started = time.time()
+      yield run_deferred(c.verify(OAuthRequestParameters.from_parts(*(r + (None,)))))
+      latencies[kind].append(time.time() - started)
+
+  monitor.loop.start(monitor.interval)
+  started = time.time()
+  yield defer.DeferredList([worker() for i in xrange(options.concurrency)], fireOnOneErrback=True)
+  elapsed = time.time() - started
+  monitor.loop.stop()
+  if pool is not None:
+    pool.stop()
+  if processes is not None:
+    processes.close()
+  metrics = {'%s.rps' % mode: len(requests) / elapsed}
+  print '%s: %.1f requests/s' % (mode, metrics['%s.rps' % mode])
+  for kind in ('hmac', 'rsa'):
+    summary = latency_summary(latencies[kind])
+    if summary['count']:
+      metrics['%s.%s.rps' % (mode, kind)] = summary['count'] / elapsed
+      metrics['%s.%s.p50_ms' % (mode, kind)] = summary['p50']
+      metrics['%s.%s.p99_ms' % (mode, kind)] = summary['p99']
+      print '  %-5s %8.1f requests/s  p50 %7.2f ms  p99 %7.2f ms' % (
+        kind, summary['count'] / elapsed, summary['p50'], summary['p99'])
+  lag = latency_summary(monitor.lags)
+  if lag['count']:
+    metrics['%s.reactor_lag.p99_ms' % mode] = lag['p99']
+    print '  reactor lag  p99 %7.2f ms  max %7.2f ms' % (lag['p99'], lag['max'])
+  defer.returnValue(metrics)
+
+
+@defer.inlineCallbacks
+def run(options):
+  storage, requests = traffic(options)
+  metrics = {}
+  try:
+    for mode in ('inline', 'pool', 'process'):
+      # each run has its own nonce store, so the same requests can be verified again
+      metrics.update((yield bench(mode, storage, requests, options)))
+    if options.output:
+      save_results(options.output, 'rsa', metrics, requests=options.requests, rsa_percent=options.rsa,
+                   concurrency=options.concurrency, threads=options.threads, processes=options.processes)
+  finally:
+    reactor.stop()
+
+
+def main():
+  parser = optparse.OptionParser(usage='%prog [-n requests] [-r percent RSA] [-c concurrency] [-t threads] '
+                                       '[-p processes] [-o results.json]')
+  parser.add_option('-n', '--requests', type='int', default=20000)
+  parser.add_option('-r', '--rsa', type='int', default=10, help='percentage of requests signed with RSA-SHA1')
+  parser.add_option('-c', '--concurrency', type='int', default=50)
+  parser.add_option('-t', '--threads', type='int', default=4)
+  parser.add_option('-p', '--processes', type='int', default=multiprocessing.cpu_count())
+  parser.add_option('-o', '--output', help='save the results to this file')
+  options, args = parser.parse_args()
+  reactor.callWhenRunning(lambda: run(options).addErrback(lambda f: f.printTraceback()))
+  reactor.run()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,119 @@
+"""Compares verifying requests by looking their access tokens up with stateless tokens.
+
+    $ python benchmarks/bench_stateless.py [-n requests] [-c concurrency] [--mongo] [-o results.json]
+
+Both paths verify the same number of signed requests through the core, the
+nonce checks are in memory. Without --mongo `lookup` uses a BaseStorage and
+`stateless` a StatelessTokenStorage over one, both answering synchronously,
+which shows the cost of decoding a token. With --mongo `lookup` uses a
+MongoDBStorage on the `oauth_bench` database of a mongod on localhost and
+`stateless` a StatelessTokenStorage over it, `-c` requests at a time.
+Reports requests per second; with -o the results are also saved for
+benchmarks/compare.py.
+"""
+import optparse, os, time
+from twisted.internet import defer, reactor
+from cycloauth.core import OAuthCore, run_sync
+from cycloauth.nonce import MemoryNOnceStore
+from cycloauth.provider import run_deferred
+from cycloauth.request import OAuthRequestParameters
+from cycloauth.signatures import HMAC_SHA1
+from cycloauth.storage import BaseStorage
+from cycloauth.storage.stateless import StatelessTokenStorage
+from bench_core import signed_requests
+from harness import save_results
+
+
+MASTER_KEYS = {'bench': os.urandom(32)}
+
+
+def make_core(storage):
+  return OAuthCore({}, storage, MemoryNOnceStore({'nonce_cache_size': 1000000}), {'HMAC-SHA1': HMAC_SHA1()})
+
+
+@defer.inlineCallbacks
+def credentials(storage):
+  consumer = yield storage.add_consumer()
+  token = yield storage.add_access_token(consumer_key=consumer.key)
+  defer.returnValue((consumer, token))
+
+
+def parsed_requests(consumer, token, n):
+  return [OAuthRequestParameters.from_parts(*(r + (None,))) for r in signed_requests(consumer, token, n)]
+
+
+def bench_sync(storage, n):
+  ret = []
+  credentials(storage).addCallback(ret.append)
+  consumer, token = ret[0]
+  c = make_core(storage)
+  requests = parsed_requests(consumer, token, n)
+  started = time.time()
+  for parsed in requests:
+    run_sync(c.verify(parsed))
+  return n / (time.time() - started)
+
+
+@defer.inlineCallbacks
+def bench_deferred(storage, n, concurrency):
+  yield storage.start()
+  consumer, token = yield credentials(storage)
+  c = make_core(storage)
+  requests = iter(parsed_requests(consumer, token, n))
+
+  @defer.inlineCallbacks
+  def worker():
+    for parsed in requests:
+      yield run_deferred(c.verify(parsed))
+
+  started = time.time()
+  yield defer.DeferredList([worker() for i in xrange(concurrency)], fireOnOneErrback=True)
+  rps = n / (time.time() - started)
+  yield storage.remove_access_token(token.key)
+  yield storage.remove_consumer(consumer.key)
+  yield storage.stop()
+  defer.returnValue(rps)
+
+
+def report(options, metrics):
+  for name in ('lookup', 'stateless'):
+    print '%s: %.1f requests/s' % (name, metrics['%s.rps' % name])
+  if options.output:
+    save_results(options.output, 'stateless', metrics, mongo=options.mongo, requests=options.requests,
+                 concurrency=options.concurrency)
+
+
+@defer.inlineCallbacks
+def run_mongo(options):
+  mongo = {'oauth_mongo_database': 'oauth_bench'}
+  stateless = dict(mongo, oauth_cached_storage_factory='cycloauth.storage.mongodb.MongoDBStorage',
+                   oauth_token_master_keys=MASTER_KEYS)
+  from cycloauth.storage.mongodb import MongoDBStorage
+  metrics = {}
+  try:
+    metrics['lookup.rps'] = yield bench_deferred(MongoDBStorage(mongo), options.requests, options.concurrency)
+    metrics['stateless.rps'] = yield bench_deferred(StatelessTokenStorage(stateless), options.requests,
+                                                    options.concurrency)
+    report(options, metrics)
+  finally:
+    reactor.stop()
+
+
+def main():
+  parser = optparse.OptionParser(usage='%prog [-n requests] [-c concurrency] [--mongo] [-o results.json]')
+  parser.add_option('-n', '--requests', type='int', default=20000)
+  parser.add_option('-c', '--concurrency', type='int', default=50)
+  parser.add_option('--mongo', action='store_true', default=False)
+  parser.add_option('-o', '--output', help='save the results to this file')
+  options, args = parser.parse_args()
+  if options.mongo:
+    reactor.callWhenRunning(lambda: run_mongo(options).addErrback(lambda f: f.printTraceback()))
+    reactor.run()
+  else:
+    report(options, {'lookup.rps': bench_sync(BaseStorage({}), options.requests),
+                     'stateless.rps': bench_sync(StatelessTokenStorage({'oauth_token_master_keys': MASTER_KEYS}),
+                                                 options.requests)})
+
+
+if __name__ == '__main__':
+  main()
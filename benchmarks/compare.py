@@ -0,0 +1,52 @@
+"""Compares two results files written by the benchmark suite.
+
+    $ python benchmarks/compare.py baseline.json new.json [-t percent]
+
+Prints every metric of both runs with the change between them and exits
+with status 1 if any got worse by more than the threshold (10% by default).
+"""
+import json, optparse, sys
+
+
+def load_results(path):
+  with open(path) as f:
+    return json.load(f)
+
+
+def higher_is_better(name):
+  return name.endswith('rps') or name.endswith('per_second')
+
+
+def compare(baseline, new, threshold):
+  "prints the comparison, returns the names of the metrics that regressed"
+  if baseline.get('kind') != new.get('kind'):
+    raise ValueError('cannot compare %s results with %s results' % (baseline.get('kind'), new.get('kind')))
+  regressed = []
+  for name in sorted(set(baseline['metrics']) & set(new['metrics'])):
+    old, value = baseline['metrics'][name], new['metrics'][name]
+    if old:
+      change = (value - old) * 100.0 / old
+    else:
+      change = 0.0 if not value else float('inf')
+    worse = -change if higher_is_better(name) else change
+    flag = ''
+    if worse > threshold:
+      flag = '  REGRESSION'
+      regressed.append(name)
+    print '%-32s %12.2f %12.2f %+8.1f%%%s' % (name, old, value, change, flag)
+  return regressed
+
+
+def main():
+  parser = optparse.OptionParser(usage='%prog baseline.json new.json [-t percent]')
+  parser.add_option('-t', '--threshold', type='float', default=10.0,
+                    help='percent a metric may get worse by before it is a regression')
+  options, args = parser.parse_args()
+  if len(args) != 2:
+    parser.error('expected two results files')
+  regressed = compare(load_results(args[0]), load_results(args[1]), options.threshold)
+  sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,51 @@
+"""Helpers shared by the benchmark suite: signing requests the way a client
+does, latency percentiles and the machine-readable results files read by
+benchmarks/compare.py."""
+import json, math, platform, sys, time, urllib
+from cycloauth.keygen import random_hex
+from cycloauth.request import OAuthRequestParameters
+from cycloauth.signatures import HMAC_SHA1
+
+
+_hmac_sha1 = HMAC_SHA1()
+
+
+def authorization_header(method, scheme, host, path, query, consumer, token=None, **oauth):
+  """the Authorization header of a request signed with HMAC-SHA1 by `consumer`
+  and `token`, any extra oauth_* parameters are passed as keywords"""
+  params = dict(oauth_consumer_key=consumer.key, oauth_signature_method='HMAC-SHA1',
+                oauth_timestamp=str(int(time.time())), oauth_nonce=random_hex(16), oauth_version='1.0')
+  if token is not None:
+    params['oauth_token'] = token.key
+  params.update(oauth)
+  header = 'OAuth ' + ', '.join('%s="%s"' % (k, urllib.quote(v, safe='~')) for k, v in sorted(params.items()))
+  parsed = OAuthRequestParameters.from_parts(method, scheme, host, path, query, {'Authorization': header}, None)
+  signature = _hmac_sha1.sign(parsed.base_string(), consumer.secret, token.secret if token else None)
+  return header + ', oauth_signature="%s"' % urllib.quote(signature, safe='~')
+
+
+def percentile(sorted_values, p):
+  "the `p`th percentile (0-100) of already sorted values, by nearest rank"
+  if not sorted_values:
+    return None
+  i = int(math.ceil(p / 100.0 * len(sorted_values))) - 1
+  return sorted_values[max(0, i)]
+
+
+def latency_summary(latencies):
+  "p50, p99, mean and max of a list of latencies in seconds, in milliseconds"
+  values = sorted(latencies)
+  if not values:
+    return dict(count=0)
+  return dict(count=len(values), p50=percentile(values, 50) * 1000, p99=percentile(values, 99) * 1000,
+              mean=sum(values) / len(values) * 1000, max=values[-1] * 1000)
+
+
+def save_results(path, kind, metrics, **info):
+  """writes a results file, `metrics` maps a flat name to a number. Names ending
+  in `rps` are better when higher, all others when lower."""
+  doc = dict(kind=kind, metrics=metrics, created=time.time(), python=sys.version.split()[0],
+             platform=platform.platform())
+  doc.update(info)
+  with open(path, 'w') as f:
+    json.dump(doc, f, indent=2, sort_keys=True)
@@ -0,0 +1,130 @@
+"""Runs the provider on asyncio event loops.
+
+On Python 2 this needs trollius, the Python 2 port of asyncio; the same code
+runs on asyncio proper, and so under uvloop, once on Python 3. Storages and
+nonce stores may return plain values, asyncio futures or twisted Deferreds
+which have already fired, as the in-memory ones do, so BaseStorage and
+MemoryNOnceStore work without a reactor.
+"""
+import time
+try:
+  import asyncio
+except ImportError:
+  import trollius as asyncio
+from cycloauth.core import OAuthCore, returnValue, run as run_core
+from cycloauth.metrics import Metrics
+from cycloauth.request import OAuthRequestParameters
+from cycloauth.signatures import HMAC_SHA1, HMAC_SHA256, PLAINTEXT, RSA_SHA1, rsa_available
+from cycloauth.signatures import SignatureProcessPool, signature_processes
+from cycloauth.utils import import_object
+
+
+def run(gen, loop=None):
+  "runs a cycloauth.core generator, returns an asyncio future of its result"
+  future = asyncio.Future(loop=loop)
+  run_core(gen, future.set_result, lambda exc: future.set_exception(exc[1]))
+  return future
+
+
+class AsyncioOAuthProvider(object):
+  """The provider for asyncio servers, each method returns a future to be
+  awaited (`yield From(...)` with trollius) by the server's request handlers.
+
+  Requests are described by their method, scheme, host, path, query string,
+  headers and body, so any framework's request object can be passed apart.
+  Storage and nonce store are created from `oauth_storage_factory` and
+  `oauth_nonce_store_factory` like OAuthApplicationMixin does, unless given;
+  the storage defaults to cycloauth.storage.aio.AsyncioStorage, which is
+  given the loop as `loop` in its settings.
+  """
+  oauth_signature_methods = {
+    'HMAC-SHA1': HMAC_SHA1,
+    'HMAC-SHA256': HMAC_SHA256,
+    'PLAINTEXT': PLAINTEXT
+  }
+  if rsa_available:
+    oauth_signature_methods['RSA-SHA1'] = RSA_SHA1
+
+  def __init__(self, settings, storage=None, nonce_store=None, loop=None):
+    self.settings = settings
+    self.loop = loop
+    if storage is None:
+      factory_name = settings.get('oauth_storage_factory', 'cycloauth.storage.aio.AsyncioStorage')
+      storage = import_object(factory_name)(dict(settings, loop=loop) if loop is not None else settings)
+    if nonce_store is None:
+      factory_name = settings.get('oauth_nonce_store_factory', 'cycloauth.nonce.MemoryNOnceStore')
+      nonce_store = import_object(factory_name)(settings, storage)
+    self.storage = storage
+    self.nonce_store = nonce_store
+    self.metrics = Metrics() if settings.get('oauth_metrics', False) else None
+    self.signature_pool = None
+    offload = None
+    if settings.get('oauth_signature_threads', 0):
+      offload = self._offload_to_thread
+    elif signature_processes(settings):
+      self.signature_pool = SignatureProcessPool(signature_processes(settings),
+                                                 settings.get('oauth_signature_timeout', 30))
+      offload = self._offload
+    self.core = OAuthCore(settings, storage, nonce_store,
+                          dict((k, v()) for k, v in self.oauth_signature_methods.iteritems()), self.metrics, offload)
+
+  def start(self):
+    return self._run(self.storage.start())
+
+  def stop(self):
+    if self.signature_pool is not None:
+      self.signature_pool.close()
+    return self._run(self.storage.stop())
+
+  def _offload(self, check):
+    loop = self.loop or asyncio.get_event_loop()
+    future = asyncio.Future(loop=loop)
+    self.signature_pool.submit(check, lambda ok, result: loop.call_soon_threadsafe(
+      future.set_result if ok else future.set_exception, result))
+    return future
+
+  def _offload_to_thread(self, check):
+    # the loop's default executor, a bounded thread pool
+    return (self.loop or asyncio.get_event_loop()).run_in_executor(None, check)
+
+  def _parse(self, *parts):
+    if self.metrics is None:
+      return OAuthRequestParameters.from_parts(*parts)
+    started = time.time()
+    parsed = OAuthRequestParameters.from_parts(*parts)
+    self.metrics.observe('parse', time.time() - started)
+    return parsed
+
+  def _run(self, gen):
+    return run(gen if hasattr(gen, 'send') else _wait(gen), self.loop)
+
+  def verify_request(self, method, scheme, host, path, query, headers, body=None, body_hasher=None):
+    """returns a future of the (consumer, token) the request was signed with, or of the
+    error. Servers streaming the body pass a cycloauth.request.BodyHasher they fed
+    with it instead of the body."""
+    parsed = self._parse(method, scheme, host, path, query, headers, body, body_hasher)
+    return self._run(self.core.verify(parsed))
+
+  def request_token(self, method, scheme, host, path, query, headers, body=None):
+    "returns a future of the request token issued, whose to_string() is the response body"
+    parsed = self._parse(method, scheme, host, path, query, headers, body)
+    return self._run(self.core.request_token(parsed))
+
+  def authorize(self, token_key):
+    "returns a future of the authorized request token, redirect to its get_callback_url()"
+    return self._run(self.core.authorize(token_key))
+
+  def access_token(self, method, scheme, host, path, query, headers, body=None):
+    "returns a future of the access token issued, whose to_string() is the response body"
+    parsed = self._parse(method, scheme, host, path, query, headers, body)
+    return self._run(self.core.access_token(parsed))
+
+  def introspect(self, items):
+    """returns a future of the result of verifying each item, a (token key, consumer
+    key) pair or an OAuthRequestParameters, see OAuthCore.introspect"""
+    return self._run(self.core.introspect(items))
+
+
+def _wait(result):
+  "a core generator waiting on a single result"
+  returnValue((yield result))
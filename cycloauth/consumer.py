@@ -1,5 +1,31 @@
+import urllib
 from oauth2 import Consumer as OAuthConsumer
 
 
 class Consumer(OAuthConsumer):
   callback = None
+  # the PEM or DER public key of consumers signing with RSA-SHA1
+  rsa_key = None
+
+  def __init__(self, key, secret, callback=None, rsa_key=None, **kwargs):
+    OAuthConsumer.__init__(self, key, secret)
+    if callback is not None:
+      self.callback = callback
+    if rsa_key is not None:
+      self.rsa_key = rsa_key
+
+
+class CompactConsumer(object):
+  "A consumer without a per-instance __dict__, for stores holding very many consumers"
+  __slots__ = ('key', 'secret', 'callback', 'rsa_key')
+
+  def __init__(self, key, secret, callback=None, rsa_key=None, **kwargs):
+    if key is None or secret is None:
+      raise ValueError("Key and secret must be set.")
+    self.key = key
+    self.secret = secret
+    self.callback = callback
+    self.rsa_key = rsa_key
+
+  def __str__(self):
+    return urllib.urlencode({'oauth_consumer_key': self.key, 'oauth_consumer_secret': self.secret})
@@ -0,0 +1,523 @@
+import sys, time, copy, functools
+from types import GeneratorType
+import oauth2
+from oauth2 import MissingSignature
+from cycloauth.errors import *
+from cycloauth.signatures import constant_time_compare
+from cycloauth.utils import MISSING
+
+
+__all__ = ['Return', 'returnValue', 'WouldBlock', 'Gather', 'run', 'run_sync', 'fetch_many', 'OAuthCore',
+           'check_timestamp', 'check_body_hash', 'verifier_matches']
+
+
+class Return(Exception):
+  "ends a core generator with a value, like twisted's defer.returnValue"
+
+  def __init__(self, value):
+    Exception.__init__(self)
+    self.value = value
+
+
+def returnValue(value):
+  raise Return(value)
+
+
+class WouldBlock(Exception):
+  """raised by run_sync when something a generator waits on doesn't complete
+  synchronously"""
+
+
+class Gather(object):
+  """Yielded by a core generator to wait on several generators, Deferreds or
+  futures at once. Resolves to a list of (success, result or exception)
+  pairs in the order given, like twisted's DeferredList."""
+  __slots__ = ('items',)
+
+  def __init__(self, items):
+    self.items = list(items)
+
+
+def _await(awaitable):
+  "a core generator waiting on a single result"
+  returnValue((yield awaitable))
+
+
+class Runner(object):
+  """Drives a core generator to completion.
+
+  Each value the generator yields is resolved and sent back in: another
+  generator is run as a nested call, a twisted Deferred or an asyncio Future
+  is waited on, the items of a Gather are run side by side and anything else
+  is a result already. Nothing is scheduled on any event loop, so results which are ready, such as those of in-memory
+  storages, are consumed without giving up control.
+  """
+
+  def __init__(self, gen, callback, errback, sync_only=False):
+    self.stack = [gen]
+    self.callback = callback
+    self.errback = errback
+    self.sync_only = sync_only
+
+  def step(self, value=None, exc=None):
+    while True:
+      gen = self.stack[-1]
+      try:
+        if exc is not None:
+          yielded = gen.throw(*exc)
+        else:
+          yielded = gen.send(value)
+      except Return, r:
+        value, exc = r.value, None
+      except StopIteration:
+        value, exc = None, None
+      except Exception:
+        value, exc = None, sys.exc_info()
+      else:
+        if isinstance(yielded, GeneratorType):
+          self.stack.append(yielded)
+          value = exc = None
+          continue
+        resolved = self.wait(yielded)
+        if resolved is None:
+          return
+        value, exc = resolved
+        continue
+      self.stack.pop()
+      if not self.stack:
+        if exc is not None:
+          self.errback(exc)
+        else:
+          self.callback(value)
+        return
+
+  def wait(self, yielded):
+    "returns (value, exc_info) if `yielded` is resolved now, otherwise arranges to resume and returns None"
+    state = {'sync': True, 'result': None, 'abandoned': False}
+
+    def resume(value, exc):
+      if state['abandoned']:
+        return
+      if state['sync']:
+        state['result'] = (value, exc)
+      else:
+        self.step(value, exc)
+
+    if isinstance(yielded, Gather):
+      self.gather(yielded.items, resume)
+    elif hasattr(yielded, 'addCallbacks'):
+      yielded.addCallbacks(lambda r: resume(r, None),
+                           lambda f: resume(None, (f.type, f.value, f.getTracebackObject())))
+    elif hasattr(yielded, 'add_done_callback'):
+      if yielded.done():
+        resume(*_future_result(yielded))
+      else:
+        yielded.add_done_callback(lambda f: resume(*_future_result(f)))
+    else:
+      resume(yielded, None)
+    state['sync'] = False
+    if state['result'] is None and self.sync_only:
+      state['abandoned'] = True
+      return None, (WouldBlock, WouldBlock('%r did not complete synchronously' % (yielded,)), None)
+    return state['result']
+
+  def gather(self, items, resume):
+    "runs every item in a Runner of its own, resumes with their outcomes once all are done"
+    results = [None] * len(items)
+    remaining = [len(items)]
+
+    def done(i, outcome):
+      results[i] = outcome
+      remaining[0] -= 1
+      if not remaining[0]:
+        resume(results, None)
+
+    if not items:
+      resume(results, None)
+    for i, item in enumerate(items):
+      Runner(item if isinstance(item, GeneratorType) else _await(item),
+             lambda value, i=i: done(i, (True, value)),
+             lambda exc, i=i: done(i, (False, exc[1]))).step()
+
+
+def _future_result(future):
+  try:
+    return future.result(), None
+  except Exception:
+    return None, sys.exc_info()
+
+
+def run(gen, callback, errback):
+  "runs a core generator, calling `callback` with its result or `errback` with exc_info"
+  Runner(gen, callback, errback).step()
+
+
+def run_sync(gen):
+  """runs a core generator to completion right away and returns its result,
+  raising WouldBlock if it had to wait on anything"""
+  ret = []
+  Runner(gen, lambda value: ret.append((value, None)), lambda exc: ret.append((None, exc)), True).step()
+  value, exc = ret[0]
+  if exc is not None:
+    raise exc[0], exc[1], exc[2]
+  return value
+
+
+def get_consumer_and_token(storage, consumer_key, token_key, token_type='access', metrics=None):
+  """returns the consumer and token, straight away when the storage can answer
+  without waiting, in one go when it implements get_consumer_and_token and
+  with both lookups at once otherwise"""
+  if metrics is not None:
+    started = time.time()
+  nowait = getattr(storage, 'get_consumer_and_token_nowait', None)
+  ret = nowait(consumer_key, token_key, token_type) if nowait is not None else MISSING
+  if ret is MISSING and getattr(storage, 'get_consumer_and_token', None) is not None:
+    ret = yield storage.get_consumer_and_token(consumer_key, token_key, token_type)
+  if ret is not MISSING:
+    if metrics is not None:
+      metrics.observe('consumer_and_token_fetch', time.time() - started)
+    returnValue(ret)
+  lookups = [storage.get_consumer(consumer_key), getattr(storage, 'get_%s_token' % token_type)(token_key)]
+  if metrics is not None:
+    lookups = [_timed(lookup, metrics, stage, started) for lookup, stage in zip(lookups, ('consumer_fetch', 'token_fetch'))]
+  results = yield Gather(lookups)
+  for ok, result in results:
+    if not ok:
+      raise result
+  returnValue(tuple(result for ok, result in results))
+
+
+def _timed(awaitable, metrics, stage, started):
+  "waits on `awaitable`, observing the time since `started` as `stage`"
+  ret = yield awaitable
+  metrics.observe(stage, time.time() - started)
+  returnValue(ret)
+
+
+def fetch_many(storage, kind, keys):
+  """returns a dict of `keys` to their 'consumer' or 'access_token' (None if
+  unknown), in one lookup when the storage implements get_consumers or
+  get_access_tokens and with every lookup at once otherwise"""
+  keys = list(keys)
+  if not keys:
+    returnValue({})
+  batch = getattr(storage, 'get_%ss' % kind, None)
+  if batch is not None:
+    returnValue((yield batch(keys)))
+  get = getattr(storage, 'get_%s' % kind)
+  results = yield Gather([get(key) for key in keys])
+  for ok, result in results:
+    if not ok:
+      raise result
+  returnValue(dict((key, result) for key, (ok, result) in zip(keys, results)))
+
+
+def issued_to(storage, tokens):
+  """the key of the consumer each of the fetched access `tokens` was issued to, or
+  None where it isn't known. Tokens with a consumer_key attribute answer
+  themselves, None included, as they were read with everything stored about
+  them; only tokens without one are asked of the storage's
+  access_token_consumer_key, at once"""
+  ret = {}
+  unknown = []
+  for key, token in tokens.iteritems():
+    if token is None:
+      continue
+    if hasattr(token, 'consumer_key'):
+      ret[key] = token.consumer_key
+    else:
+      ret[key] = None
+      unknown.append(key)
+  lookup = getattr(storage, 'access_token_consumer_key', None)
+  if lookup is not None and unknown:
+    results = yield Gather([lookup(key) for key in unknown])
+    for key, (ok, result) in zip(unknown, results):
+      if not ok:
+        raise result
+      ret[key] = result if result is not MISSING else None
+  returnValue(ret)
+
+
+class Prefetched(object):
+  """answers get_consumer_and_token from consumers and access tokens already
+  fetched, a token issued to another consumer than asked for (as told by
+  `issued_to`, a dict of token key to consumer key) being None"""
+
+  def __init__(self, consumers, tokens, issued_to=None):
+    self.consumers = consumers
+    self.tokens = tokens
+    self.issued_to = issued_to or {}
+
+  def get_consumer_and_token_nowait(self, consumer_key, token_key, token_type='access'):
+    token = self.tokens.get(token_key, None) if token_key else None
+    if token is not None and consumer_key:
+      owner = self.issued_to.get(token_key, None)
+      if owner is not None and owner != consumer_key:
+        token = None
+    return (self.consumers.get(consumer_key, None), token)
+
+
+class OAuthCore(object):
+  """The OAuth verification and token issuing logic, free of any web framework.
+
+  Methods are generators taking the parsed parameters of a request
+  (an OAuthRequestParameters). They yield the storage and nonce store
+  operations they depend on and are run by `run` or `run_sync` here, the
+  Deferred adapter in cycloauth.provider or the asyncio one in cycloauth.aio.
+
+  Given a cycloauth.metrics.Metrics, the time spent in each stage is observed
+  into it; without one timing costs a None check per stage. Given `offload`,
+  a function running a callable elsewhere and returning a Deferred or future
+  of its result, the checks of blocking signature methods (RSA-SHA1) are
+  handed to it instead of being run in the caller's thread.
+  """
+
+  def __init__(self, settings, storage, nonce_store, signature_methods, metrics=None, offload=None):
+    self.storage = storage
+    self.nonce_store = nonce_store
+    self.signature_methods = signature_methods
+    self.metrics = metrics
+    self.offload = offload
+    self.timestamp_threshold = settings.get('oauth_timestamp_threshold', 300)
+    self.timestamp_skew = settings.get('oauth_timestamp_skew', 60)
+    self.require_body_hash = settings.get('oauth_require_body_hash', False)
+
+  def with_storage(self, storage):
+    "returns a copy of this core using `storage`"
+    ret = copy.copy(self)
+    ret.storage = storage
+    return ret
+
+  def verify(self, parsed, token_type='access'):
+    "returns the (consumer, token) a request was signed with"
+    metrics = self.metrics
+    if metrics is not None:
+      started = time.time()
+    try:
+      consumer_key = parsed.oauth.get('oauth_consumer_key', None)
+      token_key = parsed.oauth.get('oauth_token', None)
+      if len(parsed.oauth) == 0:
+        raise NotAnOAuthRequest('The request made does not contain one or more OAuth parameters.')
+      elif not (consumer_key or token_key):
+        raise PartialOAuthRequest('A consumer or token was not provided in the request.')
+      consumer, token = yield get_consumer_and_token(self.storage, consumer_key, token_key, token_type, metrics)
+      yield self.check_signature(parsed, consumer, token)
+    except Exception, e:
+      if metrics is not None:
+        metrics.fail(e.__class__.__name__)
+      raise
+    if metrics is not None:
+      metrics.observe('verify', time.time() - started)
+    returnValue((consumer, token))
+
+  def check_signature(self, parsed, consumer, token):
+    params = parsed.oauth
+    metrics = self.metrics
+    try:
+      timestamp = params['oauth_timestamp']
+    except KeyError:
+      raise PartialOAuthRequest('Missing oauth_timestamp.')
+    if metrics is not None:
+      started = time.time()
+    check_timestamp(timestamp, self.timestamp_threshold, self.timestamp_skew)
+    if metrics is not None:
+      metrics.observe('timestamp', time.time() - started)
+    try:
+      nonce = params['oauth_nonce']
+    except KeyError:
+      raise PartialOAuthRequest('Missing oauth_nonce.')
+    try:
+      signature_method = self.signature_methods[params['oauth_signature_method']]
+    except KeyError:
+      raise UnknownSignature('Unknown oauth_signature_method.')
+    try:
+      signature = params['oauth_signature']
+    except KeyError:
+      raise MissingSignature('The oauth_signature is missing')
+    if consumer is None:
+      raise Error('Unknown oauth_consumer_key.')
+    if metrics is not None:
+      started = time.time()
+    base = parsed.base_string()
+    blocking = getattr(signature_method, 'blocking', False)
+    if isinstance(signature_method, oauth2.SignatureMethod):
+      # written for python-oauth2, it signs an oauth2.Request
+      check = functools.partial(signature_method.check, parsed.oauth2_request(), consumer, token, signature)
+    elif blocking:
+      check = signature_method.checker(base, consumer, token, signature)
+    else:
+      check = None
+    if check is None:
+      valid = signature_method.check(base, consumer.secret, token.secret if token else None, signature)
+    elif blocking and self.offload is not None:
+      valid = yield self.offload(check)
+    else:
+      valid = check()
+    if metrics is not None:
+      metrics.observe('signature', time.time() - started)
+    if not valid:
+      raise Error(('Invalid signature. Expected signature base string: ' + str(base)), 'sock')
+    check_body_hash(parsed, self.require_body_hash)
+    # only authentic requests are recorded, so nobody else can fill the nonce store
+    yield self.check_nonce(params.get('oauth_consumer_key', None), nonce, timestamp)
+
+  def check_nonce(self, consumer_key, nonce, timestamp):
+    "records the nonce, raises NOnceReplayed if it was used recently"
+    metrics = self.metrics
+    if metrics is not None:
+      started = time.time()
+    nowait = getattr(self.nonce_store, 'check_and_add_nowait', None)
+    if nowait is not None:
+      fresh = nowait(consumer_key, nonce, timestamp)
+    else:
+      fresh = yield self.nonce_store.check_and_add(consumer_key, nonce, timestamp)
+    if metrics is not None:
+      metrics.observe('nonce', time.time() - started)
+    if not fresh:
+      raise NOnceReplayed('The provided nonce value has been used recently.')
+
+  def request_token(self, parsed):
+    "verifies a request token request and returns the new request token"
+    if self.metrics is not None:
+      started = time.time()
+    consumer = yield self.storage.get_consumer(parsed.oauth['oauth_consumer_key'])
+    if self.metrics is not None:
+      self.metrics.observe('consumer_fetch', time.time() - started)
+    yield self.check_signature(parsed, consumer, None)
+    token = yield self.storage.add_request_token()
+    callback = parsed.oauth.get('oauth_callback', None)
+    if callback:
+      if callback == 'oob':
+        if hasattr(consumer, 'callback'):
+          token.set_callback(consumer.callback)
+        else:
+          raise PartialOAuthRequest("There is no callback set for out-of-band (oob) use")
+      else:
+        token.set_callback(callback)
+    else:
+      if hasattr(consumer, 'callback'):
+        token.set_callback(consumer.callback)
+      else:
+        raise PartialOAuthRequest("Missing oauth_callback. Required by OAuth 1.0a")
+    yield self.storage.save_request_token(token)
+    returnValue(token)
+
+  def authorize(self, token_key):
+    "gives a request token its verifier, returns the token"
+    token = yield self.storage.authorize_request_token(token_key)
+    if token is None:
+      raise Error('Unknown, expired or already authorized oauth_token.')
+    returnValue(token)
+
+  def access_token(self, parsed):
+    "verifies an access token request, exchanges its request token and returns the new access token"
+    consumer, request_token = yield get_consumer_and_token(self.storage,
+      parsed.oauth['oauth_consumer_key'], parsed.oauth['oauth_token'], 'request', self.metrics)
+    try:
+      verifier = parsed.oauth['oauth_verifier']
+    except KeyError:
+      raise InvalidVerifier('Missing oauth_verifier. Required by OAuth 1.0a')
+    if request_token is None:
+      raise Error('Unknown or expired oauth_token.')
+    yield self.check_signature(parsed, consumer, request_token)
+    if not verifier_matches(verifier, request_token.verifier):
+      raise InvalidVerifier('Invalid Verifier.')
+    if not (yield self.storage.exchange_request_token(request_token.key, verifier)):
+      raise Error('The oauth_token has already been exchanged.')
+    access_token = yield self.storage.add_access_token(consumer_key=consumer.key)
+    returnValue(access_token)
+
+  def introspect(self, items):
+    """verifies a batch of items for other services, each a signed request's
+    OAuthRequestParameters or a (token key, consumer key or None) pair.
+
+    Every consumer and access token involved is fetched once, in one lookup
+    per kind when the storage supports it, then the items are checked side by
+    side. Returns a dict per item, in order, with the consumer key, token key,
+    whether it is valid and, if it isn't, the reason.
+    """
+    keys = [introspected_keys(item) for item in items]
+    consumers = yield fetch_many(self.storage, 'consumer', set(c for t, c in keys if c))
+    tokens = yield fetch_many(self.storage, 'access_token', set(t for t, c in keys if t))
+    owners = yield issued_to(self.storage, tokens)
+    core = self.with_storage(Prefetched(consumers, tokens, owners))
+    results = yield Gather([core._introspect_pair(item) if isinstance(item, tuple) else core._introspect_request(item)
+                            for item in items])
+    ret = []
+    for (token_key, consumer_key), (ok, result) in zip(keys, results):
+      if not ok:
+        result = dict(consumer_key=consumer_key, token=token_key, valid=False,
+                      reason=getattr(result, 'log_message', None) or str(result))
+      ret.append(result)
+    returnValue(ret)
+
+  def _introspect_pair(self, item):
+    token_key, consumer_key = item
+    consumer, token = yield get_consumer_and_token(self.storage, consumer_key, token_key)
+    if token is None:
+      raise Error('Unknown or revoked oauth_token.')
+    if consumer_key and consumer is None:
+      raise Error('Unknown oauth_consumer_key.')
+    returnValue(dict(consumer_key=consumer_key, token=token_key, valid=True, reason=None))
+
+  def _introspect_request(self, parsed):
+    token_key = parsed.oauth.get('oauth_token', None)
+    consumer_key = parsed.oauth.get('oauth_consumer_key', None)
+    if token_key and self.storage.get_consumer_and_token_nowait(consumer_key, token_key)[1] is None:
+      # a request that can't be valid doesn't use up its nonce
+      raise Error('Unknown or revoked oauth_token.')
+    consumer, token = yield self.verify(parsed)
+    returnValue(dict(consumer_key=consumer.key, token=token.key if token else None, valid=True, reason=None))
+
+
+def introspected_keys(item):
+  "the (token key, consumer key) of an item given to OAuthCore.introspect"
+  if isinstance(item, tuple):
+    return item
+  return item.oauth.get('oauth_token', None), item.oauth.get('oauth_consumer_key', None)
+
+def verifier_matches(given, expected):
+  """whether the oauth_verifier `given` is the request token's, compared in
+  constant time like signatures; a token without a verifier matches none"""
+  if not given or not expected:
+    return False
+  if isinstance(given, unicode):
+    given = given.encode('utf-8')
+  if isinstance(expected, unicode):
+    expected = expected.encode('utf-8')
+  return constant_time_compare(given, expected)
+
+def check_timestamp(timestamp, threshold=300, skew=60):
+  """rejects timestamps more than `threshold` seconds old or more than `skew`
+  seconds ahead of the clock"""
+  if timestamp is None:
+    raise Error("The oauth_timestamp parameter is missing.")
+  try:
+    timestamp = int(timestamp)
+  except ValueError:
+    raise Error('Invalid oauth_timestamp.')
+  now = int(time.time())
+  lapsed = now - timestamp
+  if lapsed > threshold:
+    raise Error('Expired timestamp: given %d and now %s has a greater difference than the threshold %d' % (
+      timestamp, now, threshold
+    ))
+  if -lapsed > skew:
+    raise Error('Timestamp from the future: given %d and now %s is more than %d seconds ahead' % (
+      timestamp, now, skew
+    ))
+
+
+def check_body_hash(parsed, required=False):
+  """checks the oauth_body_hash of a request whose signature has been checked, so
+  the hash itself is authentic. Form encoded bodies are signed as parameters and
+  must not carry one, other bodies must when `required`."""
+  expected = parsed.oauth.get('oauth_body_hash', None)
+  if expected is None:
+    if required and parsed.body_type == 'other':
+      raise PartialOAuthRequest('Missing oauth_body_hash, required with bodies that are not form encoded.')
+    return
+  if parsed.body_type == 'form':
+    raise Error('oauth_body_hash is not allowed on requests with a form encoded body.')
+  if parsed.body_hash is None or not constant_time_compare(parsed.body_hash, str(expected)):
+    raise Error('Invalid oauth_body_hash.')
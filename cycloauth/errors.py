@@ -29,5 +29,9 @@ class NOnceReplayed(Error):
   """Error signals that the n-once value has already been used within a certain threshold."""
 
 
+class NOnceStoreFull(Error):
+  """Error signals that the n-once store is full and configured to reject new values rather than evict."""
+
+
 class InvalidVerifier(Error):
   """Error signalling that the verifier provided is invalid, because it either does not match or was not provided."""
\ No newline at end of file
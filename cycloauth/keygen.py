@@ -0,0 +1,68 @@
+import os, binascii, base64
+
+
+__all__ = ['KeyPool', 'random_hex', 'random_urlsafe', 'generate_key', 'generate_secret',
+           'generate_verifier', 'KEY_LENGTH', 'SECRET_LENGTH', 'VERIFIER_LENGTH']
+
+
+KEY_LENGTH = 32
+SECRET_LENGTH = 128
+VERIFIER_LENGTH = 32
+
+
+def random_hex(n):
+  "`n` random lowercase hex characters from the operating system's CSPRNG"
+  return binascii.hexlify(os.urandom((n + 1) // 2))[:n]
+
+
+def random_urlsafe(n):
+  "`n` random base64url characters from the operating system's CSPRNG"
+  return base64.urlsafe_b64encode(os.urandom((n * 3 + 3) // 4))[:n]
+
+
+class KeyPool(object):
+  """Hands out slices of a buffer of random hex characters.
+
+  The buffer is filled with one `os.urandom` call and one hexlify, so a burst
+  of token requests costs a few large reads of the CSPRNG instead of one per
+  key. Characters are never handed out twice, an exhausted buffer is refilled.
+  The buffer belongs to the process that filled it: a forked child discards
+  what it inherited, so workers never hand out the same keys.
+  """
+
+  def __init__(self, size=64 * 1024):
+    self.size = size
+    self.buffer = ''
+    self.offset = 0
+    self.pid = None
+
+  def fill(self):
+    "replaces the buffer with fresh random characters"
+    self.buffer = binascii.hexlify(os.urandom(self.size // 2))
+    self.offset = 0
+    self.pid = os.getpid()
+
+  def get(self, n):
+    "returns `n` random hex characters"
+    if n > self.size:
+      return random_hex(n)
+    if self.offset + n > len(self.buffer) or self.pid != os.getpid():
+      self.fill()
+    ret = self.buffer[self.offset:self.offset + n]
+    self.offset += n
+    return ret
+
+
+pool = KeyPool()
+
+
+def generate_key():
+  return pool.get(KEY_LENGTH)
+
+
+def generate_secret():
+  return pool.get(SECRET_LENGTH)
+
+
+def generate_verifier():
+  return pool.get(VERIFIER_LENGTH)
@@ -0,0 +1,104 @@
+from bisect import bisect_left
+
+
+__all__ = ['Histogram', 'Metrics', 'STAGES', 'DEFAULT_BUCKETS']
+
+
+# the stages of verifying a request, as passed to Metrics.observe
+STAGES = ('parse', 'timestamp', 'nonce', 'consumer_fetch', 'token_fetch', 'consumer_and_token_fetch',
+          'signature', 'verify')
+
+# upper bounds in seconds, from 10us to 5s
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram(object):
+  "A fixed-bucket histogram, an observation is one bisect and two additions"
+  __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+  def __init__(self, bounds=DEFAULT_BUCKETS):
+    self.bounds = tuple(bounds)
+    # the last count is for observations above every bound
+    self.counts = [0] * (len(self.bounds) + 1)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect_left(self.bounds, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def cumulative(self):
+    "(upper bound, observations at or below it) pairs, ending with ('+Inf', count)"
+    ret = []
+    total = 0
+    for bound, n in zip(self.bounds + ('+Inf',), self.counts):
+      total += n
+      ret.append((bound, total))
+    return ret
+
+  def quantile(self, q):
+    "an estimate of the `q` quantile (0-1): the upper bound of the bucket it falls in"
+    if not self.count:
+      return None
+    rank = q * self.count
+    for bound, total in self.cumulative():
+      if total >= rank:
+        return bound
+
+
+class Metrics(object):
+  """Latency histograms of each stage of request verification and counts of
+  failed verifications by error.
+
+  The provider only records anything when `oauth_metrics` is set, otherwise
+  it holds no Metrics and each stage costs a single None check. Functions
+  added with `add_hook` are called with every (stage, seconds) observation,
+  to feed another metrics system.
+  """
+
+  def __init__(self, buckets=DEFAULT_BUCKETS):
+    self.buckets = buckets
+    self.histograms = dict((stage, Histogram(buckets)) for stage in STAGES)
+    self.failures = {}
+    self.hooks = []
+
+  def add_hook(self, hook):
+    self.hooks.append(hook)
+
+  def observe(self, stage, seconds):
+    histogram = self.histograms.get(stage)
+    if histogram is None:
+      histogram = self.histograms[stage] = Histogram(self.buckets)
+    histogram.observe(seconds)
+    for hook in self.hooks:
+      hook(stage, seconds)
+
+  def fail(self, reason):
+    self.failures[reason] = self.failures.get(reason, 0) + 1
+
+  def summary(self):
+    "count, mean and estimated p50/p99 in seconds of every stage observed so far"
+    ret = {}
+    for stage, h in self.histograms.iteritems():
+      if h.count:
+        ret[stage] = dict(count=h.count, mean=h.sum / h.count, p50=h.quantile(0.5), p99=h.quantile(0.99))
+    return ret
+
+  def prometheus_text(self, prefix='cycloauth'):
+    "the histograms and failure counts in the Prometheus text exposition format"
+    lines = [
+      '# HELP %s_stage_seconds Time spent in each stage of OAuth request verification.' % prefix,
+      '# TYPE %s_stage_seconds histogram' % prefix]
+    for stage in sorted(self.histograms):
+      h = self.histograms[stage]
+      for bound, total in h.cumulative():
+        lines.append('%s_stage_seconds_bucket{stage="%s",le="%s"} %d' % (prefix, stage, bound, total))
+      lines.append('%s_stage_seconds_sum{stage="%s"} %r' % (prefix, stage, h.sum))
+      lines.append('%s_stage_seconds_count{stage="%s"} %d' % (prefix, stage, h.count))
+    lines.append('# HELP %s_verify_failures_total OAuth requests that failed verification, by error.' % prefix)
+    lines.append('# TYPE %s_verify_failures_total counter' % prefix)
+    for reason in sorted(self.failures):
+      lines.append('%s_verify_failures_total{reason="%s"} %d' % (prefix, reason, self.failures[reason]))
+    return '\n'.join(lines) + '\n'
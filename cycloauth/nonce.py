@@ -0,0 +1,120 @@
+import os, mmap, fcntl, hashlib, struct, time
+from twisted.internet import defer
+from zope.interface import Interface, implements
+from cycloauth.utils import NOnceStore, nonce_window, nonce_expiry
+from cycloauth.errors import NOnceStoreFull
+
+
+class INOnceStore(Interface):
+  "A store of recently used nonce values, shared by everything that verifies requests"
+
+  def check_and_add(self, consumer_key, nonce, timestamp):
+    """atomically records the nonce for the consumer, returns a deferred firing True if
+    it was fresh or False if it had already been used within the timestamp window"""
+
+  def check_and_add_nowait(self, consumer_key, nonce, timestamp):
+    """optional, the same as check_and_add but returns True or False itself, for
+    stores which never have to wait"""
+
+
+class MemoryNOnceStore(object):
+  "implements an in-process nonce store, replay protection only holds within one process"
+  implements(INOnceStore)
+
+  def __init__(self, settings, storage=None):
+    self.nonces = NOnceStore(
+      max_size=settings.get('nonce_cache_size', 20000),
+      window=nonce_window(settings),
+      eviction=settings.get('oauth_nonce_eviction', 'oldest'))
+
+  def __len__(self):
+    return len(self.nonces)
+
+  def check_and_add(self, consumer_key, nonce, timestamp):
+    return defer.succeed(self.nonces.check_and_add(consumer_key, nonce, timestamp))
+
+  def check_and_add_nowait(self, consumer_key, nonce, timestamp):
+    return self.nonces.check_and_add(consumer_key, nonce, timestamp)
+
+
+class SharedMemoryNOnceStore(object):
+  """implements a nonce store in a memory-mapped file shared by every worker on the host
+
+  The file is an open-addressed hash table of fixed size slots, each holding the
+  expiry time and sha1 digest of a (consumer key, nonce) pair. A check-and-add is
+  a single probe sequence done while holding an exclusive lock on the file, so
+  it is atomic across processes. Slots are never emptied, expired slots are
+  reused in place, so a probe can always stop at the first empty slot.
+  """
+  implements(INOnceStore)
+
+  magic = 'CYCNONC1'
+  header = struct.Struct('!8sI')
+  slot = struct.Struct('!d20s')
+  probe_limit = 32
+
+  def __init__(self, settings, storage=None):
+    self.path = settings.get('oauth_nonce_shm_path', '/dev/shm/cycloauth-nonces')
+    self.window = nonce_window(settings)
+    self.eviction = settings.get('oauth_nonce_eviction', 'oldest')
+    self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+    fcntl.lockf(self.fd, fcntl.LOCK_EX)
+    try:
+      size = os.fstat(self.fd).st_size
+      if size < self.header.size:
+        # twice the entries to keep the probe sequences short
+        slots = settings.get('nonce_cache_size', 20000) * 2
+        size = self.header.size + slots * self.slot.size
+        os.ftruncate(self.fd, size)
+        os.write(self.fd, self.header.pack(self.magic, slots))
+      self.mm = mmap.mmap(self.fd, size)
+      magic, self.slots = self.header.unpack_from(self.mm, 0)
+      if magic != self.magic:
+        raise ValueError('%s is not a cycloauth nonce store' % self.path)
+    finally:
+      fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+  def check_and_add(self, consumer_key, nonce, timestamp):
+    try:
+      return defer.succeed(self._check_and_add(consumer_key, nonce, timestamp))
+    except Exception:
+      return defer.fail()
+
+  def check_and_add_nowait(self, consumer_key, nonce, timestamp):
+    return self._check_and_add(consumer_key, nonce, timestamp)
+
+  def _check_and_add(self, consumer_key, nonce, timestamp):
+    digest = hashlib.sha1('%s\0%s' % (consumer_key, nonce)).digest()
+    start = struct.unpack('!Q', digest[:8])[0] % self.slots
+    now = time.time()
+    mm, slot, base = self.mm, self.slot, self.header.size
+    fcntl.lockf(self.fd, fcntl.LOCK_EX)
+    try:
+      reuse = oldest = None
+      for i in xrange(self.probe_limit):
+        pos = base + ((start + i) % self.slots) * slot.size
+        expires, d = slot.unpack_from(mm, pos)
+        if expires == 0:
+          if reuse is None:
+            reuse = pos
+          break
+        if expires <= now:
+          if reuse is None:
+            reuse = pos
+          continue
+        if d == digest:
+          return False
+        if oldest is None or expires < oldest[0]:
+          oldest = (expires, pos)
+      if reuse is None:
+        if self.eviction == 'reject':
+          raise NOnceStoreFull('Too many recent nonce values, try again later.')
+        reuse = oldest[1]
+      slot.pack_into(mm, reuse, nonce_expiry(timestamp, self.window, now), digest)
+      return True
+    finally:
+      fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+  def close(self):
+    self.mm.close()
+    os.close(self.fd)
@@ -1,69 +1,184 @@
 import urlparse, time, functools
 import cyclone.web
+from cyclone.escape import json_encode, json_decode, utf8
+from cyclone.httputil import HTTPHeaders
 import oauth2
 from oauth2 import generate_verifier, Consumer, Error, MissingSignature
-from twisted.python import log
-from twisted.internet import defer
-from cycloauth.utils import (generate_string, get_normalized_parameters,
-                                    NOnceList, oauth_request)
+from twisted.python import log, failure
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
+from cycloauth.utils import import_object
 from cycloauth.errors import *
-from cycloauth.signatures import HMAC_SHA1, PLAINTEXT
+from cycloauth.signatures import HMAC_SHA1, HMAC_SHA256, PLAINTEXT, RSA_SHA1, rsa_available, constant_time_compare
+from cycloauth.signatures import SignatureProcessPool, signature_processes
+from cycloauth.request import OAuthRequestParameters, BodyHasher
 from cycloauth.token import Token
+from cycloauth.core import OAuthCore, check_timestamp, run as run_core
+from cycloauth.storage import run_deferred
+from cycloauth.metrics import Metrics
 
 
 def handlers(settings):
   if 'oauth_authorization_handler' in settings:
-    m = settings['oauth_authorization_handler']
-    authz_mod = __import__('.'.join(m.split('.')[:-1]), globals(), locals(), [], -1)
-    for part in m.split('.')[1:]:
-      authz_mod = getattr(mod, part)
+    authz_mod = import_object(settings['oauth_authorization_handler'])
   else:
     authz_mod =  AuthorizeHandler
   ret = [
     (settings.get('oauth_request_token_url', '/oauth/request_token'), RequestTokenHandler),
     (settings.get('oauth_authorize_url', '/oauth/authorize'), authz_mod),
     (settings.get('oauth_access_token_url', '/oauth/access_token'), AccessTokenHandler)]
+  if settings.get('oauth_metrics', False):
+    ret.append((settings.get('oauth_metrics_url', '/oauth/metrics'), MetricsHandler))
+  if settings.get('oauth_introspection', False):
+    if not settings.get('oauth_introspection_secret', None):
+      raise ValueError('oauth_introspection requires oauth_introspection_secret')
+    ret.append((settings.get('oauth_introspection_url', '/oauth/introspect'), IntrospectionHandler))
   return ret
 
+def run_maybe_deferred(gen):
+  """runs a cycloauth.core generator and returns its result when it completes
+  synchronously, as it does with in-memory and cached storages, or else a
+  deferred firing it"""
+  done = []
+  pending = []
+
+  def callback(value):
+    if pending:
+      pending[0].callback(value)
+    else:
+      done.append((value, None))
+
+  def errback(exc):
+    if pending:
+      pending[0].errback(failure.Failure(exc[1], exc[0], exc[2]))
+    else:
+      done.append((None, exc))
+
+  run_core(gen, callback, errback)
+  if done:
+    value, exc = done[0]
+    if exc is not None:
+      raise exc[0], exc[1], exc[2]
+    return value
+  pending.append(defer.Deferred())
+  return pending[0]
+
+
+def _synchronous(ret, name):
+  "raises unless a check run by run_maybe_deferred has already passed"
+  if isinstance(ret, defer.Deferred):
+    ret.addErrback(lambda f: None)
+    raise Error('%s needs a nonce store answering synchronously, use _deferred%s instead.' % (name, name))
+  return ret
+
+
 def oauth_authenticated(method):
   "same as cyclone.web.authenticated but doesn't redirect just raises 403"
   "and works with asynchronous authentication methods (that might require a db lookup or something)"
   "using this decorator means you do not have to use cyclone.web.asynchronous and return"
   "values will be entirely ignored"
-  @defer.inlineCallbacks
   @cyclone.web.asynchronous
   @functools.wraps(method)
   def wrapper(self, *args, **kwargs):
-    user = yield self.get_oauth_token()
-    if not user:
-      raise cyclone.web.HTTPError(403)
-    method(self, *args, **kwargs)
+    user = self._get_oauth_token()
+    if isinstance(user, defer.Deferred):
+      return user.addCallback(_call_authenticated, self, method, args, kwargs)
+    _call_authenticated(user, self, method, args, kwargs)
   return wrapper
 
 
+def _call_authenticated(user, handler, method, args, kwargs):
+  if not user:
+    raise cyclone.web.HTTPError(403)
+  method(handler, *args, **kwargs)
+
+
 class OAuthApplicationMixin(object):
   oauth_signature_methods = {
     'HMAC-SHA1': HMAC_SHA1,
+    'HMAC-SHA256': HMAC_SHA256,
     'PLAINTEXT': PLAINTEXT
   }
+  if rsa_available:
+    oauth_signature_methods['RSA-SHA1'] = RSA_SHA1
+
+  @property
+  def oauth_signature_method_instances(self):
+    "one shared instance of each signature method, so their key caches live across requests"
+    if getattr(self, '_signature_methods', None) is None:
+      self._signature_methods = dict((k, v()) for k, v in self.oauth_signature_methods.iteritems())
+    return self._signature_methods
   
   @property
   def oauth_nonce_list(self):
     if getattr(self, '_nonce_list', None) is None:
-      nonce_cache_size = self.settings.get('nonce_cache_size', 20000)
-      self._nonce_list = NOnceList(nonce_cache_size)
+      factory_name = self.settings.get('oauth_nonce_store_factory', 'cycloauth.nonce.MemoryNOnceStore')
+      self._nonce_list = import_object(factory_name)(self.settings, self.oauth_storage)
     return self._nonce_list
   
   @property
   def oauth_storage(self):
     if getattr(self, '_oauth_storage', None) is None:
       factory_name = self.settings.get('oauth_storage_factory', 'cycloauth.storage.BaseStorage')
-      fn = '.'.join(factory_name.split('.')[:-1])
-      mod = __import__(fn, globals(), locals(), [], -1)
-      for part in factory_name.split('.')[1:]:
-        mod = getattr(mod, part)
-      self._oauth_storage = mod(self.settings)
+      self._oauth_storage = import_object(factory_name)(self.settings)
+      self._oauth_storage_started = self._oauth_storage.start()
+      self._oauth_storage_started.addErrback(log.err)
+      reactor.addSystemEventTrigger('before', 'shutdown', self._oauth_storage.stop)
     return self._oauth_storage
+
+  @property
+  def oauth_core(self):
+    if getattr(self, '_oauth_core', None) is None:
+      offload = None
+      if self.settings.get('oauth_signature_threads', 0) or signature_processes(self.settings):
+        offload = self.oauth_offload
+      self._oauth_core = OAuthCore(self.settings, self.oauth_storage, self.oauth_nonce_list,
+                                   self.oauth_signature_method_instances, self.oauth_metrics, offload)
+    return self._oauth_core
+
+  @property
+  def oauth_signature_threadpool(self):
+    """the pool of at most `oauth_signature_threads` threads blocking signature methods
+    are checked in when it is set, for implementations that release the GIL"""
+    if getattr(self, '_signature_threadpool', None) is None:
+      self._signature_threadpool = ThreadPool(0, self.settings.get('oauth_signature_threads', 0),
+                                              'cycloauth-signatures')
+      self._signature_threadpool.start()
+      reactor.addSystemEventTrigger('before', 'shutdown', self._signature_threadpool.stop)
+    return self._signature_threadpool
+
+  @property
+  def oauth_signature_process_pool(self):
+    """the `oauth_signature_processes` worker processes blocking signature methods
+    (RSA-SHA1) are checked in, so the reactor keeps serving other requests"""
+    if getattr(self, '_signature_process_pool', None) is None:
+      self._signature_process_pool = SignatureProcessPool(signature_processes(self.settings),
+                                                          self.settings.get('oauth_signature_timeout', 30))
+      reactor.addSystemEventTrigger('before', 'shutdown', self._signature_process_pool.close)
+    return self._signature_process_pool
+
+  def oauth_offload(self, check):
+    "runs `check` in the signature thread or process pool, returns a deferred firing its result"
+    if self.settings.get('oauth_signature_threads', 0):
+      return threads.deferToThreadPool(reactor, self.oauth_signature_threadpool, check)
+    d = defer.Deferred()
+    self.oauth_signature_process_pool.submit(
+      check, lambda ok, result: reactor.callFromThread(d.callback if ok else d.errback, result))
+    return d
+
+  @property
+  def oauth_metrics(self):
+    "the per-stage latency histograms when `oauth_metrics` is set, None otherwise"
+    if getattr(self, '_oauth_metrics', None) is None and self.settings.get('oauth_metrics', False):
+      self._oauth_metrics = Metrics()
+    return getattr(self, '_oauth_metrics', None)
+
+  def start_oauth(self):
+    """creates and starts the oauth storage and nonce store up front rather than on the
+    first request, returns a deferred firing once the storage is ready"""
+    self.oauth_storage
+    self.oauth_nonce_list
+    return self.oauth_storage.start()
   
 
 class OAuthRequestHandlerMixin(object):
@@ -80,8 +195,14 @@ class OAuthRequestHandlerMixin(object):
     else:
       return cyclone.web.RequestHandler.get_error_html(self, status_code, **kwargs)
   
-  @defer.inlineCallbacks
   def get_oauth_token(self):
+    "returns a deferred firing the access token the request was signed with, or None"
+    return defer.maybeDeferred(self._get_oauth_token)
+
+  def _get_oauth_token(self):
+    """returns the access token the request was signed with, or None, without
+    creating any deferred when the storage and nonce store answer synchronously;
+    a deferred otherwise"""
     consumer_key = self.oauth_params.get('oauth_consumer_key', None)
     oauth_token_key = self.oauth_params.get('oauth_token', None)
     if len(self.oauth_params) == 0:
@@ -89,136 +210,111 @@ class OAuthRequestHandlerMixin(object):
     elif not (consumer_key or oauth_token_key):
       raise PartialOAuthRequest('A consumer or token was not provided in the request.')
     if getattr(self, 'oauth_consumer', None) and getattr(self, 'oauth_token', None):
-      defer.returnValue(self.oauth_token)
-    s = self.application.oauth_storage
+      return self.oauth_token
     try:
-      consumer = yield s.get_consumer(consumer_key)
-      token = yield s.get_access_token(oauth_token_key)
-      self._check_signature(consumer, token)
-      self.oauth_consumer = consumer
-      self.oauth_token = token
+      ret = run_maybe_deferred(self.oauth_core.verify(self.oauth_request_parameters))
     except:
       log.err()
-      self.oauth_token = self.oauth_consumer = None
-    defer.returnValue(self.oauth_token)
-    
-    def _got_oauth_info_from_storage(self, ret):
-      consumer, token = (ret[0], ret[1])
-      try:
-        self._check_signature(consumer, token)
-        self.oauth_consumer = consumer
-        self.oauth_token = token
-      except:
-        log.err()
-        self.oauth_consumer = None
-        self.oauth_token = None
-      return self.oauth_token
+      return self._verified(None)
+    if isinstance(ret, defer.Deferred):
+      return ret.addCallbacks(self._verified, self._not_verified)
+    return self._verified(ret)
+
+  def _verified(self, ret):
+    self.oauth_consumer, self.oauth_token = ret or (None, None)
+    return self.oauth_token
+
+  def _not_verified(self, f):
+    log.err(f)
+    return self._verified(None)
   
+  @property
+  def oauth_endpoint(self):
+    "the name storage calls made for this handler are attributed to"
+    return self.__class__.__name__
+
+  @property
+  def oauth_core(self):
+    """the application's OAuthCore, using storage bound to this handler's
+    endpoint when the storage supports `bind`, as TracingStorage does"""
+    if getattr(self, '_oauth_core', None) is None:
+      core = self.application.oauth_core
+      if hasattr(core.storage, 'bind'):
+        core = core.with_storage(core.storage.bind(self.oauth_endpoint))
+      self._oauth_core = core
+    return self._oauth_core
+
   def _check_signature(self, consumer, token):
-    try:
-      nonce = self.oauth_params['oauth_nonce']
-    except KeyError:
-      raise PartialOAuthRequest('Missing oauth_nonce.')
-    self._check_nonce(nonce)
-    try:
-      timestamp = self.oauth_params['oauth_timestamp']
-    except KeyError:
-      raise PartialOAuthRequest('Missing oauth_timestamp.')
-    self._check_timestamp(timestamp)
-    try:
-      signature_method = self.application.oauth_signature_methods[self.oauth_params['oauth_signature_method']]()
-    except KeyError:
-      raise UnknownSignature('Unknown oauth_signature_method.')
-    oauth_req = oauth_request(self.request)
-    try:
-      signature = self.oauth_params['oauth_signature']
-    except KeyError:
-      raise MissingSignature('The oauth_signature is missing')
-    valid = signature_method.check(oauth_req, consumer, token, signature)
-    if not valid:
-      key, base = signature_method.signing_base(oauth_req, consumer, token)
-      raise Error(('Invalid signature. Expected signature base string: ' + str(base)), 'sock')
-  
-  def _check_timestamp(self, timestamp, threshold=300):
-    if timestamp is None:
-      raise Error("The oauth_timestamp parameter is missing.")
-    timestamp = int(timestamp)
-    now = int(time.time())
-    lapsed = now - timestamp
-    if lapsed > threshold:
-      raise Error('Expired timestamp: given %d and now %s has a greater difference than the threshold %d' % (
-        timestamp, now, threshold
-      ))
-  
+    """raises unless the request is signed by `consumer` and `token` with a fresh
+    timestamp and nonce; with a nonce store that can't answer synchronously it
+    raises too, use _deferred_check_signature then"""
+    _synchronous(run_maybe_deferred(self._signature_check(consumer, token)), '_check_signature')
+
+  def _deferred_check_signature(self, consumer, token):
+    "returns a deferred firing once the checks of _check_signature pass, or failing with the error"
+    return run_deferred(self._signature_check(consumer, token))
+
+  def _signature_check(self, consumer, token):
+    return self.oauth_core.check_signature(self.oauth_request_parameters, consumer, token)
+
   def _check_nonce(self, nonce):
-    if nonce in self.application.oauth_nonce_list:
-      raise NOnceReplayed('The provided nonce value has been used recently.')
-    self.application.oauth_nonce_list.append(nonce)
-      
+    "raises if the nonce was used recently, like _check_signature it only works synchronously"
+    _synchronous(run_maybe_deferred(self._nonce_check(nonce)), '_check_nonce')
+
+  def _deferred_check_nonce(self, nonce):
+    "returns a deferred firing once the nonce is recorded, or failing with NOnceReplayed"
+    return run_deferred(self._nonce_check(nonce))
 
-  def _checks_positive_for_oauth(self, params_var):
-    return True in [p.find('oauth_') >= 0 for p in params_var]
+  def _nonce_check(self, nonce):
+    params = self.oauth_request_parameters.oauth
+    return self.oauth_core.check_nonce(params.get('oauth_consumer_key', None), nonce,
+                                       params.get('oauth_timestamp', None))
+
+  def _check_timestamp(self, timestamp, threshold=300, skew=60):
+    check_timestamp(timestamp, threshold, skew)
+
+  @property
+  def oauth_request_parameters(self):
+    "every parameter of the request, parsed once and shared by oauth_params and signature checks"
+    if getattr(self, '_oauth_request_parameters', None) is None:
+      metrics = self.application.oauth_metrics
+      if metrics is not None:
+        started = time.time()
+      self._oauth_request_parameters = OAuthRequestParameters.from_request(
+        self.request, getattr(self, '_oauth_body_hasher', None))
+      if metrics is not None:
+        metrics.observe('parse', time.time() - started)
+    return self._oauth_request_parameters
   
+  def oauth_body_received(self, chunk):
+    """hashes a chunk of the request body for oauth_body_hash, for servers handing
+    handlers the body as it arrives; the whole body is then never needed"""
+    if getattr(self, '_oauth_body_hasher', None) is None:
+      self._oauth_body_hasher = BodyHasher()
+    self._oauth_body_hasher.update(chunk)
+
   @property
   def oauth_header(self):
-    extracted = {}
-    try:
-      auth_header = self.request.headers['authorization']
-      if auth_header[:6] == 'OAuth ':
-        auth_header = auth_header.lstrip('OAuth ')
-        try:
-          extracted = oauth2.Request._split_header(auth_header)
-        except Exception, e:
-          log.err()
-          raise Error('Unable to parse OAuth parameters from the Authorization Header.')
-    except KeyError:
-      pass
-    return extracted
+    return dict(self.oauth_request_parameters.header)
   
   @property
   def oauth_arguments(self):
-    extracted = {}
-    if self._checks_positive_for_oauth(self.request.arguments):
-      extracted = dict((k, self.get_argument(k)) for k in self.request.arguments.iterkeys() if k.find('oauth_') >= 0)
-    return extracted
+    parsed = self.oauth_request_parameters
+    return dict((k, v) for k, v in parsed.params[len(parsed.header):] if k.startswith('oauth_'))
   
   @property
   def oauth_params(self):
-    if getattr(self, '_oauth_params', None) is None:
-      extracted = {}
-      extracted.update(self.oauth_header)
-      extracted.update(self.oauth_arguments)
-      self._oauth_params = dict((k, extracted[k]) for k in extracted.iterkeys())
-    return self._oauth_params
+    return self.oauth_request_parameters.oauth
   
   @property
   def nonoauth_argument(self):
-    oauth_param_keys = self.oauth_params.keys()
-    return dict([k, v] for k, v in self.params.iteritems() if k not in oauth_param_keys)
-
+    return self.oauth_request_parameters.arguments()
 
 class RequestTokenHandler(cyclone.web.RequestHandler, OAuthRequestHandlerMixin):
   @defer.inlineCallbacks
   @cyclone.web.asynchronous
   def get(self):
-    consumer = yield self.application.oauth_storage.get_consumer(self.oauth_params['oauth_consumer_key'])
-    self._check_signature(consumer, None)
-    token = yield self.application.oauth_storage.add_request_token()
-    callback = self.oauth_params.get('oauth_callback', None)
-    if callback:
-      if 'callback' == 'oob':
-        if hasattr(consumer, 'callback'):
-          token.set_callback(consumer.callback)
-        else:
-          raise PartialOAuthRequest("There is no callback set for out-of-band (oob) use")
-      else:
-        token.set_callback(callback)
-    else:
-      if hasattr(consumer, 'callback'):
-        token.set_callback(consumer.callback)
-      else:
-        raise PartialOAuthRequest("Missing oauth_callback. Required by OAuth 1.0a")
-    yield self.application.oauth_storage.save_request_token(token)
+    token = yield run_deferred(self.oauth_core.request_token(self.oauth_request_parameters))
     self.set_header('Content-Type', 'text/plain')
     self.write(token.to_string())
     self.finish()
@@ -228,9 +324,7 @@ class AuthorizeHandler(cyclone.web.RequestHandler, OAuthRequestHandlerMixin):
   @defer.inlineCallbacks
   @cyclone.web.asynchronous
   def get(self):
-    token = yield self.application.oauth_storage.get_request_token(self.oauth_params['oauth_token'])
-    token.set_verifier()
-    yield self.application.oauth_storage.save_request_token(token)
+    token = yield run_deferred(self.oauth_core.authorize(self.oauth_params['oauth_token']))
     cb = token.get_callback_url()
     self.redirect(cb)
 
@@ -239,18 +333,63 @@ class AccessTokenHandler(cyclone.web.RequestHandler, OAuthRequestHandlerMixin):
   @defer.inlineCallbacks
   @cyclone.web.asynchronous
   def get(self):
-    consumer = yield self.application.oauth_storage.get_consumer(self.oauth_params['oauth_consumer_key'])
-    request_token = yield self.application.oauth_storage.get_request_token(self.oauth_params['oauth_token'])
-    try:
-      verifier = self.oauth_params['oauth_verifier']
-    except KeyError:
-      raise InvalidVerifier('Missing oauth_verifier. Required by OAuth 1.0a')
-    self._check_signature(consumer, request_token)
-    if verifier != request_token.verifier:
-      raise InvalidVerifier('Invalid Verifier.')
-    access_token = yield self.application.oauth_storage.add_access_token()
-    yield self.application.oauth_storage.save_access_token(access_token)
+    access_token = yield run_deferred(self.oauth_core.access_token(self.oauth_request_parameters))
     self.set_header('Content-Type', 'text/plain')
     self.write(access_token.to_string())
     self.finish()
 
+
+class MetricsHandler(cyclone.web.RequestHandler):
+  "serves the application's oauth metrics in the Prometheus text format"
+  def get(self):
+    metrics = self.application.oauth_metrics
+    if metrics is None:
+      raise cyclone.web.HTTPError(404)
+    self.set_header('Content-Type', 'text/plain; version=0.0.4')
+    self.write(metrics.prometheus_text())
+
+
+class IntrospectionHandler(cyclone.web.RequestHandler, OAuthRequestHandlerMixin):
+  """verifies a batch of access tokens or signed requests for other services
+
+  POST a JSON object whose `items` are each {"token": ..., "consumer_key": ...}
+  or {"request": {"method", "scheme", "host", "path", "query", "headers", "body"}},
+  at most `oauth_introspection_max_items` of them. The response's `results`
+  hold, in order, each item's consumer_key, token, valid and reason. Callers
+  send `oauth_introspection_secret` as a Bearer Authorization, without one set
+  every call is refused. Bodies over `oauth_introspection_max_body` bytes are
+  refused before they are parsed.
+  """
+  @defer.inlineCallbacks
+  @cyclone.web.asynchronous
+  def post(self):
+    secret = self.settings.get('oauth_introspection_secret', None)
+    if not secret:
+      raise cyclone.web.HTTPError(403)
+    if not constant_time_compare(utf8(self.request.headers.get('Authorization', '')), 'Bearer ' + utf8(secret)):
+      raise cyclone.web.HTTPError(403)
+    if len(self.request.body) > self.settings.get('oauth_introspection_max_body', 1 << 20):
+      raise cyclone.web.HTTPError(413)
+    try:
+      items = [self.introspection_item(item) for item in json_decode(self.request.body)['items']]
+    except (ValueError, KeyError, TypeError, AttributeError, Error):
+      raise cyclone.web.HTTPError(400)
+    if len(items) > self.settings.get('oauth_introspection_max_items', 1000):
+      raise cyclone.web.HTTPError(413)
+    results = yield run_deferred(self.oauth_core.introspect(items))
+    self.set_header('Content-Type', 'application/json')
+    self.write(json_encode({'results': results}))
+    self.finish()
+
+  def introspection_item(self, item):
+    "an item of the request body as given to OAuthCore.introspect"
+    if 'request' not in item:
+      consumer_key = item.get('consumer_key', None)
+      return (utf8(item['token']), utf8(consumer_key) if consumer_key else None)
+    r = item['request']
+    headers = HTTPHeaders()
+    for k, v in r.get('headers', {}).iteritems():
+      headers[utf8(k)] = utf8(v)
+    return OAuthRequestParameters.from_parts(utf8(r.get('method', 'GET')), utf8(r.get('scheme', 'http')),
+                                             utf8(r['host']), utf8(r.get('path', '/')), utf8(r.get('query', '')),
+                                             headers, utf8(r.get('body', None)))
@@ -0,0 +1,161 @@
+import urllib, urlparse, hashlib, binascii
+import oauth2
+from cycloauth.errors import Error
+from cycloauth.signatures import signature_base_string
+
+
+__all__ = ['OAuthRequestParameters', 'BodyHasher', 'parse_authorization_header', 'escape']
+
+
+FORM_CONTENT_TYPE = 'application/x-www-form-urlencoded'
+
+# the body hash algorithm of each signature method, SHA-1 for any other
+BODY_HASHES = {'HMAC-SHA256': 'sha256'}
+
+
+def escape(s):
+  "percent-encodes a parameter as required by RFC 5849 section 3.6"
+  if isinstance(s, unicode):
+    s = s.encode('utf-8')
+  return urllib.quote(s, safe='~')
+
+
+def parse_authorization_header(header):
+  "returns the (name, value) pairs of an `OAuth ...` Authorization header, without the realm"
+  ret = []
+  for part in header[6:].split(','):
+    part = part.strip()
+    if not part:
+      continue
+    k, sep, v = part.partition('=')
+    if not sep or len(v) < 2 or v[0] != '"' or v[-1] != '"':
+      raise Error('Unable to parse OAuth parameters from the Authorization Header.')
+    k = urllib.unquote(k.strip())
+    if k != 'realm':
+      ret.append((k, urllib.unquote(v[1:-1])))
+  return ret
+
+
+class BodyHasher(object):
+  """Hashes a request body for the oauth_body_hash extension chunk by chunk as
+  it arrives, so large bodies never have to be held in memory to be checked.
+
+  The hash follows the signature method, SHA-256 for HMAC-SHA256 and SHA-1
+  otherwise. Until the method is known both are computed.
+  """
+  __slots__ = ('hashes', 'size')
+
+  def __init__(self, signature_method=None):
+    if signature_method is None:
+      self.hashes = {'sha1': hashlib.sha1(), 'sha256': hashlib.sha256()}
+    else:
+      algorithm = BODY_HASHES.get(signature_method, 'sha1')
+      self.hashes = {algorithm: hashlib.new(algorithm)}
+    self.size = 0
+
+  def update(self, chunk):
+    for h in self.hashes.itervalues():
+      h.update(chunk)
+    self.size += len(chunk)
+
+  def digest(self, signature_method):
+    "the base64 encoded digest to compare with oauth_body_hash, None if it wasn't computed"
+    h = self.hashes.get(BODY_HASHES.get(signature_method, 'sha1'))
+    if h is None:
+      return None
+    return binascii.b2a_base64(h.digest())[:-1]
+
+
+class OAuthRequestParameters(object):
+  """Every parameter of a request, read once from the Authorization header, the
+  query string and a form encoded body.
+
+  `params` keeps repeated parameters and their order so it can be normalized
+  as RFC 5849 requires, `oauth` holds the oauth_* protocol parameters (query
+  and body values take precedence over the header) and the normalized
+  parameter string and base string are only built when first asked for.
+
+  `body_type` is None without a body, 'form' for a form encoded one and
+  'other' for any other and `body_hash` is the digest of a body that isn't
+  form encoded, computed only when the request carries an oauth_body_hash or
+  when a BodyHasher fed while the body arrived is given.
+  """
+  __slots__ = ('method', 'base_url', 'header', 'params', 'oauth', 'body_type', 'body_hash', '_normalized')
+
+  def __init__(self, method, base_url, header_params, query_params, body_params, body_type=None, body_hash=None):
+    self.method = method
+    self.base_url = base_url
+    self.header = header_params
+    self.params = header_params + query_params + body_params
+    self.oauth = dict(header_params)
+    for k, v in query_params + body_params:
+      if k.startswith('oauth_'):
+        self.oauth[k] = v
+    self.body_type = body_type
+    self.body_hash = body_hash
+    self._normalized = None
+
+  @classmethod
+  def from_request(cls, request, body_hasher=None):
+    "reads the parameters of a cyclone HTTPRequest"
+    return cls.from_parts(request.method, request.protocol, request.host, request.path,
+                          request.query, request.headers, request.body, body_hasher)
+
+  @classmethod
+  def from_parts(cls, method, scheme, host, path, query, headers, body, body_hasher=None):
+    """reads the parameters of a request of any framework, `headers` only needs a get
+    method. Servers streaming the body pass the BodyHasher they fed instead of it."""
+    auth = headers.get('Authorization', '')
+    header_params = parse_authorization_header(auth) if auth[:6] == 'OAuth ' else []
+    query_params = urlparse.parse_qsl(query, keep_blank_values=True) if query else []
+    body_params = []
+    body_type = None
+    if body or (body_hasher is not None and body_hasher.size):
+      body_type = 'other'
+      if headers.get('Content-Type', '').split(';')[0].strip() == FORM_CONTENT_TYPE:
+        body_type = 'form'
+        body_params = urlparse.parse_qsl(body or '', keep_blank_values=True)
+    ret = cls(method, cls.normalize_url(scheme, host, path), header_params, query_params, body_params, body_type)
+    if body_type != 'form' and (body_hasher is not None or 'oauth_body_hash' in ret.oauth):
+      signature_method = ret.oauth.get('oauth_signature_method', None)
+      if body_hasher is None:
+        body_hasher = BodyHasher(signature_method)
+        # hashlib reads the body in place, no copy is made
+        body_hasher.update(body or '')
+      ret.body_hash = body_hasher.digest(signature_method)
+    return ret
+
+  @staticmethod
+  def normalize_url(scheme, host, path):
+    "the base string URI of RFC 5849 section 3.4.1.2"
+    scheme, host = scheme.lower(), host.lower()
+    if (scheme, host[-3:]) == ('http', ':80') or (scheme, host[-4:]) == ('https', ':443'):
+      host = host.rsplit(':', 1)[0]
+    return '%s://%s%s' % (scheme, host, path or '/')
+
+  @property
+  def normalized(self):
+    "the normalized request parameters of RFC 5849 section 3.4.1.3.2"
+    if self._normalized is None:
+      pairs = sorted((escape(k), escape(v)) for k, v in self.params if k != 'oauth_signature')
+      self._normalized = '&'.join('%s=%s' % p for p in pairs)
+    return self._normalized
+
+  def base_string(self):
+    return signature_base_string(self.method, self.base_url, self.normalized)
+
+  def oauth2_request(self):
+    "an oauth2.Request of these parameters, for signature methods written for python-oauth2"
+    params = {}
+    for k, v in self.params:
+      params.setdefault(k, []).append(v)
+    params = dict((k, v[0] if len(v) == 1 else v) for k, v in params.iteritems())
+    return oauth2.Request(self.method, self.base_url, params)
+
+  def arguments(self):
+    "the non-oauth parameters, as a dict of their first values"
+    ret = {}
+    for k, v in self.params:
+      if not k.startswith('oauth_') and k not in ret:
+        ret[k] = v
+    return ret
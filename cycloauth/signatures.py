@@ -1,7 +1,259 @@
-from oauth2 import escape, SignatureMethod_HMAC_SHA1, SignatureMethod_PLAINTEXT
-from cycloauth.utils import get_normalized_parameters
+import hmac, hashlib, binascii, functools, itertools, cPickle, multiprocessing, signal, threading, time
+from oauth2 import escape
+from cycloauth.utils import LRUCache, MISSING
+try:
+  from Crypto.PublicKey import RSA
+  from Crypto.Signature import PKCS1_v1_5
+  from Crypto.Hash import SHA
+except ImportError:
+  RSA = None
 
 
-HMAC_SHA1 = SignatureMethod_HMAC_SHA1
+__all__ = ['constant_time_compare', 'signature_base_string', 'SignatureMethod',
+           'HMACSignatureMethod', 'HMAC_SHA1', 'HMAC_SHA256', 'PLAINTEXT', 'RSA_SHA1', 'rsa_available',
+           'check_rsa_sha1', 'SignatureProcessPool', 'signature_processes']
 
-PLAINTEXT = SignatureMethod_PLAINTEXT
+
+# RSA-SHA1 needs PyCrypto
+rsa_available = RSA is not None
+
+
+try:
+  from hmac import compare_digest as constant_time_compare
+except ImportError:
+  def constant_time_compare(a, b):
+    "compares two strings in time independent of where they differ"
+    if len(a) != len(b):
+      return False
+    result = 0
+    for x, y in zip(a, b):
+      result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+def signature_base_string(method, url, normalized_parameters):
+  "the signature base string, built once per request and shared by verification and error reporting"
+  return '&'.join((escape(method.upper()), escape(url), escape(normalized_parameters)))
+
+
+class SignatureMethod(object):
+  """A signature method verifying already computed signature base strings.
+
+  Instances are shared by every request, so they must not keep per-request state.
+  Methods whose checks are expensive set `blocking`, the provider then runs
+  the callable returned by `checker` in a worker process when it can be
+  pickled, as a functools.partial of a module level function can.
+  """
+  name = None
+  blocking = False
+
+  def signing_key(self, consumer_secret, token_secret):
+    return '%s&%s' % (escape(consumer_secret), escape(token_secret or ''))
+
+  def sign(self, base, consumer_secret, token_secret):
+    raise NotImplementedError
+
+  def check(self, base, consumer_secret, token_secret, signature):
+    return constant_time_compare(self.sign(base, consumer_secret, token_secret), str(signature))
+
+  def checker(self, base, consumer, token, signature):
+    """returns a callable taking no arguments which checks the signature. Anything
+    touching shared state is done here, so the callable may run in another thread."""
+    return lambda: self.check(base, consumer.secret, token.secret if token else None, signature)
+
+
+class HMACSignatureMethod(SignatureMethod):
+  """Keeps a prepared HMAC object per (consumer secret, token secret) pair so that
+  escaping the secrets and the HMAC key schedule happen once, not once per request.
+  """
+  digestmod = None
+
+  def __init__(self, key_cache_size=10000, key_cache_ttl=3600):
+    self.keys = LRUCache(key_cache_size, key_cache_ttl)
+
+  def sign(self, base, consumer_secret, token_secret):
+    k = (consumer_secret, token_secret)
+    mac = self.keys.get(k)
+    if mac is MISSING:
+      mac = hmac.new(self.signing_key(consumer_secret, token_secret), digestmod=self.digestmod)
+      self.keys.set(k, mac)
+    mac = mac.copy()
+    mac.update(base)
+    return binascii.b2a_base64(mac.digest())[:-1]
+
+
+class HMAC_SHA1(HMACSignatureMethod):
+  name = 'HMAC-SHA1'
+  digestmod = hashlib.sha1
+
+
+class HMAC_SHA256(HMACSignatureMethod):
+  name = 'HMAC-SHA256'
+  digestmod = hashlib.sha256
+
+
+class PLAINTEXT(SignatureMethod):
+  name = 'PLAINTEXT'
+
+  def sign(self, base, consumer_secret, token_secret):
+    return self.signing_key(consumer_secret, token_secret)
+
+
+# the verifiers of the RSA public keys this process has parsed, by key
+rsa_public_keys = LRUCache(1000, 3600)
+
+
+def rsa_public_key(pem):
+  "a verifier of the public key `pem`, in PEM or DER, or None if it can't be parsed"
+  verifier = rsa_public_keys.get(pem)
+  if verifier is MISSING:
+    try:
+      verifier = PKCS1_v1_5.new(RSA.importKey(pem))
+    except (ValueError, IndexError, TypeError):
+      verifier = None
+    rsa_public_keys.set(pem, verifier)
+  return verifier
+
+
+def check_rsa_sha1(pem, base, signature):
+  """whether the decoded `signature` of `base` was made with the private key of the
+  public key `pem`. It takes nothing but strings, so it can be sent to a worker
+  process, which parses each key once and keeps it in its own cache."""
+  verifier = rsa_public_key(pem)
+  if verifier is None:
+    return False
+  try:
+    return bool(verifier.verify(SHA.new(base), signature))
+  except ValueError:
+    # a signature that is no number below the key's modulus
+    return False
+
+
+class RSA_SHA1(SignatureMethod):
+  """Checks signatures made with a consumer's RSA private key against the public
+  key registered as the consumer's `rsa_key`, in PEM or DER.
+
+  Parsed keys are cached by each process checking signatures, so a key is only
+  parsed again once it changes or drops out of the cache.
+  """
+  name = 'RSA-SHA1'
+  blocking = True
+
+  def __init__(self):
+    if RSA is None:
+      raise ImportError('RSA-SHA1 signatures require PyCrypto')
+
+  def public_key(self, consumer):
+    "a verifier of the consumer's public key, or None if it has none or it can't be parsed"
+    pem = getattr(consumer, 'rsa_key', None)
+    return rsa_public_key(pem) if pem else None
+
+  def sign(self, base, consumer_secret, token_secret):
+    raise NotImplementedError('RSA-SHA1 signatures are made with the private key only the consumer has')
+
+  def check(self, base, consumer_secret, token_secret, signature):
+    # the consumer's public key is needed, see checker
+    return False
+
+  def checker(self, base, consumer, token, signature):
+    pem = getattr(consumer, 'rsa_key', None)
+    if not pem:
+      return lambda: False
+    try:
+      decoded = binascii.a2b_base64(signature)
+    except binascii.Error:
+      return lambda: False
+    return functools.partial(check_rsa_sha1, pem, base, decoded)
+
+
+def signature_processes(settings):
+  """the number of worker processes blocking signature methods are checked in, 0, the
+  default, checks them inline (or in `oauth_signature_threads` threads if set)"""
+  return settings.get('oauth_signature_processes', 0)
+
+
+def _init_worker():
+  # forked from a process whose event loop may handle these, as twisted's reactor does
+  signal.signal(signal.SIGTERM, signal.SIG_DFL)
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+
+def _run_pickled(payload):
+  "runs a pickled check in a worker process, returns (True, its result) or (False, the error)"
+  try:
+    return True, cPickle.loads(payload)()
+  except Exception, e:
+    return False, '%s: %s' % (e.__class__.__name__, e)
+
+
+class SignatureProcessPool(object):
+  """Checks signatures in `processes` worker processes, forked on first use, so
+  checks holding the GIL, as PyCrypto's RSA verification does, don't hold up the
+  event loop. Checks are pickled to be sent over; those that can't be, such as
+  closures, are run in the calling thread instead.
+
+  A check not answered within `timeout` seconds, as happens when its worker
+  dies, fails with a RuntimeError, as do the checks in flight when the pool is
+  closed, so no caller waits forever.
+  """
+
+  def __init__(self, processes, timeout=30):
+    self.processes = processes
+    self.timeout = timeout
+    self.pool = None
+    self.pending = {}
+    self.lock = threading.Lock()
+    self.ids = itertools.count()
+    self.closed = None
+
+  def submit(self, check, callback):
+    """runs `check` and calls `callback(ok, result)` with its result, or the
+    exception it raised, from the pool's result thread or the calling one"""
+    try:
+      payload = cPickle.dumps(check, cPickle.HIGHEST_PROTOCOL)
+    except (cPickle.PicklingError, TypeError, AttributeError):
+      try:
+        result = check()
+      except Exception, e:
+        return callback(False, e)
+      return callback(True, result)
+    if self.pool is None:
+      self.pool = multiprocessing.Pool(self.processes, _init_worker)
+      self.closed = threading.Event()
+      watcher = threading.Thread(target=self._watch, args=(self.closed,), name='cycloauth-signature-watcher')
+      watcher.daemon = True
+      watcher.start()
+    i = next(self.ids)
+    with self.lock:
+      self.pending[i] = (time.time() + self.timeout, callback)
+    self.pool.apply_async(_run_pickled, (payload,),
+                          callback=lambda (ok, result): self._finish(i, ok, result if ok else RuntimeError(result)))
+
+  def _finish(self, i, ok, result):
+    "calls back the check `i` unless it was already, having timed out or been abandoned"
+    with self.lock:
+      entry = self.pending.pop(i, None)
+    if entry is not None:
+      entry[1](ok, result)
+
+  def _watch(self, closed):
+    # fails the checks whose worker didn't answer in time; apply_async has no
+    # error callback before python 3.2 and never answers for a worker that died
+    while not closed.wait(min(1.0, self.timeout)):
+      now = time.time()
+      with self.lock:
+        expired = [i for i, (deadline, callback) in self.pending.iteritems() if deadline <= now]
+      for i in expired:
+        self._finish(i, False, RuntimeError('signature check timed out after %ss' % self.timeout))
+
+  def close(self):
+    "stops the worker processes, failing the checks in progress"
+    pool, self.pool = self.pool, None
+    if pool is not None:
+      self.closed.set()
+      pool.terminate()
+    with self.lock:
+      pending, self.pending = self.pending, {}
+    for deadline, callback in pending.itervalues():
+      callback(False, RuntimeError('signature process pool closed'))
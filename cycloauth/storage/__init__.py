@@ -1,14 +1,24 @@
-from collections import namedtuple
-from twisted.internet import defer
+import time
+from collections import namedtuple, OrderedDict
+from twisted.internet import defer, task
+from twisted.python import failure
 from zope.interface import Interface, Attribute, implements
-from cycloauth.utils import generate_string
+from cycloauth.keygen import generate_key, generate_secret
 from cycloauth.token import Token as OAuthToken
 from cycloauth.consumer import Consumer as OAuthConsumer
+from cycloauth.utils import MISSING
+from cycloauth import core
 
 
 class IStorage(Interface):
   "A storage mechanism for consumerse, request tokens and access tokens"
 
+  def start(self):
+    "connects the store and readies it for requests, returns a deferred"
+
+  def stop(self):
+    "releases any connections held by the store, returns a deferred"
+
   def add_consumer(self, key=None, secret=None, **kwargs):
     "creates a consumer in the store"
   
@@ -31,7 +41,22 @@ class IStorage(Interface):
     "removes a request token from the store"
   
   def get_request_token(self, key):
-    "retrieves a request token from the store"
+    "retrieves a request token from the store, unless it is older than oauth_request_token_ttl"
+
+  def consume_request_token(self, key):
+    "atomically removes and returns a live request token, or None if it has already been consumed or expired"
+
+  def authorize_request_token(self, key, verifier=None):
+    """atomically gives a live request token that has not been authorized yet its
+    verifier (a new one unless given), returns the token or None. A request token
+    is issued, authorized once, then exchanged once for an access token."""
+
+  def exchange_request_token(self, key, verifier):
+    """atomically removes and returns a live request token authorized with
+    `verifier`, or None, so a request token can only be exchanged once"""
+
+  def request_token_stats(self):
+    "returns a deferred firing a dict with the number of live, expired and reaped request tokens"
 
   def add_access_token(self, key=None, secret=None, **kwargs):
     "adds an access token to the store"
@@ -44,6 +69,45 @@ class IStorage(Interface):
   
   def get_access_token(self, key):
     "retrieves an access token from the store"
+
+  def add_consumers(self, n, **kwargs):
+    "creates `n` consumers with generated keys and secrets, returns a deferred firing a list of them"
+
+  def save_consumers(self, consumers):
+    "saves many consumers to the store at once"
+
+  def remove_consumers(self, keys):
+    "removes many consumers from the store at once"
+
+  def add_access_tokens(self, n, **kwargs):
+    "creates `n` access tokens with generated keys and secrets, returns a deferred firing a list of them"
+
+  def save_access_tokens(self, tokens):
+    "saves many access tokens to the store at once"
+
+  def remove_access_tokens(self, keys):
+    "removes many access tokens from the store at once"
+
+  def get_consumer_and_token(self, consumer_key, token_key, token_type='access'):
+    """optional, retrieves a consumer and a `token_type` ('access' or 'request') token
+    in one go, returns a deferred firing a (consumer, token) tuple"""
+
+  def get_consumer_and_token_nowait(self, consumer_key, token_key, token_type='access'):
+    """optional, returns the (consumer, token) tuple itself when the store can answer
+    without waiting on anything, otherwise cycloauth.utils.MISSING"""
+
+  def get_consumers(self, keys):
+    """optional, retrieves many consumers in one lookup, returns a deferred firing
+    a dict of each key to its consumer or None"""
+
+  def get_access_tokens(self, keys):
+    """optional, retrieves many access tokens in one lookup, returns a deferred
+    firing a dict of each key to its token or None"""
+
+  def access_token_consumer_key(self, key):
+    """optional, returns the key of the consumer the access token `key` was
+    issued to, or None, itself or as a deferred for stores that have to look it up;
+    only asked for tokens with no consumer_key attribute of their own"""
   
   request_token_factory = Attribute("")
   access_token_factory = Attribute("")
@@ -62,6 +126,7 @@ class IConsumer(Interface):
   callback = Attribute("")
   key = Attribute("")
   secret = Attribute("")
+  rsa_key = Attribute("the public key of a consumer signing with RSA-SHA1, or None")
 
 
 class BaseConsumer(OAuthConsumer):
@@ -76,14 +141,50 @@ class BaseToken(OAuthToken):
 def key_secret_generator(storage, func, key, secret):
   if key is None:
     while True:
-      key = generate_string()
+      key = generate_key()
       if not (yield getattr(storage, func)(key)):
         break
   if secret is None:
-    secret = generate_string(128)
+    secret = generate_secret()
   defer.returnValue(dict(key=key, secret=secret))
 
 
+def generate_keys(existing, n):
+  "generates `n` distinct keys that are not in `existing`, checking locally instead of with a lookup per key"
+  keys = set()
+  while len(keys) < n:
+    key = generate_key()
+    if key not in existing:
+      keys.add(key)
+  return keys
+
+
+def fetch_all(deferreds):
+  "returns a deferred firing a list of the results of `deferreds`, or the first failure"
+  d = defer.DeferredList(deferreds, fireOnOneErrback=True, consumeErrors=True)
+  d.addCallbacks(lambda results: [r for ok, r in results],
+                 lambda f: f.value.subFailure)
+  return d
+
+
+def run_deferred(gen):
+  "runs a cycloauth.core generator, returns a deferred firing its result"
+  d = defer.Deferred()
+  core.run(gen, d.callback, lambda exc: d.errback(failure.Failure(exc[1], exc[0], exc[2])))
+  return d
+
+
+def get_consumer_and_token(storage, consumer_key, token_key, token_type='access'):
+  "cycloauth.core.get_consumer_and_token for wrapping storages, returns a deferred firing a (consumer, token) tuple"
+  return run_deferred(core.get_consumer_and_token(storage, consumer_key, token_key, token_type))
+
+
+def get_many(storage, kind, keys):
+  """cycloauth.core.fetch_many for wrapping storages, returns a deferred firing
+  a dict of key to 'consumer' or 'access_token' entity"""
+  return run_deferred(core.fetch_many(storage, kind, keys))
+
+
 class BaseStorage(object):
   "implements an in-memory Storage as a singleton"
   implements(IStorage)
@@ -94,8 +195,66 @@ class BaseStorage(object):
   
   def __init__(self, settings):
     self.consumers = {}
-    self.request_tokens = {}
+    # kept in creation order so the reaper only has to look at the oldest
+    self.request_tokens = OrderedDict()
     self.access_tokens = {}
+    self.request_token_ttl = settings.get('oauth_request_token_ttl', 3600)
+    self.reap_interval = settings.get('oauth_request_token_reap_interval', 60)
+    self.reaped_request_tokens = 0
+    self.reaper = None
+
+  def start(self):
+    if self.request_token_ttl and self.reap_interval and self.reaper is None:
+      self.reaper = task.LoopingCall(self.reap_request_tokens)
+      self.reaper.start(self.reap_interval, now=False)
+    return defer.succeed(None)
+
+  def stop(self):
+    if self.reaper is not None and self.reaper.running:
+      self.reaper.stop()
+    self.reaper = None
+    return defer.succeed(None)
+
+  def _request_token_expired(self, token, now):
+    created = getattr(token, 'created', None)
+    return bool(self.request_token_ttl and created and created + self.request_token_ttl <= now)
+
+  def _live_request_token(self, key):
+    token = self.request_tokens.get(key, None)
+    if token is not None and self._request_token_expired(token, time.time()):
+      del self.request_tokens[key]
+      self.reaped_request_tokens += 1
+      token = None
+    return token
+
+  def reap_request_tokens(self):
+    "removes expired request tokens, returns how many were removed"
+    now = time.time()
+    reaped = 0
+    while self.request_tokens:
+      key, token = next(self.request_tokens.iteritems())
+      if getattr(token, 'created', None) is None:
+        # its age is unknown, it expires a ttl from now like a new token
+        token.created = now
+        del self.request_tokens[key]
+        self.request_tokens[key] = token
+        continue
+      if not self._request_token_expired(token, now):
+        break
+      del self.request_tokens[key]
+      reaped += 1
+    self.reaped_request_tokens += reaped
+    return reaped
+
+  def request_token_stats(self):
+    now = time.time()
+    expired = 0
+    for token in self.request_tokens.itervalues():
+      if not self._request_token_expired(token, now):
+        break
+      expired += 1
+    return defer.succeed({'live': len(self.request_tokens) - expired, 'expired': expired,
+                          'reaped': self.reaped_request_tokens})
   
   @defer.inlineCallbacks
   def add_consumer(self, key=None, secret=None, **kwargs):
@@ -111,6 +270,9 @@ class BaseStorage(object):
     ret = self.consumers.get(key, None)
     return defer.succeed(ret)
   
+  def get_consumers(self, keys):
+    return defer.succeed(dict((key, self.consumers.get(key, None)) for key in keys))
+  
   def remove_consumer(self, key):
     if key in self.consumers:
       del self.consumers[key]
@@ -123,13 +285,34 @@ class BaseStorage(object):
     defer.returnValue(ret)
   
   def save_request_token(self, token):
+    if getattr(token, 'created', None) is None:
+      token.created = time.time()
     self.request_tokens[token.key] = token
     return defer.succeed(token)
   
   def get_request_token(self, key):
-    ret = self.request_tokens.get(key, None)
-    return defer.succeed(ret)
+    return defer.succeed(self._live_request_token(key))
+
+  def consume_request_token(self, key):
+    token = self._live_request_token(key)
+    if token is not None:
+      del self.request_tokens[key]
+    return defer.succeed(token)
   
+  def authorize_request_token(self, key, verifier=None):
+    token = self._live_request_token(key)
+    if token is None or getattr(token, 'verifier', None):
+      return defer.succeed(None)
+    token.set_verifier(verifier)
+    return defer.succeed(token)
+
+  def exchange_request_token(self, key, verifier):
+    token = self._live_request_token(key)
+    if token is None or not core.verifier_matches(verifier, getattr(token, 'verifier', None)):
+      return defer.succeed(None)
+    del self.request_tokens[key]
+    return defer.succeed(token)
+
   def remove_request_token(self, key):
     if key in self.request_tokens:
       del self.request_tokens[key]
@@ -149,7 +332,51 @@ class BaseStorage(object):
     ret = self.access_tokens.get(key, None)
     return defer.succeed(ret)
   
+  def get_access_tokens(self, keys):
+    return defer.succeed(dict((key, self.access_tokens.get(key, None)) for key in keys))
+
+  def access_token_consumer_key(self, key):
+    return getattr(self.access_tokens.get(key, None), 'consumer_key', None)
+  
   def remove_access_token(self, key):
     if key in self.access_tokens:
       del self.access_tokens[key]
     return defer.succeed(True)
+
+  def add_consumers(self, n, **kwargs):
+    return self.save_consumers([self.consumer_factory(key=k, secret=generate_secret(), **kwargs)
+                                for k in generate_keys(self.consumers, n)])
+
+  def save_consumers(self, consumers):
+    for consumer in consumers:
+      self.consumers[consumer.key] = consumer
+    return defer.succeed(list(consumers))
+
+  def remove_consumers(self, keys):
+    for key in keys:
+      self.consumers.pop(key, None)
+    return defer.succeed(True)
+
+  def add_access_tokens(self, n, **kwargs):
+    return self.save_access_tokens([self.access_token_factory(key=k, secret=generate_secret(), **kwargs)
+                                    for k in generate_keys(self.access_tokens, n)])
+
+  def save_access_tokens(self, tokens):
+    for token in tokens:
+      self.access_tokens[token.key] = token
+    return defer.succeed(list(tokens))
+
+  def remove_access_tokens(self, keys):
+    for key in keys:
+      self.access_tokens.pop(key, None)
+    return defer.succeed(True)
+
+  def get_consumer_and_token(self, consumer_key, token_key, token_type='access'):
+    return defer.succeed(self.get_consumer_and_token_nowait(consumer_key, token_key, token_type))
+
+  def get_consumer_and_token_nowait(self, consumer_key, token_key, token_type='access'):
+    if token_type == 'access':
+      token = self.access_tokens.get(token_key, None)
+    else:
+      token = self._live_request_token(token_key)
+    return (self.consumers.get(consumer_key, None), token)
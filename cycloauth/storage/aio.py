@@ -0,0 +1,92 @@
+try:
+  import asyncio
+except ImportError:
+  import trollius as asyncio
+from zope.interface import implements
+from cycloauth.storage import IStorage, BaseStorage
+
+
+# the IStorage methods answered with asyncio futures
+FUTURE_METHODS = frozenset([
+  'add_consumer', 'save_consumer', 'get_consumer', 'remove_consumer',
+  'add_request_token', 'save_request_token', 'get_request_token', 'consume_request_token',
+  'authorize_request_token', 'exchange_request_token', 'remove_request_token', 'request_token_stats',
+  'add_access_token', 'save_access_token', 'get_access_token', 'remove_access_token',
+  'add_consumers', 'save_consumers', 'remove_consumers',
+  'add_access_tokens', 'save_access_tokens', 'remove_access_tokens',
+  'get_consumer_and_token', 'get_consumers', 'get_access_tokens'])
+
+
+def to_future(d, loop=None):
+  "an asyncio future of the result of the twisted Deferred `d`"
+  future = asyncio.Future(loop=loop)
+  d.addCallbacks(future.set_result, lambda f: future.set_exception(f.value))
+  return future
+
+
+class AsyncioStorage(object):
+  """implements the in-memory storage for asyncio servers
+
+  Every operation of BaseStorage, which this wraps, returns an asyncio future
+  instead of a twisted Deferred, so handlers can `await` (or `yield From`)
+  them, and expired request tokens are reaped with the loop's call_later
+  rather than twisted's reactor, which asyncio servers don't run. The
+  futures of the in-memory storage are done when returned, so
+  AsyncioOAuthProvider consumes them without giving up control.
+
+  Select it with `oauth_storage_factory = 'cycloauth.storage.aio.AsyncioStorage'`,
+  the loop is `loop` in the settings or the current event loop.
+  """
+  implements(IStorage)
+
+  def __init__(self, settings):
+    # reaping is scheduled here, not by the wrapped storage
+    self.storage = BaseStorage(dict(settings, oauth_request_token_reap_interval=0))
+    self.loop = settings.get('loop', None)
+    self.reap_interval = settings.get('oauth_request_token_reap_interval', 60)
+    self.reaper = None
+
+  @property
+  def request_token_factory(self):
+    return self.storage.request_token_factory
+
+  @property
+  def access_token_factory(self):
+    return self.storage.access_token_factory
+
+  @property
+  def consumer_factory(self):
+    return self.storage.consumer_factory
+
+  def __getattr__(self, name):
+    if name not in FUTURE_METHODS:
+      raise AttributeError(name)
+    method = getattr(self.storage, name)
+    return lambda *args, **kwargs: self._future(method(*args, **kwargs))
+
+  def _future(self, d):
+    return to_future(d, self.loop)
+
+  def _loop(self):
+    return self.loop or asyncio.get_event_loop()
+
+  def start(self):
+    if self.storage.request_token_ttl and self.reap_interval and self.reaper is None:
+      self.reaper = self._loop().call_later(self.reap_interval, self._reap)
+    return self._future(self.storage.start())
+
+  def stop(self):
+    if self.reaper is not None:
+      self.reaper.cancel()
+      self.reaper = None
+    return self._future(self.storage.stop())
+
+  def _reap(self):
+    self.reaper = self._loop().call_later(self.reap_interval, self._reap)
+    self.storage.reap_request_tokens()
+
+  def access_token_consumer_key(self, key):
+    return self.storage.access_token_consumer_key(key)
+
+  def get_consumer_and_token_nowait(self, consumer_key, token_key, token_type='access'):
+    return self.storage.get_consumer_and_token_nowait(consumer_key, token_key, token_type)
@@ -0,0 +1,283 @@
+from twisted.internet import defer
+from twisted.python import failure
+from zope.interface import implements
+from cycloauth.storage import IStorage, fetch_all, get_consumer_and_token, get_many
+from cycloauth.utils import LRUCache, MISSING, import_object
+
+
+class CachingStorage(object):
+  """implements a read-through cache in front of any other storage
+
+  Consumers and tokens are kept in a bounded LRU with a ttl per kind of entity,
+  unknown keys are cached for `oauth_cache_negative_ttl` seconds and any
+  save_* or remove_* made through this storage invalidates the cached entry.
+  A ttl of 0 disables caching for that kind of entity.
+
+  Select it with `oauth_storage_factory = 'cycloauth.storage.cache.CachingStorage'`
+  and name the storage it wraps in `oauth_cached_storage_factory`.
+  """
+  implements(IStorage)
+
+  default_storage_factory = 'cycloauth.storage.BaseStorage'
+  default_ttl = 300
+
+  def __init__(self, settings):
+    factory_name = settings.get('oauth_cached_storage_factory', self.default_storage_factory)
+    self.storage = import_object(factory_name)(settings)
+    self.cache = LRUCache(settings.get('oauth_cache_size', 10000))
+    self.ttls = {
+      'consumer': settings.get('oauth_cache_consumer_ttl', self.default_ttl),
+      'access_token': settings.get('oauth_cache_access_token_ttl', self.default_ttl),
+      'request_token': settings.get('oauth_cache_request_token_ttl', 0)
+    }
+    self.negative_ttl = settings.get('oauth_cache_negative_ttl', 30)
+    self.hits = dict.fromkeys(self.ttls, 0)
+    self.misses = dict.fromkeys(self.ttls, 0)
+    # lookups in flight by (kind, key) and, for those keys, the epoch they were
+    # last invalidated at, so a lookup overlapping a write to its key isn't cached
+    self.in_flight = {}
+    self.invalidated = {}
+    self.epoch = 0
+    # the epoch the whole cache was last dropped at
+    self.flushed = 0
+
+  @property
+  def request_token_factory(self):
+    return self.storage.request_token_factory
+
+  @property
+  def access_token_factory(self):
+    return self.storage.access_token_factory
+
+  @property
+  def consumer_factory(self):
+    return self.storage.consumer_factory
+
+  def start(self):
+    return self.storage.start()
+
+  def stop(self):
+    return self.storage.stop()
+
+  def cache_stats(self):
+    "returns the hit and miss counters for each kind of entity"
+    return dict((kind, {'hits': self.hits[kind], 'misses': self.misses[kind]}) for kind in self.ttls)
+
+  def _get(self, kind, key, fetch):
+    ttl = self.ttls[kind]
+    if not ttl:
+      return fetch(key)
+    ret = self.cache.get((kind, key))
+    if ret is not MISSING:
+      self.hits[kind] += 1
+      return defer.succeed(ret)
+    self.misses[kind] += 1
+    epoch = self._lookup(kind, key)
+    return fetch(key).addBoth(self._fetched, kind, key, epoch)
+
+  def _lookup(self, kind, key):
+    "records a lookup of `key` going to the wrapped storage, returns the epoch it started at"
+    k = (kind, key)
+    self.in_flight[k] = self.in_flight.get(k, 0) + 1
+    return self.epoch
+
+  def _fetched(self, ret, kind, key, epoch):
+    "caches the result of a lookup started at `epoch` unless its key changed meanwhile"
+    k = (kind, key)
+    stale = self.flushed > epoch or self.invalidated.get(k, 0) > epoch
+    n = self.in_flight.pop(k) - 1
+    if n:
+      self.in_flight[k] = n
+    else:
+      self.invalidated.pop(k, None)
+    if self.ttls[kind] and not stale and not isinstance(ret, failure.Failure):
+      self.cache.set(k, ret, self.ttls[kind] if ret is not None else self.negative_ttl)
+    return ret
+
+  def _get_many(self, kind, keys):
+    """answers what it can from the cache and fetches the rest in one lookup"""
+    if not self.ttls[kind]:
+      return get_many(self.storage, kind, keys)
+    ret, missed = {}, []
+    for key in set(keys):
+      entity = self.cache.get((kind, key))
+      if entity is MISSING:
+        missed.append(key)
+      else:
+        ret[key] = entity
+    self.hits[kind] += len(ret)
+    if not missed:
+      return defer.succeed(ret)
+    self.misses[kind] += len(missed)
+    epoch = self.epoch
+    for key in missed:
+      self._lookup(kind, key)
+    return get_many(self.storage, kind, missed).addBoth(self._fetched_many, kind, missed, ret, epoch)
+
+  def _fetched_many(self, fetched, kind, missed, ret, epoch):
+    if isinstance(fetched, failure.Failure):
+      for key in missed:
+        self._fetched(fetched, kind, key, epoch)
+      return fetched
+    for key in missed:
+      ret[key] = self._fetched(fetched.get(key, None), kind, key, epoch)
+    return ret
+
+  def _saved(self, ret, kind):
+    self._invalidate(kind, ret.key)
+    if self.ttls[kind]:
+      self.cache.set((kind, ret.key), ret, self.ttls[kind])
+    return ret
+
+  def _invalidate(self, kind, key):
+    k = (kind, key)
+    self.cache.delete(k)
+    # only lookups of this very key are affected, inserts of new keys cost nothing
+    if k in self.in_flight:
+      self.epoch += 1
+      self.invalidated[k] = self.epoch
+
+  def _flush(self):
+    "drops every cached entry, and the results of every lookup in flight"
+    self.cache.clear()
+    self.epoch += 1
+    self.flushed = self.epoch
+
+  def _removed(self, ret, kind, key):
+    self._invalidate(kind, key)
+    return ret
+
+  def add_consumer(self, key=None, secret=None, **kwargs):
+    return self.storage.add_consumer(key, secret, **kwargs).addCallback(self._saved, 'consumer')
+
+  def save_consumer(self, consumer):
+    return self.storage.save_consumer(consumer).addCallback(self._saved, 'consumer')
+
+  def get_consumer(self, key):
+    return self._get('consumer', key, self.storage.get_consumer)
+
+  def get_consumers(self, keys):
+    return self._get_many('consumer', keys)
+
+  def remove_consumer(self, key):
+    self._invalidate('consumer', key)
+    return self.storage.remove_consumer(key).addCallback(self._removed, 'consumer', key)
+
+  def add_request_token(self, key=None, secret=None, **kwargs):
+    return self.storage.add_request_token(key, secret, **kwargs).addCallback(self._saved, 'request_token')
+
+  def save_request_token(self, token):
+    return self.storage.save_request_token(token).addCallback(self._saved, 'request_token')
+
+  def get_request_token(self, key):
+    return self._get('request_token', key, self.storage.get_request_token)
+
+  def consume_request_token(self, key):
+    self._invalidate('request_token', key)
+    return self.storage.consume_request_token(key).addCallback(self._removed, 'request_token', key)
+
+  def authorize_request_token(self, key, verifier=None):
+    self._invalidate('request_token', key)
+    return self.storage.authorize_request_token(key, verifier).addCallback(self._removed, 'request_token', key)
+
+  def exchange_request_token(self, key, verifier):
+    self._invalidate('request_token', key)
+    return self.storage.exchange_request_token(key, verifier).addCallback(self._removed, 'request_token', key)
+
+  def request_token_stats(self):
+    return self.storage.request_token_stats()
+
+  def remove_request_token(self, key):
+    self._invalidate('request_token', key)
+    return self.storage.remove_request_token(key).addCallback(self._removed, 'request_token', key)
+
+  def add_access_token(self, key=None, secret=None, **kwargs):
+    return self.storage.add_access_token(key, secret, **kwargs).addCallback(self._saved, 'access_token')
+
+  def save_access_token(self, token):
+    return self.storage.save_access_token(token).addCallback(self._saved, 'access_token')
+
+  def get_access_token(self, key):
+    return self._get('access_token', key, self.storage.get_access_token)
+
+  def get_access_tokens(self, keys):
+    return self._get_many('access_token', keys)
+
+  def remove_access_token(self, key):
+    self._invalidate('access_token', key)
+    return self.storage.remove_access_token(key).addCallback(self._removed, 'access_token', key)
+
+  def _saved_many(self, ret, kind):
+    for entity in ret:
+      self._saved(entity, kind)
+    return ret
+
+  def _invalidate_many(self, kind, keys):
+    for key in keys:
+      self._invalidate(kind, key)
+
+  def _removed_many(self, ret, kind, keys):
+    self._invalidate_many(kind, keys)
+    return ret
+
+  def add_consumers(self, n, **kwargs):
+    return self.storage.add_consumers(n, **kwargs).addCallback(self._saved_many, 'consumer')
+
+  def save_consumers(self, consumers):
+    return self.storage.save_consumers(consumers).addCallback(self._saved_many, 'consumer')
+
+  def remove_consumers(self, keys):
+    keys = list(keys)
+    self._invalidate_many('consumer', keys)
+    return self.storage.remove_consumers(keys).addCallback(self._removed_many, 'consumer', keys)
+
+  def add_access_tokens(self, n, **kwargs):
+    return self.storage.add_access_tokens(n, **kwargs).addCallback(self._saved_many, 'access_token')
+
+  def save_access_tokens(self, tokens):
+    return self.storage.save_access_tokens(tokens).addCallback(self._saved_many, 'access_token')
+
+  def remove_access_tokens(self, keys):
+    keys = list(keys)
+    self._invalidate_many('access_token', keys)
+    return self.storage.remove_access_tokens(keys).addCallback(self._removed_many, 'access_token', keys)
+
+  def get_consumer_and_token(self, consumer_key, token_key, token_type='access'):
+    kind = '%s_token' % token_type
+    get_token = self.get_access_token if token_type == 'access' else self.get_request_token
+    consumer, token = [self.cache.get(k) if self.ttls[k[0]] else MISSING
+                       for k in (('consumer', consumer_key), (kind, token_key))]
+    if consumer is not MISSING and token is not MISSING:
+      self.hits['consumer'] += 1
+      self.hits[kind] += 1
+      return defer.succeed((consumer, token))
+    if consumer is MISSING and token is MISSING:
+      # let the wrapped storage answer both with its batch lookup
+      self.misses['consumer'] += 1
+      self.misses[kind] += 1
+      epoch = self._lookup('consumer', consumer_key)
+      self._lookup(kind, token_key)
+      d = get_consumer_and_token(self.storage, consumer_key, token_key, token_type)
+      return d.addBoth(self._fetched_both, consumer_key, (kind, token_key), epoch)
+    return fetch_all([self.get_consumer(consumer_key), get_token(token_key)]).addCallback(tuple)
+
+  def get_consumer_and_token_nowait(self, consumer_key, token_key, token_type='access'):
+    "answers from the cache alone, MISSING unless both entries are cached"
+    kind = '%s_token' % token_type
+    if not (self.ttls['consumer'] and self.ttls[kind]):
+      return MISSING
+    consumer = self.cache.get(('consumer', consumer_key))
+    if consumer is MISSING:
+      return MISSING
+    token = self.cache.get((kind, token_key))
+    if token is MISSING:
+      return MISSING
+    self.hits['consumer'] += 1
+    self.hits[kind] += 1
+    return consumer, token
+
+  def _fetched_both(self, ret, consumer_key, token_k, epoch):
+    failed = isinstance(ret, failure.Failure)
+    self._fetched(ret if failed else ret[0], 'consumer', consumer_key, epoch)
+    self._fetched(ret if failed else ret[1], token_k[0], token_k[1], epoch)
+    return ret
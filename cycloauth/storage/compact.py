@@ -0,0 +1,138 @@
+from array import array
+from zope.interface import classImplements
+from cycloauth.storage import BaseStorage, IToken, IConsumer
+from cycloauth.token import CompactToken
+from cycloauth.consumer import CompactConsumer
+
+
+classImplements(CompactToken, IToken)
+classImplements(CompactConsumer, IConsumer)
+
+
+class CompactStorage(BaseStorage):
+  "implements an in-memory storage of slotted consumers and tokens"
+
+  request_token_factory = CompactToken
+  access_token_factory = CompactToken
+  consumer_factory = CompactConsumer
+
+
+class PackedTable(object):
+  """A dict-like table of consumers or tokens packed into contiguous buffers.
+
+  Only the key -> record number index holds Python objects, each record's
+  string `fields` (its secret and callback by default) live one after the
+  other in one bytearray and their offsets, lengths and creation times in
+  typed arrays. Entities are unpacked into a new `factory` instance on every
+  lookup, so changes must be saved back to be kept. A field holding anything
+  but a string is refused with a TypeError rather than dropped.
+  """
+
+  def __init__(self, factory, fields=('secret', 'callback')):
+    self.factory = factory
+    self.fields = fields
+    self.index = {}
+    self.data = bytearray()
+    self.offsets = array('L')
+    # one array of lengths per field
+    self.lengths = [array('L') for field in fields]
+    self.created = array('d')
+    self.free = []
+    self.garbage = 0
+
+  def __len__(self):
+    return len(self.index)
+
+  def __contains__(self, key):
+    return key in self.index
+
+  def __iter__(self):
+    return iter(self.index)
+
+  def __setitem__(self, key, entity):
+    values = [_encode(field, getattr(entity, field, None) or '') for field in self.fields]
+    created = getattr(entity, 'created', None) or 0.0
+    if key in self.index:
+      self._release(self.index.pop(key))
+    if self.free:
+      i = self.free.pop()
+      self.offsets[i] = len(self.data)
+      for lengths, value in zip(self.lengths, values):
+        lengths[i] = len(value)
+      self.created[i] = created
+    else:
+      i = len(self.offsets)
+      self.offsets.append(len(self.data))
+      for lengths, value in zip(self.lengths, values):
+        lengths.append(len(value))
+      self.created.append(created)
+    for value in values:
+      self.data += value
+    self.index[key] = i
+
+  def __getitem__(self, key):
+    i = self.index[key]
+    offset = self.offsets[i]
+    values = []
+    for lengths in self.lengths:
+      values.append(str(self.data[offset:offset + lengths[i]]))
+      offset += lengths[i]
+    kwargs = {'created': self.created[i]} if self.created[i] else {}
+    entity = self.factory(key=key, secret=values[0], **kwargs)
+    for field, value in zip(self.fields[1:], values[1:]):
+      if value:
+        setattr(entity, field, value)
+    return entity
+
+  def __delitem__(self, key):
+    self._release(self.index.pop(key))
+
+  def get(self, key, default=None):
+    if key not in self.index:
+      return default
+    return self[key]
+
+  def pop(self, key, default=None):
+    if key not in self.index:
+      return default
+    ret = self[key]
+    del self[key]
+    return ret
+
+  def _size(self, i):
+    return sum(lengths[i] for lengths in self.lengths)
+
+  def _release(self, i):
+    self.garbage += self._size(i)
+    self.free.append(i)
+    # rewrite the buffer once most of it is no longer referenced
+    if self.garbage > 4096 and self.garbage * 2 > len(self.data):
+      self.compact()
+
+  def compact(self):
+    "rewrites the data buffer without the bytes of removed or replaced records"
+    data = bytearray()
+    for i in self.index.itervalues():
+      offset = self.offsets[i]
+      self.offsets[i] = len(data)
+      data += self.data[offset:offset + self._size(i)]
+    self.data = data
+    self.garbage = 0
+
+
+def _encode(field, s):
+  if isinstance(s, unicode):
+    return s.encode('utf-8')
+  if not isinstance(s, str):
+    raise TypeError('%s must be a string to be packed, not %r' % (field, type(s)))
+  return s
+
+
+class PackedStorage(CompactStorage):
+  """implements an in-memory storage keeping consumers and access tokens packed
+  into contiguous buffers rather than as one object each"""
+
+  def __init__(self, settings):
+    CompactStorage.__init__(self, settings)
+    self.consumers = PackedTable(self.consumer_factory, ('secret', 'callback', 'rsa_key'))
+    self.access_tokens = PackedTable(self.access_token_factory, ('secret', 'callback', 'verifier', 'consumer_key'))
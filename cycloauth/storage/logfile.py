@@ -0,0 +1,483 @@
+import os, mmap, struct, hashlib, fcntl, time, zlib
+from twisted.internet import defer, threads, task
+from twisted.python import log
+from cycloauth.storage.compact import CompactStorage, _encode
+
+
+KIND_CONSUMER = 1
+KIND_ACCESS_TOKEN = 3
+
+OP_PUT = 1
+OP_DELETE = 2
+
+# kind, op, key length, value length, crc32 of key and value
+RECORD = struct.Struct('!BBHIi')
+# magic, generation, number of slots, used slots, committed log size, stale flag
+INDEX_HEADER = struct.Struct('!8sQQQQQ')
+# key hash (0 when empty), log offset
+INDEX_SLOT = struct.Struct('!QQ')
+# magic, generation
+LOG_HEADER = struct.Struct('!8sQ')
+INDEX_MAGIC = 'CYCIDX02'
+LOG_MAGIC = 'CYCLOG03'
+
+
+def key_hash(kind, key):
+  return struct.unpack('!Q', hashlib.sha1(chr(kind) + key).digest()[:8])[0] or 1
+
+
+class LogFile(object):
+  """An append-only log of records with a memory-mapped open-addressed hash index.
+
+  Both files are mapped into memory: appends are written into the mapping of a
+  preallocated log and a lookup is a probe of the index followed by a read of
+  one record straight out of the log mapping, without any system call. The
+  committed log size in the index header is written last, so a record only
+  exists once it has been counted there, which is also what recovery relies on.
+
+  Both headers carry a generation that compaction increments. An index is only
+  used with the log of its own generation: when a crash left them apart the
+  writer rebuilds the index from the log, and a reader opening them while the
+  writer swaps them in retries for a moment.
+
+  Any number of processes may open the files read-only and share the OS page
+  cache. When the writer replaces the files, on compaction or when the index
+  grows, it flags the old index as stale and readers reopen the new files on
+  their next lookup.
+  """
+
+  def __init__(self, path, name='oauth', readonly=False, fsync=False, lock=True, index_slots=1 << 16,
+               generation=0):
+    self.path = path
+    self.log_path = os.path.join(path, name + '.log')
+    self.index_path = os.path.join(path, name + '.idx')
+    self.readonly = readonly
+    self.fsync = fsync
+    self.initial_slots = index_slots
+    # only used to create a new log
+    self.generation = generation
+    self.lock_fd = None
+    # bytes in the log taken up by records that have been replaced or deleted
+    self.garbage = 0
+    if not readonly:
+      if not os.path.isdir(path):
+        os.makedirs(path)
+      if lock:
+        self.lock_fd = os.open(os.path.join(path, name + '.lock'), os.O_RDWR | os.O_CREAT, 0600)
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    self.open()
+
+  def open(self, attempts=50):
+    """maps the log and its index; a read-only instance finding them of different
+    generations retries up to `attempts` times, 10ms apart, for the writer to
+    finish swapping them"""
+    while True:
+      self._open()
+      if self.index_generation == self.generation:
+        break
+      if not self.readonly:
+        log.msg('%s is not the index of %s, rebuilding it' % (self.index_path, self.log_path))
+        self.close()
+        os.remove(self.index_path)
+        self._open()
+        break
+      self.close()
+      attempts -= 1
+      if attempts <= 0:
+        raise IOError('%s is not the index of %s' % (self.index_path, self.log_path))
+      time.sleep(0.01)
+    if not self.readonly:
+      self._recover()
+
+  def _open(self):
+    access = mmap.ACCESS_READ if self.readonly else mmap.ACCESS_WRITE
+    flags = os.O_RDONLY if self.readonly else os.O_RDWR | os.O_CREAT
+    self.log_fd = os.open(self.log_path, flags, 0600)
+    if not self.readonly and os.fstat(self.log_fd).st_size == 0:
+      os.ftruncate(self.log_fd, 1 << 20)
+      os.write(self.log_fd, LOG_HEADER.pack(LOG_MAGIC, self.generation))
+    self.log_mm = mmap.mmap(self.log_fd, 0, access=access)
+    magic, self.generation = LOG_HEADER.unpack_from(self.log_mm, 0)
+    if magic != LOG_MAGIC:
+      raise IOError('%s is not a cycloauth log' % self.log_path)
+    rebuild = not os.path.exists(self.index_path)
+    if rebuild and self.readonly:
+      raise IOError('%s has no index, open it for writing first' % self.path)
+    if rebuild:
+      self._write_index(self.index_path, self._empty_index(self.initial_slots, LOG_HEADER.size))
+    self.index_fd = os.open(self.index_path, flags)
+    self.index_mm = mmap.mmap(self.index_fd, 0, access=access)
+    magic, self.index_generation, self.slots, self.used, self.log_size, stale = \
+      INDEX_HEADER.unpack_from(self.index_mm, 0)
+    if magic != INDEX_MAGIC:
+      raise IOError('%s is not a cycloauth index' % self.index_path)
+
+  def close(self):
+    for mm in (self.log_mm, self.index_mm):
+      mm.close()
+    for fd in (self.log_fd, self.index_fd):
+      os.close(fd)
+
+  def reopen(self):
+    self.close()
+    self.open()
+
+  def _empty_index(self, slots, log_size):
+    buf = bytearray(INDEX_HEADER.size + slots * INDEX_SLOT.size)
+    INDEX_HEADER.pack_into(buf, 0, INDEX_MAGIC, self.generation, slots, 0, log_size, 0)
+    return buf
+
+  def _commit(self, stale=0):
+    INDEX_HEADER.pack_into(self.index_mm, 0, INDEX_MAGIC, self.generation, self.slots, self.used,
+                           self.log_size, stale)
+
+  def _write_index(self, path, buf):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+      f.write(buf)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+  def _refresh(self):
+    "picks up files replaced by the writer and log growth, for read-only instances"
+    if INDEX_HEADER.unpack_from(self.index_mm, 0)[5]:
+      self.reopen()
+    self.slots, self.used, self.log_size = INDEX_HEADER.unpack_from(self.index_mm, 0)[2:5]
+    if self.log_size > len(self.log_mm):
+      self.log_mm.close()
+      self.log_mm = mmap.mmap(self.log_fd, 0, access=mmap.ACCESS_READ)
+
+  def read(self, offset):
+    "returns the (kind, op, key, value, length) of the record at `offset`"
+    kind, op, key_length, value_length, crc = RECORD.unpack_from(self.log_mm, offset)
+    start = offset + RECORD.size
+    key = self.log_mm[start:start + key_length]
+    value = self.log_mm[start + key_length:start + key_length + value_length]
+    return kind, op, key, value, RECORD.size + key_length + value_length
+
+  def records(self, start, end):
+    "yields (offset, kind, op, key, value, length) for every record between the offsets"
+    offset = start
+    while offset < end:
+      kind, op, key, value, length = self.read(offset)
+      yield offset, kind, op, key, value, length
+      offset += length
+
+  def _probe(self, kind, key, h=None):
+    "returns (slot position, record offset or None) for `key`, the position being empty if it is absent"
+    h = h or key_hash(kind, key)
+    mm, slots = self.index_mm, self.slots
+    i = h % slots
+    while True:
+      pos = INDEX_HEADER.size + i * INDEX_SLOT.size
+      slot_hash, offset = INDEX_SLOT.unpack_from(mm, pos)
+      if slot_hash == 0:
+        return pos, None
+      # offsets past the committed size belong to records lost in a crash
+      if slot_hash == h and offset < self.log_size:
+        record_kind, op, key_length = RECORD.unpack_from(self.log_mm, offset)[:3]
+        if record_kind == kind and key_length == len(key) and \
+           self.log_mm[offset + RECORD.size:offset + RECORD.size + key_length] == key:
+          return pos, offset
+      i = (i + 1) % slots
+
+  def find(self, kind, key):
+    """returns the offset in `log_mm` of the value stored for `key`, or None, so
+    that its fields can be read where they are"""
+    if self.readonly:
+      self._refresh()
+    offset = self._probe(kind, key)[1]
+    if offset is None:
+      return None
+    record_kind, op, key_length = RECORD.unpack_from(self.log_mm, offset)[:3]
+    return offset + RECORD.size + key_length if op == OP_PUT else None
+
+  def lookup(self, kind, key):
+    "returns a copy of the value stored for `key`, or None"
+    if self.readonly:
+      self._refresh()
+    offset = self._probe(kind, key)[1]
+    if offset is None:
+      return None
+    record_kind, op, record_key, value = self.read(offset)[:4]
+    return value if op == OP_PUT else None
+
+  def append(self, kind, op, key, value=''):
+    if self.readonly:
+      raise IOError('%s is opened read-only' % self.path)
+    record = RECORD.pack(kind, op, len(key), len(value), zlib.crc32(key + value)) + key + value
+    offset = self.log_size
+    if offset + len(record) > len(self.log_mm):
+      self._grow_log(offset + len(record))
+    self.log_mm[offset:offset + len(record)] = record
+    h = key_hash(kind, key)
+    pos, previous = self._probe(kind, key, h)
+    if previous is not None:
+      self.garbage += self.read(previous)[4]
+    else:
+      self.used += 1
+    INDEX_SLOT.pack_into(self.index_mm, pos, h, offset)
+    self.log_size = offset + len(record)
+    # committing the new log size makes the record visible
+    self._commit()
+    if self.fsync:
+      self.log_mm.flush()
+      self.index_mm.flush()
+    if self.used * 10 > self.slots * 7:
+      self._grow_index()
+
+  def _grow_log(self, needed):
+    size = len(self.log_mm)
+    while size < needed:
+      size *= 2
+    # the old mapping isn't closed here, a compaction may still be reading it
+    os.ftruncate(self.log_fd, size)
+    self.log_mm = mmap.mmap(self.log_fd, 0, access=mmap.ACCESS_WRITE)
+
+  def _grow_index(self, slots=None):
+    """rehashes the index into a new file of `slots` slots, twice the size by default;
+    the slots hold the hashes so no record is read"""
+    slots = slots or self.slots * 2
+    buf = self._empty_index(slots, self.log_size)
+    for i in xrange(self.slots):
+      h, offset = INDEX_SLOT.unpack_from(self.index_mm, INDEX_HEADER.size + i * INDEX_SLOT.size)
+      if h:
+        j = h % slots
+        while INDEX_SLOT.unpack_from(buf, INDEX_HEADER.size + j * INDEX_SLOT.size)[0]:
+          j = (j + 1) % slots
+        INDEX_SLOT.pack_into(buf, INDEX_HEADER.size + j * INDEX_SLOT.size, h, offset)
+    INDEX_HEADER.pack_into(buf, 0, INDEX_MAGIC, self.generation, slots, self.used, self.log_size, 0)
+    self._write_index(self.index_path, buf)
+    self._commit(stale=1)
+    # only the index is remapped, the log is untouched and needs no recovery
+    self.index_mm.close()
+    os.close(self.index_fd)
+    self.index_fd = os.open(self.index_path, os.O_RDWR)
+    self.index_mm = mmap.mmap(self.index_fd, 0, access=mmap.ACCESS_WRITE)
+    self.slots = slots
+
+  def _replace(self, log_path, index):
+    """swaps in a compacted log and its index, then flags the old index stale for
+    readers. Each is renamed into place on its own; until both are, the files
+    are of different generations and are not used together"""
+    os.rename(log_path, self.log_path)
+    self._write_index(self.index_path, index)
+    self._commit(stale=1)
+    self.reopen()
+
+  def _recover(self):
+    """indexes complete records written after the last committed size, which also
+    rebuilds a missing index. A torn record fails its checksum and ends recovery,
+    later appends overwrite it. Records are indexed where they are, nothing is
+    appended, and the index is grown once up front for all of them."""
+    end = len(self.log_mm)
+    offset = self.log_size
+    found = []
+    while offset + RECORD.size <= end:
+      kind, op, key_length, value_length, crc = RECORD.unpack_from(self.log_mm, offset)
+      length = RECORD.size + key_length + value_length
+      if kind not in (KIND_CONSUMER, KIND_ACCESS_TOKEN) or op not in (OP_PUT, OP_DELETE) or offset + length > end:
+        break
+      key, value = self.read(offset)[2:4]
+      if zlib.crc32(key + value) != crc:
+        break
+      found.append((offset, kind, key, length))
+      offset += length
+    if not found:
+      return
+    slots = self.slots
+    while (self.used + len(found)) * 10 > slots * 7:
+      slots *= 2
+    if slots != self.slots:
+      self._grow_index(slots)
+    # slots written just before a crash point at records found here, counting them
+    # all lets each key's probe find its slot and its last record set it back
+    self.log_size = offset
+    for offset, kind, key, length in found:
+      h = key_hash(kind, key)
+      pos, previous = self._probe(kind, key, h)
+      if previous is not None and previous < offset:
+        self.garbage += self.read(previous)[4]
+      INDEX_SLOT.pack_into(self.index_mm, pos, h, offset)
+    self.used = sum(1 for i in xrange(self.slots)
+                    if INDEX_SLOT.unpack_from(self.index_mm, INDEX_HEADER.size + i * INDEX_SLOT.size)[0])
+    self._commit()
+    if self.fsync:
+      self.index_mm.flush()
+
+  def keys(self, kind):
+    "yields the live keys of `kind`, scanning the whole index"
+    if self.readonly:
+      self._refresh()
+    for i in xrange(self.slots):
+      h, offset = INDEX_SLOT.unpack_from(self.index_mm, INDEX_HEADER.size + i * INDEX_SLOT.size)
+      if h and offset < self.log_size:
+        record_kind, op, key = self.read(offset)[:3]
+        if record_kind == kind and op == OP_PUT:
+          yield key
+
+  def compact(self):
+    """rewrites the log without replaced and deleted records. The bulk of the work
+    happens in a thread on a snapshot, records appended meanwhile are copied over
+    afterwards in the calling thread, returns a deferred"""
+    if self.readonly:
+      return defer.fail(IOError('%s is opened read-only' % self.path))
+    snapshot_size = self.log_size
+    slots = self.slots
+    index = self.index_mm[:]
+    # a mapping of its own, the writer's is replaced when the log or index grows
+    log_mm = mmap.mmap(self.log_fd, 0, access=mmap.ACCESS_READ)
+    name = os.path.basename(self.log_path)[:-4] + '.compact'
+    for suffix in ('.log', '.idx'):
+      if os.path.exists(os.path.join(self.path, name + suffix)):
+        os.remove(os.path.join(self.path, name + suffix))
+    target = LogFile(self.path, name, lock=False, index_slots=self.slots, generation=self.generation + 1)
+
+    def copy_live():
+      for i in xrange(slots):
+        h, offset = INDEX_SLOT.unpack_from(index, INDEX_HEADER.size + i * INDEX_SLOT.size)
+        if h and offset < snapshot_size:
+          kind, op, key_length, value_length, crc = RECORD.unpack_from(log_mm, offset)
+          if op == OP_PUT:
+            start = offset + RECORD.size
+            target.append(kind, op, log_mm[start:start + key_length],
+                          log_mm[start + key_length:start + key_length + value_length])
+
+    def swap(result):
+      log_mm.close()
+      for offset, kind, op, key, value, length in self.records(snapshot_size, self.log_size):
+        target.append(kind, op, key, value)
+      target.log_mm.flush()
+      index = target.index_mm[:]
+      log_path = target.log_path
+      target.close()
+      os.remove(target.index_path)
+      self._replace(log_path, index)
+      self.garbage = 0
+      return self
+
+    return threads.deferToThread(copy_live).addCallback(swap)
+
+
+class LogTable(object):
+  """A dict-like view of one kind of entity in a LogFile.
+
+  A value is the entity's creation time and the lengths of its string `fields`
+  in a fixed header, followed by the fields themselves. Lookups unpack the
+  header and slice each field straight out of the log's mapping, the value is
+  neither copied as a whole nor decoded.
+  """
+
+  def __init__(self, log, kind, factory, fields=('secret', 'callback')):
+    self.log = log
+    self.kind = kind
+    self.factory = factory
+    self.fields = fields
+    # creation time, then the length of each field
+    self.header = struct.Struct('!d' + 'I' * len(fields))
+
+  def __contains__(self, key):
+    return self.log.find(self.kind, key) is not None
+
+  def __iter__(self):
+    return self.log.keys(self.kind)
+
+  def __len__(self):
+    return sum(1 for key in self)
+
+  def __getitem__(self, key):
+    offset = self.log.find(self.kind, key)
+    if offset is None:
+      raise KeyError(key)
+    mm = self.log.log_mm
+    header = self.header.unpack_from(mm, offset)
+    offset += self.header.size
+    values = []
+    for length in header[1:]:
+      values.append(mm[offset:offset + length])
+      offset += length
+    kwargs = {'created': header[0]} if header[0] else {}
+    entity = self.factory(key=key, secret=values[0], **kwargs)
+    for field, value in zip(self.fields[1:], values[1:]):
+      if value:
+        setattr(entity, field, value)
+    return entity
+
+  def __setitem__(self, key, entity):
+    values = [_encode(field, getattr(entity, field, None) or '') for field in self.fields]
+    header = self.header.pack(getattr(entity, 'created', None) or 0.0, *[len(value) for value in values])
+    self.log.append(self.kind, OP_PUT, key, header + ''.join(values))
+
+  def __delitem__(self, key):
+    if key not in self:
+      raise KeyError(key)
+    self.log.append(self.kind, OP_DELETE, key)
+
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def pop(self, key, default=None):
+    ret = self.get(key, default)
+    if key in self:
+      del self[key]
+    return ret
+
+
+class LogStorage(CompactStorage):
+  """implements a persistent storage on local disk, for read-mostly deployments
+
+  Consumers and access tokens live in an append-only log with a memory-mapped
+  hash index under `oauth_log_storage_path`, so lookups need no network and no
+  system calls. One process opens it for writing; other worker processes set
+  `oauth_log_storage_readonly` and share the same files through the page
+  cache, which means the token endpoints must be served by the writer. Short
+  lived request tokens stay in the writer's memory. The writer compacts the
+  log in the background every `oauth_log_storage_compact_interval` seconds once
+  more than half of it is garbage.
+  """
+
+  def __init__(self, settings):
+    CompactStorage.__init__(self, settings)
+    self.log = LogFile(settings.get('oauth_log_storage_path', 'oauth-data'),
+                       readonly=settings.get('oauth_log_storage_readonly', False),
+                       fsync=settings.get('oauth_log_storage_fsync', False))
+    self.consumers = LogTable(self.log, KIND_CONSUMER, self.consumer_factory, ('secret', 'callback', 'rsa_key'))
+    self.access_tokens = LogTable(self.log, KIND_ACCESS_TOKEN, self.access_token_factory,
+                                  ('secret', 'callback', 'verifier', 'consumer_key'))
+    self.compact_interval = settings.get('oauth_log_storage_compact_interval', 300)
+    self.compactor = None
+    self.compacting = None
+
+  def start(self):
+    if not self.log.readonly and self.compact_interval and self.compactor is None:
+      self.compactor = task.LoopingCall(self.maybe_compact)
+      self.compactor.start(self.compact_interval, now=False)
+    return CompactStorage.start(self)
+
+  def stop(self):
+    if self.compactor is not None and self.compactor.running:
+      self.compactor.stop()
+    self.compactor = None
+    return CompactStorage.stop(self)
+
+  def maybe_compact(self):
+    if self.log.garbage > 1 << 20 and self.log.garbage * 2 > self.log.log_size:
+      return self.compact()
+
+  def compact(self):
+    "compacts the log, returns a deferred; calls made while one is running share it"
+    if self.compacting is None:
+      self.compacting = self.log.compact()
+      self.compacting.addErrback(log.err)
+      self.compacting.addBoth(self._compacted)
+    d = defer.Deferred()
+    self.compacting.addBoth(lambda r: d.callback(None) or r)
+    return d
+
+  def _compacted(self, result):
+    self.compacting = None
+    return result
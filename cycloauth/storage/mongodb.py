@@ -1,7 +1,37 @@
-from cycloauth.storage import BaseStorage, BaseToken, BaseConsumer, key_secret_generator
+import datetime, calendar, functools, hashlib, time
+from cycloauth.storage import BaseStorage, BaseToken, BaseConsumer, fetch_all
+from cycloauth.storage.stateless import RevocationList
+from cycloauth.keygen import generate_key, generate_secret
+from cycloauth.nonce import INOnceStore
+from cycloauth.utils import MISSING, nonce_window, nonce_expiry
 from txmongo import MongoConnectionPool
+from txmongo import filter as qf
+from bson.objectid import ObjectId
+from pymongo.collection import ReturnDocument
+from pymongo.errors import CollectionInvalid
+from pymongo.operations import UpdateOne
 from cyclone.web import HTTPError
-from twisted.internet import defer
+from twisted.internet import defer, task
+from twisted.python import log, failure
+from zope.interface import implements
+
+
+def is_duplicate_key_error(e):
+  "whether an exception raised by a write, or any of a bulk write's errors, is a unique index violation"
+  errors = (getattr(e, 'details', None) or {}).get('writeErrors', None) or [e]
+  return any(getattr(err, 'code', None) in (11000, 11001) or
+             (isinstance(err, dict) and err.get('code', None) in (11000, 11001)) or
+             'E11000' in str(err) for err in errors)
+
+
+def is_index_conflict(e):
+  "whether creating an index failed because one on the same keys exists with other options"
+  return getattr(e, 'code', None) in (85, 86) or 'already exists with different options' in str(e)
+
+
+def is_collection_exists(e):
+  "whether creating a collection failed because it exists (NamespaceExists)"
+  return isinstance(e, CollectionInvalid) or getattr(e, 'code', None) == 48
 
 
 class MongoToken(BaseToken):
@@ -13,8 +43,12 @@ class MongoToken(BaseToken):
       'secret': self.secret,
       'callback': self.__dict__.get('callback', None),
       'callback_confirmed': self.__dict__.get('callback_confirmed', False),
-      'verifier': self.__dict__.get('verifier', None)
+      'verifier': self.__dict__.get('verifier', None),
+      'consumer_key': self.__dict__.get('consumer_key', None)
     }
+    if self.__dict__.get('created', None):
+      # stored as a date so a TTL index can expire request tokens
+      ret['created'] = datetime.datetime.utcfromtimestamp(self.created)
     if self.m_id:
       ret['_id'] = self.m_id
     return ret
@@ -22,10 +56,12 @@ class MongoToken(BaseToken):
   @classmethod
   def from_dict(cls, d):
     if not d: return None
-    ret = cls(key=d['key'], secret=d['secret'])
+    ret = cls(key=d['key'], secret=d['secret'], consumer_key=d.get('consumer_key', None))
     if d.get('callback', None):
       ret.set_callback(d['callback'])
     ret.m_id = d.get('_id', None)
+    if d.get('created', None):
+      ret.created = calendar.timegm(d['created'].utctimetuple())
     if d.get('verifier', None):
       ret.set_verifier(d['verifier'])
     return ret
@@ -40,6 +76,8 @@ class MongoConsumer(BaseConsumer):
       'secret': self.secret,
       'callback': self.callback
     }
+    if self.rsa_key:
+      ret['rsa_key'] = self.rsa_key
     if self.m_id:
       ret['_id'] = self.m_id
     return ret
@@ -49,6 +87,7 @@ class MongoConsumer(BaseConsumer):
     if not d: return None
     ret = cls(key=d['key'], secret=d['secret'])
     ret.callback = d.get('callback', None)
+    ret.rsa_key = d.get('rsa_key', None)
     ret.m_id = d.get('_id', None)
     return ret
 
@@ -66,139 +105,506 @@ class MongoDBStorage(BaseStorage):
     self.consumer_collection = settings.get('oauth_consumer_collection', 'oauth_consumers')
     self.request_token_collection = settings.get('oauth_request_token_collection', 'oauth_requets_tokens')
     self.ensured_indexes = {}
+    self.request_token_ttl = settings.get('oauth_request_token_ttl', 3600)
+    self.indexes = [
+      (self.consumer_collection, {'key': 1}, {'unique': True}),
+      (self.access_token_collection, {'key': 1}, {'unique': True}),
+      (self.request_token_collection, {'key': 1}, {'unique': True})]
+    if self.request_token_ttl:
+      self.indexes.append((self.request_token_collection, {'created': 1},
+                           {'expireAfterSeconds': self.request_token_ttl}))
+    self.pool_size = settings.get('oauth_mongo_pool_size', 5)
+    self._pool = self._db = self._connecting = None
+    self._start_waiters = []
+    self.in_flight = 0
+    # one slot per pooled connection, operations beyond them wait for one
+    self._slots = defer.DeferredSemaphore(self.pool_size)
+    self.metrics = dict(operations=0, max_in_flight=0, waits=0, wait_time_total=0.0, wait_time_max=0.0,
+                        connect_waits=0, connect_wait_time_total=0.0, connect_wait_time_max=0.0)
   
-  @defer.inlineCallbacks
   def add_consumer(self, key=None, secret=None, **kwargs):
-    yield self.mongo_ensure(self.consumer_collection, {'key': 1})
-    ks = yield key_secret_generator(self, 'get_consumer', key, secret)
-    ret = yield self.save_consumer(self.consumer_factory(key=ks['key'], secret=ks['secret'], **kwargs))
-    defer.returnValue(ret)
+    consumer = self.consumer_factory(key=key or generate_key(), secret=secret or generate_secret(), **kwargs)
+    d = self.mongo_insert_new(self.consumer_collection, [consumer], key is None)
+    return d.addCallback(lambda r: r[0])
   
-  @defer.inlineCallbacks
   def save_consumer(self, consumer):
-    yield self.mongo_ensure(self.consumer_collection, {'key': 1})
-    r = consumer.to_dict()
-    yield self.mongo_save(self.consumer_collection, r)
-    defer.returnValue(MongoConsumer.from_dict(r))
+    return self.mongo_upsert(self.consumer_collection, consumer)
   
   @defer.inlineCallbacks
   def get_consumer(self, key):
-    yield self.mongo_ensure(self.consumer_collection, {'key': 1})
     r = yield self.mongo_find_one_or_none(self.consumer_collection, {'key': key})
     defer.returnValue(MongoConsumer.from_dict(r) if r else None)
   
+  def get_consumers(self, keys):
+    return self._get_many(self.consumer_collection, MongoConsumer, keys)
+  
   @defer.inlineCallbacks
   def remove_consumer(self, key):
-    yield self.mongo_ensure(self.consumer_collection, {'key': 1})
     yield self.mongo_remove(self.consumer_collection, {'key': key})
     defer.returnValue(True)
   
-  @defer.inlineCallbacks
   def add_request_token(self, key=None, secret=None, **kwargs):
-    self.mongo_ensure(self.request_token_collection, {'key': 1})
-    ks = yield key_secret_generator(self, 'get_request_token', key, secret)
-    ret = yield self.save_request_token(self.request_token_factory(key=ks['key'], secret=ks['secret'], **kwargs))
-    defer.returnValue(ret)
+    token = self.request_token_factory(key=key or generate_key(), secret=secret or generate_secret(), **kwargs)
+    d = self.mongo_insert_new(self.request_token_collection, [token], key is None)
+    return d.addCallback(lambda r: r[0])
   
-  @defer.inlineCallbacks
   def save_request_token(self, token):
-    yield self.mongo_ensure(self.request_token_collection, {'key': 1})
-    r = token.to_dict()
-    yield self.mongo_save(self.request_token_collection, r)
-    defer.returnValue(MongoToken.from_dict(r) if r else None)
+    return self.mongo_upsert(self.request_token_collection, token)
   
+  def _live_request_token_query(self, key):
+    # the TTL monitor only runs every minute or so, don't hand out tokens it hasn't reached yet
+    query = {'key': key}
+    if self.request_token_ttl:
+      cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.request_token_ttl)
+      # tokens saved without a creation date, by earlier versions, are stamped by start()
+      query['$or'] = [{'created': {'$gt': cutoff}}, {'created': None}]
+    return query
+
+  def stamp_request_tokens(self, db=None):
+    """gives request tokens stored without a creation date the current time, so
+    they expire oauth_request_token_ttl seconds from now"""
+    return self._caller(db)(self.request_token_collection, 'update_many', {'created': None},
+                            {'$set': {'created': datetime.datetime.utcnow()}})
+
   @defer.inlineCallbacks
   def get_request_token(self, key):
-    yield self.mongo_ensure(self.request_token_collection, {'key': 1})
-    r = yield self.mongo_find_one_or_none(self.request_token_collection, {'key': key})
+    r = yield self.mongo_find_one_or_none(self.request_token_collection, self._live_request_token_query(key))
+    defer.returnValue(MongoToken.from_dict(r))
+
+  @defer.inlineCallbacks
+  def consume_request_token(self, key):
+    r = yield self.mongo_call(self.request_token_collection, 'find_one_and_delete',
+                              self._live_request_token_query(key))
+    defer.returnValue(MongoToken.from_dict(r))
+
+  @defer.inlineCallbacks
+  def authorize_request_token(self, key, verifier=None):
+    query = self._live_request_token_query(key)
+    # matches tokens without one too
+    query['verifier'] = None
+    verifier = verifier or self.request_token_factory.verifier_generator()
+    r = yield self.mongo_call(self.request_token_collection, 'find_one_and_update', query,
+                              {'$set': {'verifier': verifier}}, return_document=ReturnDocument.AFTER)
     defer.returnValue(MongoToken.from_dict(r))
+
+  def exchange_request_token(self, key, verifier):
+    if not verifier:
+      return defer.succeed(None)
+    query = self._live_request_token_query(key)
+    query['verifier'] = verifier
+    d = self.mongo_call(self.request_token_collection, 'find_one_and_delete', query)
+    return d.addCallback(MongoToken.from_dict)
+
+  @defer.inlineCallbacks
+  def request_token_stats(self):
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.request_token_ttl or 0)
+    live, expired = yield fetch_all([
+      self.mongo_call(self.request_token_collection, 'count', {'$or': [{'created': {'$gt': cutoff}}, {'created': None}]}),
+      self.mongo_call(self.request_token_collection, 'count', {'created': {'$lte': cutoff}})])
+    # expired documents are removed by mongod's TTL monitor, which doesn't count them
+    defer.returnValue({'live': live, 'expired': expired if self.request_token_ttl else 0, 'reaped': None})
   
   @defer.inlineCallbacks
   def remove_request_token(self, key):
-    yield self.mongo_ensure(self.request_token_collection, {'key': 1})
     yield self.mongo_remove(self.request_token_collection, {'key': key})
     defer.returnValue(True)
 
-  @defer.inlineCallbacks
   def add_access_token(self, key=None, secret=None, **kwargs):
-    self.mongo_ensure(self.access_token_collection, {'key': 1})
-    ks = yield key_secret_generator(self, 'get_access_token', key, secret)
-    ret = yield self.save_access_token(self.access_token_factory(key=ks['key'], secret=ks['secret'], **kwargs))
-    defer.returnValue(ret)
+    token = self.access_token_factory(key=key or generate_key(), secret=secret or generate_secret(), **kwargs)
+    d = self.mongo_insert_new(self.access_token_collection, [token], key is None)
+    return d.addCallback(lambda r: r[0])
   
-  @defer.inlineCallbacks
-  def save_access_token(self, token):    
-    yield self.mongo_ensure(self.access_token_collection, {'key': 1})
-    r = token.to_dict()
-    yield self.mongo_save(self.request_token_collection, r)
-    defer.returnValue(MongoToken.from_dict(r))
+  def save_access_token(self, token):
+    return self.mongo_upsert(self.access_token_collection, token)
   
   @defer.inlineCallbacks
   def get_access_token(self, key):
-    yield self.mongo_ensure(self.access_token_collection, {'key': 1})
     r = yield self.mongo_find_one_or_none(self.access_token_collection, {'key': key})
     defer.returnValue(MongoToken.from_dict(r) if r else None)
   
+  def get_access_tokens(self, keys):
+    return self._get_many(self.access_token_collection, MongoToken, keys)
+
   @defer.inlineCallbacks
   def remove_access_token(self, key):
-    yield self.mongo_ensure(self.access_token_collection, {'key': 1})
-    yield self.mong_remove(self.access_token_collection, {'key': key})
+    yield self.mongo_remove(self.access_token_collection, {'key': key})
     defer.returnValue(True)
   
-  @property
+  def add_consumers(self, n, **kwargs):
+    consumers = [self.consumer_factory(key=generate_key(), secret=generate_secret(), **kwargs)
+                 for i in xrange(n)]
+    return self.mongo_insert_new(self.consumer_collection, consumers, True)
+
+  def save_consumers(self, consumers):
+    return self._save_many(self.consumer_collection, consumers)
+
+  def remove_consumers(self, keys):
+    d = self.mongo_remove(self.consumer_collection, {'key': {'$in': list(keys)}})
+    return d.addCallback(lambda r: True)
+
+  def add_access_tokens(self, n, **kwargs):
+    tokens = [self.access_token_factory(key=generate_key(), secret=generate_secret(), **kwargs)
+              for i in xrange(n)]
+    return self.mongo_insert_new(self.access_token_collection, tokens, True)
+
+  def save_access_tokens(self, tokens):
+    return self._save_many(self.access_token_collection, tokens)
+
+  def remove_access_tokens(self, keys):
+    d = self.mongo_remove(self.access_token_collection, {'key': {'$in': list(keys)}})
+    return d.addCallback(lambda r: True)
+
+  @defer.inlineCallbacks
+  def _get_many(self, collection, cls, keys):
+    "finds every entity of `keys` with one query, returns a dict of key to entity or None"
+    ret = dict.fromkeys(keys)
+    if ret:
+      docs = yield self.mongo_call(collection, 'find', {'key': {'$in': list(ret)}})
+      for doc in docs:
+        ret[doc['key']] = cls.from_dict(doc)
+    defer.returnValue(ret)
+
+  @defer.inlineCallbacks
+  def _save_many(self, collection, entities):
+    """writes each entity over the document with the same key, or inserts it, as
+    mongo_upsert does, all in one unordered bulk write"""
+    entities = list(entities)
+    if not entities:
+      defer.returnValue(entities)
+    requests = []
+    for e in entities:
+      doc = e.to_dict()
+      doc.pop('_id', None)
+      requests.append(UpdateOne({'key': e.key}, {'$set': doc}, upsert=True))
+    result = yield self.mongo_call(collection, 'bulk_write', requests, ordered=False)
+    for i, _id in result.upserted_ids.iteritems():
+      entities[i].m_id = _id
+    # entities saved over a document they weren't read from need its _id
+    unknown = dict((e.key, e) for e in entities if not e.m_id)
+    if unknown:
+      docs = yield self.mongo_call(collection, 'find', {'key': {'$in': list(unknown)}}, projection=['key'])
+      for doc in docs:
+        unknown[doc['key']].m_id = doc['_id']
+    defer.returnValue(entities)
+
+  def mongo_upsert(self, collection, entity):
+    """writes `entity` over the document with the same key, or inserts it, and
+    returns a deferred firing the entity itself with its m_id set. Only the
+    entity's fields are $set, the stored document isn't replaced."""
+    doc = entity.to_dict()
+    doc.pop('_id', None)
+    if entity.m_id:
+      d = self.mongo_call(collection, 'update_one', {'key': entity.key}, {'$set': doc}, upsert=True)
+      return d.addCallback(lambda r: entity)
+    # the _id of an existing document isn't known here, have mongod return it
+    d = self.mongo_call(collection, 'find_one_and_update', {'key': entity.key}, {'$set': doc},
+                        projection={'_id': 1}, upsert=True, return_document=ReturnDocument.AFTER)
+    return d.addCallback(self._upserted, entity)
+
+  def _upserted(self, doc, entity):
+    entity.m_id = doc['_id']
+    return entity
+
   @defer.inlineCallbacks
+  def mongo_insert_new(self, collection, entities, generated_keys):
+    """inserts entities in one multi-document insert and relies on the unique key
+    index to detect collisions rather than reading each key first. When the keys
+    were generated here the entities that didn't make it in get new keys and
+    are retried, otherwise the duplicate key error is raised."""
+    pending = list(entities)
+    while pending:
+      for e in pending:
+        if not e.m_id:
+          e.m_id = ObjectId()
+      try:
+        yield self.mongo_call(collection, 'insert_many', [e.to_dict() for e in pending], ordered=True)
+        break
+      except Exception, err:
+        if not (generated_keys and is_duplicate_key_error(err)):
+          raise
+      # the insert stops at the first collision, find out how far it got
+      inserted = yield self.mongo_call(collection, 'find', {'_id': {'$in': [e.m_id for e in pending]}},
+                                       projection=['_id'])
+      inserted = set(d['_id'] for d in inserted)
+      pending = [e for e in pending if e.m_id not in inserted]
+      for e in pending:
+        e.key = generate_key()
+    defer.returnValue(list(entities))
+
+  def get_consumer_and_token(self, consumer_key, token_key, token_type='access'):
+    # the two collections can't be read in one query, but both go out at once
+    get_token = self.get_access_token if token_type == 'access' else self.get_request_token
+    return fetch_all([self.get_consumer(consumer_key), get_token(token_key)]).addCallback(tuple)
+
+  def get_consumer_and_token_nowait(self, consumer_key, token_key, token_type='access'):
+    # every lookup is a query
+    return MISSING
+
+  def start(self):
+    """connects the pool, creates indexes and warms every connection, returns a
+    deferred firing the database. Concurrent callers share one connection attempt."""
+    if self._db is not None:
+      return defer.succeed(self._db)
+    d = defer.Deferred()
+    self._start_waiters.append((d, time.time()))
+    if self._connecting is None:
+      self._connecting = self._connect()
+      self._connecting.addBoth(self._connected)
+    return d
+
+  @defer.inlineCallbacks
+  def _connect(self):
+    pool = yield MongoConnectionPool(
+      host=self.settings.get('oauth_mongo_host', '127.0.0.1'), 
+      port=self.settings.get('oauth_mongo_port', 27017),
+      reconnect=self.settings.get('oauth_mongo_reconnect', True), 
+      pool_size=self.pool_size)
+    self._pool = pool
+    db = getattr(pool, self.settings.get('oauth_mongo_database', 'oauth'))
+    # the database is only handed out once the unique key indexes exist, other
+    # calls wait on start() until then, so setup talks to it directly
+    yield self.ensure_indexes(db)
+    if self.request_token_ttl:
+      yield self.stamp_request_tokens(db)
+    # txmongo hands out pooled connections round-robin, so one cheap query per
+    # connection makes sure each of them is established before real traffic
+    yield fetch_all([self._call(db, self.consumer_collection, 'find_one', {'key': None})
+                     for i in xrange(self.pool_size)])
+    # indexes registered while the above ran, the others are skipped
+    yield self.ensure_indexes(db)
+    self._db = db
+    defer.returnValue(db)
+
+  def _connected(self, result):
+    self._connecting = None
+    if isinstance(result, failure.Failure):
+      if self._pool is not None:
+        # connected, but creating the indexes or warming the pool failed
+        self._pool.disconnect()
+      self._pool = self._db = None
+    waiters, self._start_waiters = self._start_waiters, []
+    now = time.time()
+    for d, started in waiters:
+      self._waited('connect_', now - started)
+      if isinstance(result, failure.Failure):
+        d.errback(result)
+      else:
+        d.callback(result)
+    if isinstance(result, failure.Failure):
+      log.err(result)
+
+  def stop(self):
+    "disconnects the pool"
+    pool, self._pool, self._db = self._pool, None, None
+    if pool is None:
+      return defer.succeed(None)
+    return defer.maybeDeferred(pool.disconnect)
+
+  def pool_stats(self):
+    """returns connection pool utilization and wait-time metrics: `waits` and
+    `wait_time_*` for operations which waited for a pooled connection,
+    `connect_waits` and `connect_wait_time_*` for callers of start() which
+    waited for the pool to connect"""
+    ret = dict(self.metrics)
+    ret['pool_size'] = self.pool_size
+    ret['in_flight'] = self.in_flight
+    ret['utilization'] = float(self.pool_size - self._slots.tokens) / self.pool_size
+    ret['queued'] = len(self._slots.waiting)
+    ret['connected'] = self._db is not None
+    return ret
+
+  def _waited(self, prefix, seconds):
+    self.metrics[prefix + 'waits'] += 1
+    self.metrics[prefix + 'wait_time_total'] += seconds
+    self.metrics[prefix + 'wait_time_max'] = max(self.metrics[prefix + 'wait_time_max'], seconds)
+
+  @property
   def db(self):
-    if not getattr(self, '_db', None):
-      pool = yield self.pool
-      self._db = getattr(pool, self.settings.get('oauth_mongo_database', 'oauth'))
-    defer.returnValue(self._db)
+    return self.start()
 
   @property
-  @defer.inlineCallbacks
   def pool(self):
-    if not getattr(self, '_pool', None):
-      mongo = yield MongoConnectionPool(
-        host=self.settings.get('oauth_mongo_host', '127.0.0.1'), 
-        port=self.settings.get('oauth_mongo_port', 27017),
-        reconnect=self.settings.get('oauth_mongo_reconnect', True), 
-        pool_size=self.settings.get('oauth_mongo_pool_size', 5))
-      self._pool = mongo
-    defer.returnValue(self._pool)
-  
+    return self.start().addCallback(lambda db: self._pool)
+
+  def add_index(self, collection, index, **kwargs):
+    "registers an index to be created when the pool connects, or right away if it already has"
+    self.indexes.append((collection, index, kwargs))
+    if self._db is not None and self.settings.get('oauth_mongo_ensure_indexes', True):
+      return self.mongo_ensure(collection, index, **kwargs)
+    return defer.succeed(True)
+
   @defer.inlineCallbacks
+  def ensure_indexes(self, db=None):
+    """creates every registered index, once, so queries never have to. A failure
+    fails start(): without the unique key indexes duplicate keys go undetected"""
+    if not self.settings.get('oauth_mongo_ensure_indexes', True):
+      defer.returnValue(False)
+    for collection, index, kwargs in self.indexes:
+      yield self.mongo_ensure(collection, index, db=db, **kwargs)
+    defer.returnValue(True)
+
+  def mongo_call(self, collection, method, *args, **kwargs):
+    "calls `method` on the named collection, waiting for the pool to connect if it has not yet"
+    if self._db is None:
+      return self.start().addCallback(lambda db: self.mongo_call(collection, method, *args, **kwargs))
+    return self._call(self._db, collection, method, *args, **kwargs)
+
+  def _call(self, db, collection, method, *args, **kwargs):
+    "calls `method` on the named collection of `db` as soon as a pooled connection is free"
+    self.in_flight += 1
+    self.metrics['operations'] += 1
+    if self.in_flight > self.metrics['max_in_flight']:
+      self.metrics['max_in_flight'] = self.in_flight
+    requested = None if self._slots.tokens else time.time()
+    d = self._slots.acquire()
+    d.addCallback(self._checked_out, requested, getattr(getattr(db, collection), method), args, kwargs)
+    d.addBoth(self._call_done)
+    return d
+
+  def _checked_out(self, slots, requested, method, args, kwargs):
+    if requested is not None:
+      self._waited('', time.time() - requested)
+    d = defer.maybeDeferred(method, *args, **kwargs)
+    return d.addBoth(self._checked_in)
+
+  def _checked_in(self, result):
+    self._slots.release()
+    return result
+
+  def _caller(self, db):
+    "mongo_call, or a call made on `db` without waiting for start() when given one"
+    return self.mongo_call if db is None else functools.partial(self._call, db)
+
+  def _call_done(self, result):
+    self.in_flight -= 1
+    return result
+
   def mongo_find_one_or_none(self, collection, query):
-    col = getattr((yield self.db), collection)
-    r = yield col.find_one(query)
-    if not r:
-      r = None
-    defer.returnValue(r)
+    return self.mongo_call(collection, 'find_one', query).addCallback(lambda r: r or None)
 
-  @defer.inlineCallbacks
-  def mongo_insert(self, collection, *args, **kwargs):
-    col = getattr((yield self.db), collection)
-    r = yield col.insert(*args, **kwargs)
-    defer.returnValue(r)
+  def mongo_insert(self, collection, doc):
+    return self.mongo_call(collection, 'insert_one', doc)
 
-  @defer.inlineCallbacks
-  def mongo_save(self, collection, *args, **kwargs):
-    col = getattr((yield self.db), collection)
-    r = yield col.save(*args, **kwargs)
-    defer.returnValue(r)
+  def mongo_save(self, collection, doc):
+    "replaces the document with the same _id as `doc`, or inserts it"
+    return self.mongo_call(collection, 'replace_one', {'_id': doc['_id']}, doc, upsert=True)
 
-  @defer.inlineCallbacks
-  def mongo_remove(self, collection, *args, **kwargs):
-    col = getattr((yield self.db), collection)
-    r = yield col.remove(*args, **kwargs)
-    defer.returnValue(r)
+  def mongo_remove(self, collection, spec):
+    return self.mongo_call(collection, 'delete_many', spec)
   
   @defer.inlineCallbacks
-  def mongo_ensure(self, collection, index):
-    k = 'collection' + ''.join(list(index.iterkeys()))
+  def mongo_ensure(self, collection, index, db=None, **kwargs):
+    """creates an index. One on the same keys created with other options, such as the
+    non-unique key indexes of earlier versions, fails it unless
+    `oauth_mongo_replace_conflicting_indexes` is set, then it is dropped and recreated"""
+    call = self._caller(db)
+    k = collection + ':' + ','.join(sorted(index.iterkeys()))
     if k in self.ensured_indexes:
       defer.returnValue(True)
-    else:
-      col = getattr((yield self.db), collection)
-      yield col.ensureIndex(index)
-      defer.returnValue(True)
-  
+    fields = qf.sort(sorted(index.items()))
+    try:
+      yield call(collection, 'create_index', fields, **kwargs)
+    except Exception, e:
+      if not is_index_conflict(e):
+        raise
+      if not self.settings.get('oauth_mongo_replace_conflicting_indexes', False):
+        log.msg('the index %s exists with options other than %r, drop it or set '
+                'oauth_mongo_replace_conflicting_indexes' % (k, kwargs))
+        raise
+      log.msg('replacing the index %s, it exists with options other than %r' % (k, kwargs))
+      yield call(collection, 'drop_index', fields)
+      yield call(collection, 'create_index', fields, **kwargs)
+    self.ensured_indexes[k] = True
+    defer.returnValue(True)
+
+class MongoNOnceStore(object):
+  """implements a nonce store shared by every process using the same MongoDB
+
+  Each nonce is inserted as a document whose _id is derived from the consumer
+  key and nonce, so the unique _id index makes check-and-add a single insert.
+  A TTL index removes documents once their timestamp leaves the window.
+  """
+  implements(INOnceStore)
+
+  def __init__(self, settings, storage):
+    # look through storage wrappers such as CachingStorage
+    while not isinstance(storage, MongoDBStorage) and hasattr(storage, 'storage'):
+      storage = storage.storage
+    if not isinstance(storage, MongoDBStorage):
+      raise TypeError('MongoNOnceStore requires oauth_storage_factory to be a MongoDBStorage')
+    self.storage = storage
+    self.window = nonce_window(settings)
+    self.collection = settings.get('oauth_nonce_collection', 'oauth_nonces')
+    # without it the collection grows without bound
+    self.indexed = storage.add_index(self.collection, {'expires': 1}, expireAfterSeconds=0)
+    self.indexed.addErrback(log.err, 'creating the TTL index of %s failed' % self.collection)
+
+  @defer.inlineCallbacks
+  def check_and_add(self, consumer_key, nonce, timestamp):
+    expires = datetime.datetime.utcfromtimestamp(nonce_expiry(timestamp, self.window, time.time()))
+    doc = {
+      '_id': hashlib.sha1('%s\0%s' % (consumer_key, nonce)).hexdigest(),
+      'expires': expires
+    }
+    try:
+      yield self.storage.mongo_insert(self.collection, doc)
+    except Exception, e:
+      if is_duplicate_key_error(e):
+        defer.returnValue(False)
+      raise
+    defer.returnValue(True)
+
+
+class MongoRevocationList(RevocationList):
+  """revoked stateless access tokens shared by every process using the same MongoDB
+
+  Revocations are written to `oauth_revocation_collection` and every process
+  reloads the live ones each `oauth_revocation_poll_interval` seconds, so a
+  revocation made elsewhere takes effect within one interval while checks
+  stay in memory. A TTL index removes revocations once the tokens expire.
+  """
+
+  def __init__(self, settings, storage):
+    RevocationList.__init__(self, settings, storage)
+    while not isinstance(storage, MongoDBStorage) and hasattr(storage, 'storage'):
+      storage = storage.storage
+    if not isinstance(storage, MongoDBStorage):
+      raise TypeError('MongoRevocationList requires oauth_cached_storage_factory to be a MongoDBStorage')
+    self.storage = storage
+    self.collection = settings.get('oauth_revocation_collection', 'oauth_revoked_tokens')
+    self.poll_interval = settings.get('oauth_revocation_poll_interval', 5)
+    self.poller = None
+    self.indexed = storage.add_index(self.collection, {'expires': 1}, expireAfterSeconds=0)
+    self.indexed.addErrback(log.err, 'creating the TTL index of %s failed' % self.collection)
+
+  def start(self):
+    if self.poller is None:
+      self.poller = task.LoopingCall(self.poll)
+      self.poller.start(self.poll_interval, now=False)
+    return self.poll()
+
+  def stop(self):
+    if self.poller is not None and self.poller.running:
+      self.poller.stop()
+    self.poller = None
+    return defer.succeed(None)
+
+  @defer.inlineCallbacks
+  def poll(self):
+    "replaces the revocations held in memory with the live ones in the collection"
+    spec = {'expires': {'$gt': datetime.datetime.utcnow()}}
+    try:
+      docs = yield self.storage.mongo_call(self.collection, 'find', spec, projection=['expires'])
+    except Exception:
+      # the LoopingCall would stop on a failure, the previous revocations are kept
+      log.err()
+      return
+    self.revoked = dict((doc['_id'], calendar.timegm(doc['expires'].utctimetuple())) for doc in docs)
 
+  def revoke(self, revocations):
+    revocations = list(revocations)
+    RevocationList.revoke(self, revocations)
+    return fetch_all([self.storage.mongo_call(self.collection, 'update_one', {'_id': key},
+                                              {'$set': {'expires': datetime.datetime.utcfromtimestamp(expires)}},
+                                              upsert=True)
+                      for key, expires in revocations]).addCallback(lambda r: True)
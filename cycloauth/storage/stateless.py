@@ -0,0 +1,259 @@
+import os, time, struct, hmac, hashlib, binascii, base64
+from twisted.internet import defer
+from cycloauth.storage.cache import CachingStorage
+from cycloauth.signatures import constant_time_compare
+from cycloauth.utils import MISSING, import_object
+
+
+__all__ = ['TokenCodec', 'RevocationList', 'StatelessTokenStorage']
+
+
+NONCE_LENGTH = 12
+MAC_LENGTH = 16
+# issue and expiry times
+HEADER = struct.Struct('!II')
+
+
+def _b64encode(s):
+  return base64.urlsafe_b64encode(s).rstrip('=')
+
+
+def _b64decode(s):
+  return base64.urlsafe_b64decode(s + '=' * (-len(s) % 4))
+
+
+def _xor(data, stream):
+  n = len(data)
+  if not n:
+    return data
+  x = int(binascii.hexlify(data), 16) ^ int(binascii.hexlify(stream[:n]), 16)
+  return binascii.unhexlify('%0*x' % (n * 2, x))
+
+
+class MasterKey(object):
+  """the encryption, authentication and secret derivation keys derived from one
+  master key, kept as keyed HMACs which are copied rather than rekeyed per use"""
+  __slots__ = ('id', 'encryption', 'authentication', 'derivation')
+
+  def __init__(self, key_id, secret):
+    if isinstance(secret, unicode):
+      secret = secret.encode('utf-8')
+    self.id = str(key_id)
+    derive = lambda purpose: hmac.new(hmac.new(secret, purpose, hashlib.sha256).digest(), digestmod=hashlib.sha256)
+    self.encryption = derive('cycloauth token encryption')
+    self.authentication = derive('cycloauth token authentication')
+    self.derivation = derive('cycloauth token secret')
+
+  def _hmac(self, keyed, data):
+    h = keyed.copy()
+    h.update(data)
+    return h
+
+  def keystream(self, nonce, n):
+    return ''.join(self._hmac(self.encryption, nonce + struct.pack('!I', counter)).digest()
+                   for counter in xrange((n + 31) // 32))
+
+  def mac(self, data):
+    return self._hmac(self.authentication, data).digest()[:MAC_LENGTH]
+
+  def secret(self, token_key):
+    return self._hmac(self.derivation, token_key).hexdigest()
+
+
+class TokenCodec(object):
+  """Issues and reads self-verifying access token keys.
+
+  A key is `<master key id>.<base64url of nonce, ciphertext and MAC>`. The
+  ciphertext holds the issue time, expiry and consumer key, encrypted with an
+  HMAC-SHA256 keystream and authenticated with HMAC-SHA256. The token secret
+  is never stored: it is an HMAC of the whole key, derived again on every
+  request. Keys are taken from `master_keys`, a dict of id to secret, and new
+  tokens use `key_id`, so master keys are rotated by adding a new one, issuing
+  with it and dropping the old one once its tokens have expired.
+  """
+
+  def __init__(self, master_keys, key_id=None, ttl=30 * 86400):
+    if not master_keys:
+      raise ValueError('stateless tokens require oauth_token_master_keys')
+    if key_id is None:
+      if len(master_keys) != 1:
+        raise ValueError('oauth_token_key_id must name one of several oauth_token_master_keys')
+      key_id = list(master_keys)[0]
+    for k in master_keys:
+      if not k or '.' in k:
+        raise ValueError('master key ids must be non-empty and contain no dots: %r' % (k,))
+    self.keys = dict((str(k), MasterKey(k, secret)) for k, secret in master_keys.iteritems())
+    if str(key_id) not in self.keys:
+      raise ValueError('unknown master key id %r' % (key_id,))
+    self.key_id = str(key_id)
+    self.ttl = ttl
+
+  def issue(self, consumer_key, now=None):
+    "returns the (key, secret) of a new token for `consumer_key`"
+    master = self.keys[self.key_id]
+    issued = int(now or time.time())
+    plain = HEADER.pack(issued, issued + self.ttl) + (consumer_key or '').encode('utf-8')
+    nonce = os.urandom(NONCE_LENGTH)
+    sealed = nonce + _xor(plain, master.keystream(nonce, len(plain)))
+    key = '%s.%s' % (master.id, _b64encode(sealed + master.mac(master.id + '.' + sealed)))
+    return key, master.secret(key)
+
+  def decode(self, key, now=None):
+    """returns the (consumer key, issue time, expiry, secret) of a token key, or
+    None when it is malformed, forged, signed by an unknown master key or expired"""
+    try:
+      key = str(key)
+    except UnicodeError:
+      return None
+    key_id, sep, payload = key.partition('.')
+    master = self.keys.get(key_id)
+    if master is None or not sep:
+      return None
+    try:
+      raw = _b64decode(payload)
+    except (TypeError, ValueError):
+      return None
+    if len(raw) < NONCE_LENGTH + HEADER.size + MAC_LENGTH:
+      return None
+    sealed, mac = raw[:-MAC_LENGTH], raw[-MAC_LENGTH:]
+    if not constant_time_compare(mac, master.mac(key_id + '.' + sealed)):
+      return None
+    nonce, cipher = sealed[:NONCE_LENGTH], sealed[NONCE_LENGTH:]
+    plain = _xor(cipher, master.keystream(nonce, len(cipher)))
+    issued, expires = HEADER.unpack(plain[:HEADER.size])
+    if expires <= (now or time.time()):
+      return None
+    return plain[HEADER.size:].decode('utf-8'), issued, expires, master.secret(key)
+
+
+class RevocationList(object):
+  """Revoked token keys held in memory until the tokens expire.
+
+  Each process has its own, use cycloauth.storage.mongodb.MongoRevocationList
+  to share revocations between processes.
+  """
+
+  def __init__(self, settings, storage):
+    self.revoked = {}
+    self.purge_interval = settings.get('oauth_revocation_purge_interval', 60)
+    self.next_purge = 0
+
+  def start(self):
+    return defer.succeed(None)
+
+  def stop(self):
+    return defer.succeed(None)
+
+  def purge(self, now):
+    for key, expires in self.revoked.items():
+      if expires <= now:
+        del self.revoked[key]
+    self.next_purge = now + self.purge_interval
+
+  def revoke(self, revocations):
+    "revokes (key, expiry) pairs, returns a deferred"
+    now = time.time()
+    if now >= self.next_purge:
+      self.purge(now)
+    self.revoked.update(revocations)
+    return defer.succeed(True)
+
+  def is_revoked(self, key):
+    return key in self.revoked
+
+
+class StatelessTokenStorage(CachingStorage):
+  """implements a storage whose access tokens are never stored
+
+  Access token keys carry their consumer key, issue time and expiry encrypted
+  and authenticated under a server master key (see TokenCodec), so verifying
+  a request decodes its token locally instead of looking it up; only the
+  revocation list, held by `oauth_revocation_list_factory`, is consulted.
+  Consumers and request tokens live in the storage named by
+  `oauth_cached_storage_factory`, with consumers cached as by CachingStorage.
+
+  Tokens are valid for `oauth_access_token_ttl` seconds and bound to the
+  consumer they were issued to. Removing an access token revokes it.
+  """
+
+  def __init__(self, settings):
+    CachingStorage.__init__(self, settings)
+    self.codec = TokenCodec(settings.get('oauth_token_master_keys', None), settings.get('oauth_token_key_id', None),
+                            settings.get('oauth_access_token_ttl', 30 * 86400))
+    factory_name = settings.get('oauth_revocation_list_factory', 'cycloauth.storage.stateless.RevocationList')
+    self.revocations = import_object(factory_name)(settings, self)
+
+  def start(self):
+    return CachingStorage.start(self).addCallback(lambda ignored: self.revocations.start())
+
+  def stop(self):
+    return self.revocations.stop().addCallback(lambda ignored: CachingStorage.stop(self))
+
+  def token(self, key, consumer_key=None):
+    "the access token with `key`, None when invalid, expired, revoked or not issued to `consumer_key`"
+    if key is None:
+      return None
+    decoded = self.codec.decode(key)
+    if decoded is None or (consumer_key is not None and decoded[0] != consumer_key):
+      return None
+    if self.revocations.is_revoked(key):
+      return None
+    return self.access_token_factory(key=key, secret=decoded[3], created=decoded[1], consumer_key=decoded[0])
+
+  def _issue(self, consumer_key, kwargs):
+    key, secret = self.codec.issue(consumer_key)
+    return self.access_token_factory(key=key, secret=secret, consumer_key=consumer_key, **kwargs)
+
+  def add_access_token(self, key=None, secret=None, consumer_key=None, **kwargs):
+    if key is not None or secret is not None:
+      return defer.fail(ValueError('stateless access tokens can not be given a key or secret'))
+    return defer.succeed(self._issue(consumer_key, kwargs))
+
+  def save_access_token(self, token):
+    # everything about the token is in its key
+    return defer.succeed(token)
+
+  def get_access_token(self, key):
+    return defer.succeed(self.token(key))
+
+  def get_access_tokens(self, keys):
+    return defer.succeed(dict((key, self.token(key)) for key in keys))
+
+  def access_token_consumer_key(self, key):
+    decoded = self.codec.decode(key) if key is not None else None
+    return decoded[0] if decoded is not None else None
+
+  def remove_access_token(self, key):
+    return self.remove_access_tokens([key])
+
+  def add_access_tokens(self, n, consumer_key=None, **kwargs):
+    return defer.succeed([self._issue(consumer_key, kwargs) for i in xrange(n)])
+
+  def save_access_tokens(self, tokens):
+    return defer.succeed(list(tokens))
+
+  def remove_access_tokens(self, keys):
+    revocations = []
+    for key in keys:
+      decoded = self.codec.decode(key)
+      if decoded is not None:
+        revocations.append((key, decoded[2]))
+    return self.revocations.revoke(revocations)
+
+  def get_consumer_and_token(self, consumer_key, token_key, token_type='access'):
+    if token_type != 'access':
+      return CachingStorage.get_consumer_and_token(self, consumer_key, token_key, token_type)
+    token = self.token(token_key, consumer_key)
+    return self.get_consumer(consumer_key).addCallback(lambda consumer: (consumer, token))
+
+  def get_consumer_and_token_nowait(self, consumer_key, token_key, token_type='access'):
+    "decodes the token, MISSING unless the consumer is cached"
+    if token_type != 'access':
+      return CachingStorage.get_consumer_and_token_nowait(self, consumer_key, token_key, token_type)
+    if not self.ttls['consumer']:
+      return MISSING
+    consumer = self.cache.get(('consumer', consumer_key))
+    if consumer is MISSING:
+      return MISSING
+    self.hits['consumer'] += 1
+    return (consumer, self.token(token_key, consumer_key))
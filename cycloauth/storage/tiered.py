@@ -0,0 +1,160 @@
+import datetime, time
+from twisted.internet import defer, task
+from twisted.python import log
+from cycloauth.keygen import generate_key
+from cycloauth.storage import get_consumer_and_token, get_many
+from cycloauth.storage.cache import CachingStorage
+from cycloauth.storage.mongodb import MongoDBStorage, ObjectId, is_collection_exists
+from cycloauth.utils import MISSING
+
+
+class TieredStorage(CachingStorage):
+  """implements an in-process cache in front of MongoDBStorage which is kept
+  coherent across nodes
+
+  Every write made through a node is recorded in a capped collection
+  (`oauth_invalidation_collection`) and each node polls it every
+  `oauth_invalidation_poll_interval` seconds, dropping the entries other nodes
+  changed. Reads are answered from the cache without any network call once
+  it is warm. If a node hasn't heard from the collection for
+  `oauth_invalidation_max_delay` seconds it empties its cache and reads
+  through to MongoDB until polling recovers, so a revocation never goes
+  unnoticed for longer than that.
+  """
+
+  default_storage_factory = 'cycloauth.storage.mongodb.MongoDBStorage'
+  # entries are invalidated when they change, the ttl only bounds memory
+  default_ttl = 3600
+
+  def __init__(self, settings):
+    CachingStorage.__init__(self, settings)
+    mongo = self.storage
+    while not isinstance(mongo, MongoDBStorage) and hasattr(mongo, 'storage'):
+      mongo = mongo.storage
+    if not isinstance(mongo, MongoDBStorage):
+      raise TypeError('TieredStorage requires oauth_cached_storage_factory to be a MongoDBStorage')
+    self.mongo = mongo
+    self.collection = settings.get('oauth_invalidation_collection', 'oauth_invalidations')
+    self.collection_size = settings.get('oauth_invalidation_collection_size', 8 << 20)
+    self.poll_interval = settings.get('oauth_invalidation_poll_interval', 1)
+    self.max_delay = settings.get('oauth_invalidation_max_delay', 5)
+    # how far back each poll looks, covering clock skew between nodes and slow writes
+    self.overlap = settings.get('oauth_invalidation_overlap', 30)
+    self.node_id = generate_key()
+    self.poller = None
+    self.last_poll = None
+    self.seen = set()
+    self.invalidation_metrics = dict(polls=0, poll_errors=0, published=0, received=0, flushes=0)
+
+  @defer.inlineCallbacks
+  def start(self):
+    yield CachingStorage.start(self)
+    db = yield self.mongo.db
+    try:
+      yield db.create_collection(self.collection, {'capped': True, 'size': self.collection_size})
+    except Exception, e:
+      if not is_collection_exists(e):
+        raise
+      # it already exists, which is the usual case, but polling an uncapped one
+      # would read an ever growing collection
+      options = yield self.mongo.mongo_call(self.collection, 'options')
+      if not options.get('capped', False):
+        raise ValueError('%s exists and is not capped, drop it for TieredStorage to create it' % self.collection)
+    if self.poller is None:
+      self.poller = task.LoopingCall(self.poll)
+      self.poller.start(self.poll_interval, now=True)
+
+  def stop(self):
+    if self.poller is not None and self.poller.running:
+      self.poller.stop()
+    self.poller = None
+    self.last_poll = None
+    return CachingStorage.stop(self)
+
+  def fresh(self):
+    "whether invalidations have been received recently enough for the cache to be used"
+    if self.last_poll is not None and time.time() - self.last_poll <= self.max_delay:
+      return True
+    if len(self.cache):
+      self.invalidation_metrics['flushes'] += 1
+    # lookups started while fresh mustn't be cached either
+    self._flush()
+    return False
+
+  @defer.inlineCallbacks
+  def poll(self):
+    "reads the invalidations recorded since the last poll and drops the affected entries"
+    started = time.time()
+    since = (self.last_poll or started) - self.overlap
+    spec = {'_id': {'$gt': ObjectId.from_datetime(datetime.datetime.utcfromtimestamp(since))}}
+    try:
+      docs = yield self.mongo.mongo_call(self.collection, 'find', spec, projection=['kind', 'keys', 'node'])
+    except Exception:
+      # the LoopingCall would stop on a failure, the cache is bypassed until a poll succeeds
+      self.invalidation_metrics['poll_errors'] += 1
+      log.err()
+      return
+    seen = set()
+    for doc in docs:
+      seen.add(doc['_id'])
+      if doc['_id'] in self.seen or doc.get('node') == self.node_id:
+        continue
+      self.invalidation_metrics['received'] += 1
+      self._invalidate_many(doc['kind'], doc['keys'])
+    # anything in the next window that was written before this poll is in this one
+    self.seen = seen
+    self.last_poll = started
+    self.invalidation_metrics['polls'] += 1
+
+  def publish(self, ret, kind, keys):
+    "records that `keys` changed so other nodes drop them, passes `ret` through"
+    if not self.ttls[kind]:
+      return ret
+    doc = {'_id': ObjectId(), 'kind': kind, 'keys': list(keys), 'node': self.node_id}
+    d = self.mongo.mongo_insert(self.collection, doc)
+    self.invalidation_metrics['published'] += 1
+    d.addErrback(log.err)
+    return d.addCallback(lambda r: ret)
+
+  def cache_stats(self):
+    ret = CachingStorage.cache_stats(self)
+    ret['invalidation'] = dict(self.invalidation_metrics)
+    ret['invalidation']['fresh'] = self.fresh()
+    return ret
+
+  def _get(self, kind, key, fetch):
+    if not self.fresh():
+      return fetch(key)
+    return CachingStorage._get(self, kind, key, fetch)
+
+  def _get_many(self, kind, keys):
+    if not self.fresh():
+      return get_many(self.storage, kind, keys)
+    return CachingStorage._get_many(self, kind, keys)
+
+  def _saved(self, ret, kind):
+    CachingStorage._saved(self, ret, kind)
+    return self.publish(ret, kind, [ret.key])
+
+  def _removed(self, ret, kind, key):
+    CachingStorage._removed(self, ret, kind, key)
+    return self.publish(ret, kind, [key])
+
+  def _saved_many(self, ret, kind):
+    for entity in ret:
+      CachingStorage._saved(self, entity, kind)
+    return self.publish(ret, kind, [entity.key for entity in ret])
+
+  def _removed_many(self, ret, kind, keys):
+    CachingStorage._removed_many(self, ret, kind, keys)
+    return self.publish(ret, kind, keys)
+
+  def get_consumer_and_token(self, consumer_key, token_key, token_type='access'):
+    if not self.fresh():
+      return get_consumer_and_token(self.storage, consumer_key, token_key, token_type)
+    return CachingStorage.get_consumer_and_token(self, consumer_key, token_key, token_type)
+
+  def get_consumer_and_token_nowait(self, consumer_key, token_key, token_type='access'):
+    if not self.fresh():
+      return MISSING
+    return CachingStorage.get_consumer_and_token_nowait(self, consumer_key, token_key, token_type)
@@ -0,0 +1,221 @@
+import time, functools
+from collections import deque
+from twisted.internet import defer
+from twisted.python import failure
+from zope.interface import implements
+from cycloauth.metrics import Histogram
+from cycloauth.storage import IStorage, get_many
+from cycloauth.utils import MISSING, import_object
+
+
+# the IStorage methods whose calls are traced
+TRACED_METHODS = (
+  'add_consumer', 'save_consumer', 'get_consumer', 'remove_consumer',
+  'add_request_token', 'save_request_token', 'get_request_token', 'consume_request_token',
+  'authorize_request_token', 'exchange_request_token', 'remove_request_token',
+  'add_access_token', 'save_access_token', 'get_access_token', 'remove_access_token',
+  'add_consumers', 'save_consumers', 'remove_consumers',
+  'add_access_tokens', 'save_access_tokens', 'remove_access_tokens',
+  'get_consumer_and_token', 'get_consumer_and_token_nowait', 'get_consumers', 'get_access_tokens',
+  'access_token_consumer_key')
+
+# the optional batch lookups, made with single ones when the wrapped storage lacks them
+BATCH_GETS = {'get_consumers': 'consumer', 'get_access_tokens': 'access_token'}
+
+
+class CallStats(object):
+  "latency, result size and error counts of one kind of call"
+  __slots__ = ('calls', 'errors', 'results', 'histogram')
+
+  def __init__(self):
+    self.calls = 0
+    self.errors = 0
+    self.results = 0
+    self.histogram = Histogram()
+
+  def record(self, seconds, results, error):
+    self.calls += 1
+    self.results += results
+    if error:
+      self.errors += 1
+    self.histogram.observe(seconds)
+
+  def to_dict(self):
+    h = self.histogram
+    return dict(calls=self.calls, errors=self.errors, results=self.results,
+                error_rate=float(self.errors) / self.calls if self.calls else 0.0,
+                mean=h.sum / h.count if h.count else None, p50=h.quantile(0.5), p99=h.quantile(0.99))
+
+
+def result_size(result):
+  "the number of consumers or tokens in a storage method's result"
+  if result is None or result is MISSING or isinstance(result, (bool, failure.Failure)):
+    return 0
+  if isinstance(result, dict):
+    return len([r for r in result.itervalues() if r is not None])
+  if isinstance(result, list):
+    return len(result)
+  if isinstance(result, tuple):
+    return len([r for r in result if r is not None])
+  return 1
+
+
+class TracingStorage(object):
+  """implements a wrapper recording every call made to another storage
+
+  Each IStorage method's calls are counted with their latency, the number of
+  consumers or tokens returned and errors, per endpoint when the storage is
+  used through `bind(endpoint)` as the provider's handlers do. Calls slower
+  than `oauth_trace_slow_threshold` seconds are kept in a rolling log of
+  `oauth_trace_slow_log_size` entries.
+
+  The wrapped storage's own methods are counted too, so calls it makes to
+  itself, such as the key collision checks of add_*, show up as hidden calls,
+  and so do the queries of a MongoDBStorage found underneath, by collection
+  and operation, index creation included.
+
+  Select it with `oauth_storage_factory = 'cycloauth.storage.tracing.TracingStorage'`
+  and name the storage it wraps in `oauth_traced_storage_factory`.
+  """
+  implements(IStorage)
+
+  def __init__(self, settings):
+    factory_name = settings.get('oauth_traced_storage_factory', 'cycloauth.storage.BaseStorage')
+    self.storage = import_object(factory_name)(settings)
+    self.slow_threshold = settings.get('oauth_trace_slow_threshold', 0.1)
+    self.slow_calls = deque(maxlen=settings.get('oauth_trace_slow_log_size', 100))
+    # (endpoint, method) -> CallStats
+    self.calls = {}
+    self.inner_calls = dict.fromkeys(TRACED_METHODS, 0)
+    # 'collection.operation' -> CallStats
+    self.mongo_calls = {}
+    for name in TRACED_METHODS:
+      if hasattr(self.storage, name):
+        setattr(self.storage, name, self._counting(name, getattr(self.storage, name)))
+    mongo = self.storage
+    while not hasattr(mongo, 'mongo_call') and hasattr(mongo, 'storage'):
+      mongo = mongo.storage
+    if hasattr(mongo, 'mongo_call'):
+      mongo.mongo_call = self._tracing_mongo(mongo, mongo.mongo_call)
+
+  @property
+  def request_token_factory(self):
+    return self.storage.request_token_factory
+
+  @property
+  def access_token_factory(self):
+    return self.storage.access_token_factory
+
+  @property
+  def consumer_factory(self):
+    return self.storage.consumer_factory
+
+  def start(self):
+    return self.storage.start()
+
+  def stop(self):
+    return self.storage.stop()
+
+  def request_token_stats(self):
+    return self.storage.request_token_stats()
+
+  def bind(self, endpoint):
+    "returns a view of this storage attributing its calls to `endpoint`"
+    return BoundTracingStorage(self, endpoint)
+
+  def _counting(self, name, method):
+    @functools.wraps(method)
+    def counted(*args, **kwargs):
+      self.inner_calls[name] += 1
+      return method(*args, **kwargs)
+    return counted
+
+  def _tracing_mongo(self, mongo, mongo_call):
+    @functools.wraps(mongo_call)
+    def traced(collection, method, *args, **kwargs):
+      if getattr(mongo, '_db', True) is None:
+        # waits for the connection then calls traced again
+        return mongo_call(collection, method, *args, **kwargs)
+      started = time.time()
+      d = mongo_call(collection, method, *args, **kwargs)
+      return d.addBoth(self._record_mongo, '%s.%s' % (collection, method), started)
+    return traced
+
+  def _record_mongo(self, result, name, started):
+    stats = self.mongo_calls.get(name)
+    if stats is None:
+      stats = self.mongo_calls[name] = CallStats()
+    stats.record(time.time() - started, 0, isinstance(result, failure.Failure))
+    return result
+
+  def call(self, endpoint, name, *args, **kwargs):
+    "calls the wrapped storage's `name` method, tracing it"
+    method = getattr(self.storage, name, None)
+    if method is None:
+      if name not in BATCH_GETS:
+        # only the *_nowait methods and access_token_consumer_key are optional
+        return MISSING
+      method = functools.partial(get_many, self.storage, BATCH_GETS[name])
+    started = time.time()
+    try:
+      ret = method(*args, **kwargs)
+    except Exception:
+      self._record(failure.Failure(), endpoint, name, args, started)
+      raise
+    if isinstance(ret, defer.Deferred):
+      return ret.addBoth(self._record, endpoint, name, args, started)
+    return self._record(ret, endpoint, name, args, started)
+
+  def _record(self, result, endpoint, name, args, started):
+    seconds = time.time() - started
+    error = isinstance(result, failure.Failure)
+    stats = self.calls.get((endpoint, name))
+    if stats is None:
+      stats = self.calls[(endpoint, name)] = CallStats()
+    stats.record(seconds, result_size(result), error)
+    if seconds >= self.slow_threshold:
+      # only the key is logged, the other arguments may be secrets
+      key = args[0] if args and isinstance(args[0], basestring) else None
+      self.slow_calls.append(dict(time=started, seconds=seconds, endpoint=endpoint, method=name, key=key,
+                                  error=result.getErrorMessage() if error else None))
+    return result
+
+  def hidden_calls(self):
+    "calls the wrapped storage made to its own methods, by method"
+    outer = dict.fromkeys(TRACED_METHODS, 0)
+    for (endpoint, name), stats in self.calls.iteritems():
+      outer[name] += stats.calls
+    return dict((name, n - outer[name]) for name, n in self.inner_calls.iteritems() if n > outer[name])
+
+  def trace_stats(self):
+    "returns the call statistics by endpoint and method, hidden calls, mongo queries and slow calls"
+    calls = {}
+    for (endpoint, name), stats in self.calls.iteritems():
+      calls.setdefault(endpoint, {})[name] = stats.to_dict()
+    return dict(calls=calls, hidden=self.hidden_calls(),
+                mongo=dict((name, stats.to_dict()) for name, stats in self.mongo_calls.iteritems()),
+                slow=list(self.slow_calls))
+
+
+def _traced(name):
+  def method(self, *args, **kwargs):
+    return self.call(None, name, *args, **kwargs)
+  method.__name__ = name
+  return method
+
+for _name in TRACED_METHODS:
+  setattr(TracingStorage, _name, _traced(_name))
+
+
+class BoundTracingStorage(object):
+  "a TracingStorage attributing every call to one endpoint"
+
+  def __init__(self, tracer, endpoint):
+    self.tracer = tracer
+    self.endpoint = endpoint
+    self.storage = tracer.storage
+
+  def __getattr__(self, name):
+    if name in TRACED_METHODS:
+      return functools.partial(self.tracer.call, self.endpoint, name)
+    return getattr(self.tracer, name)
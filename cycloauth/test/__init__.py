@@ -0,0 +1,23 @@
+"""The cycloauth tests, run them with `trial cycloauth.test`."""
+import time, urllib
+from cycloauth.keygen import random_hex
+from cycloauth.request import OAuthRequestParameters
+from cycloauth.signatures import HMAC_SHA1
+
+
+def signed_request(consumer, token=None, method='GET', path='/1/statuses.json', query='count=20', body=None,
+                   content_type=None, **oauth):
+  """the parameters of a request signed with HMAC-SHA1 by `consumer` and `token`,
+  any oauth_* parameters given as keywords replace the generated ones"""
+  params = dict(oauth_consumer_key=consumer.key, oauth_signature_method='HMAC-SHA1',
+                oauth_timestamp=str(int(time.time())), oauth_nonce=random_hex(16), oauth_version='1.0')
+  if token is not None:
+    params['oauth_token'] = token.key
+  params.update(oauth)
+  header = 'OAuth ' + ', '.join('%s="%s"' % (k, urllib.quote(v, safe='~')) for k, v in sorted(params.items()))
+  parts = (method, 'http', 'api.example.com', path, query)
+  headers = {'Content-Type': content_type} if content_type else {}
+  parsed = OAuthRequestParameters.from_parts(*(parts + (dict(headers, Authorization=header), body)))
+  signature = HMAC_SHA1().sign(parsed.base_string(), consumer.secret, token.secret if token else None)
+  header += ', oauth_signature="%s"' % urllib.quote(signature, safe='~')
+  return OAuthRequestParameters.from_parts(*(parts + (dict(headers, Authorization=header), body)))
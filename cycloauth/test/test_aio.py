@@ -0,0 +1,165 @@
+import time
+from twisted.internet import defer
+from twisted.trial import unittest
+from cycloauth.errors import Error, InvalidVerifier
+from cycloauth.utils import MISSING
+from cycloauth.test import signed_request
+from cycloauth.test.test_provider import authorization
+try:
+  from cycloauth import aio
+  from cycloauth.storage.aio import AsyncioStorage
+except ImportError:
+  aio = None
+  AsyncioStorage = object
+
+
+def parts(parsed, path='/1/statuses.json'):
+  "the request `parsed` as the parts AsyncioOAuthProvider takes"
+  return ('GET', 'http', 'api.example.com', path, 'count=20', {'Authorization': authorization(parsed)})
+
+
+class DelayedStorage(AsyncioStorage):
+  "an AsyncioStorage whose futures are resolved on a later loop iteration, and which never answers synchronously"
+
+  def __init__(self, settings):
+    AsyncioStorage.__init__(self, settings)
+    self.operations = 0
+
+  def get_consumer_and_token_nowait(self, consumer_key, token_key, token_type='access'):
+    return MISSING
+
+  def _future(self, d):
+    self.operations += 1
+    future = aio.asyncio.Future(loop=self.loop)
+    d.addCallbacks(lambda r: self.loop.call_soon(future.set_result, r),
+                   lambda f: self.loop.call_soon(future.set_exception, f.value))
+    return future
+
+
+class AsyncioProviderTest(unittest.TestCase):
+  if aio is None:
+    skip = 'needs asyncio or trollius'
+
+  storage_factory = 'cycloauth.storage.aio.AsyncioStorage'
+
+  def setUp(self):
+    self.loop = aio.asyncio.new_event_loop()
+    self.addCleanup(self.loop.close)
+    settings = {'oauth_request_token_reap_interval': 0, 'oauth_storage_factory': self.storage_factory,
+                'loop': self.loop}
+    self.provider = aio.AsyncioOAuthProvider(settings, loop=self.loop)
+    self.wait(self.provider.start())
+    storage = self.provider.storage
+    self.consumer = self.wait(storage.add_consumer(callback='http://example.com/cb'))
+
+  def wait(self, result):
+    "runs the loop until `result`, a future or fired Deferred, is ready"
+    if hasattr(result, 'addCallbacks'):
+      return self.successResultOf(result)
+    return self.loop.run_until_complete(result)
+
+  def test_dance(self):
+    request_token = self.wait(self.provider.request_token(*parts(signed_request(self.consumer, oauth_callback='oob'))))
+    self.assertEqual(request_token.callback, 'http://example.com/cb')
+    verifier = self.wait(self.provider.authorize(request_token.key)).verifier
+    wrong = signed_request(self.consumer, request_token, oauth_verifier='wrong')
+    self.assertRaises(InvalidVerifier, self.wait, self.provider.access_token(*parts(wrong)))
+    exchange = signed_request(self.consumer, request_token, oauth_verifier=verifier)
+    access_token = self.wait(self.provider.access_token(*parts(exchange)))
+    # exchanging removes the request token, so a fresh request for it finds none
+    again = signed_request(self.consumer, request_token, oauth_verifier=verifier)
+    e = self.assertRaises(Error, self.wait, self.provider.access_token(*parts(again)))
+    self.assertEqual(e.log_message, 'Unknown or expired oauth_token.')
+    consumer, token = self.wait(self.provider.verify_request(*parts(signed_request(self.consumer, access_token))))
+    self.assertEqual((consumer.key, token.key), (self.consumer.key, access_token.key))
+
+  def test_forged(self):
+    forged = self.provider.storage.consumer_factory(key=self.consumer.key, secret='wrong')
+    e = self.assertRaises(Error, self.wait, self.provider.verify_request(*parts(signed_request(forged))))
+    self.assertTrue(e.log_message.startswith('Invalid signature.'))
+
+  def test_introspect(self):
+    token = self.wait(self.provider.storage.add_access_token())
+    result = self.wait(self.provider.introspect([signed_request(self.consumer, token)]))
+    self.assertTrue(result[0]['valid'])
+
+
+class BaseStorageProviderTest(AsyncioProviderTest):
+  "the same, with the twisted in-memory storage and its fired Deferreds"
+  storage_factory = 'cycloauth.storage.BaseStorage'
+
+
+class DelayedStorageProviderTest(AsyncioProviderTest):
+  "the same, with a storage whose futures aren't done when returned"
+  storage_factory = 'cycloauth.test.test_aio.DelayedStorage'
+
+  def test_waits_on_futures(self):
+    token = self.wait(self.provider.storage.add_access_token())
+    operations = self.provider.storage.operations
+    future = self.provider.verify_request(*parts(signed_request(self.consumer, token)))
+    self.assertFalse(future.done())
+    self.assertEqual(self.wait(future)[1].key, token.key)
+    # consumer and token in a single get_consumer_and_token
+    self.assertEqual(self.provider.storage.operations - operations, 1)
+
+  def test_exchanged_once(self):
+    request_token = self.wait(self.provider.request_token(*parts(signed_request(self.consumer, oauth_callback='oob'))))
+    verifier = self.wait(self.provider.authorize(request_token.key)).verifier
+    first, second = [self.provider.access_token(*parts(signed_request(self.consumer, request_token,
+                                                                      oauth_verifier=verifier)))
+                     for i in range(2)]
+    # both have read the request token before either exchanges it
+    self.assertIn(self.wait(first).key, self.provider.storage.storage.access_tokens)
+    e = self.assertRaises(Error, self.wait, second)
+    self.assertEqual(e.log_message, 'The oauth_token has already been exchanged.')
+
+
+class AsyncioStorageTest(unittest.TestCase):
+  if aio is None:
+    skip = 'needs asyncio or trollius'
+
+  def setUp(self):
+    self.loop = aio.asyncio.new_event_loop()
+    self.addCleanup(self.loop.close)
+    self.storage = AsyncioStorage({'loop': self.loop, 'oauth_request_token_ttl': 60,
+                                   'oauth_request_token_reap_interval': 0.01})
+
+  def test_futures(self):
+    future = self.storage.add_consumer()
+    self.assertIsInstance(future, aio.asyncio.Future)
+    self.assertTrue(future.done())
+    consumer = future.result()
+    token = self.storage.add_access_token(consumer_key=consumer.key).result()
+    self.assertEqual(self.storage.get_consumer_and_token(consumer.key, token.key).result(), (consumer, token))
+    self.assertEqual(self.storage.get_consumer_and_token_nowait(consumer.key, token.key), (consumer, token))
+    self.assertEqual(self.storage.get_access_tokens([token.key, 'unknown']).result(),
+                     {token.key: token, 'unknown': None})
+    self.assertTrue(self.storage.remove_access_token(token.key).result())
+    self.assertIsNone(self.storage.get_access_token(token.key).result())
+
+  def test_request_tokens(self):
+    token = self.storage.add_request_token().result()
+    verifier = self.storage.authorize_request_token(token.key).result().verifier
+    self.assertEqual(self.storage.exchange_request_token(token.key, verifier).result().key, token.key)
+    self.assertIsNone(self.storage.exchange_request_token(token.key, verifier).result())
+
+  def test_failures(self):
+    self.storage.storage.add_access_token = lambda *args, **kwargs: defer.fail(ValueError('down'))
+    self.assertRaises(ValueError, self.storage.add_access_token().result)
+
+  def test_reaps_on_the_loop(self):
+    token = self.storage.add_request_token().result()
+    token.created = time.time() - 120
+    self.loop.run_until_complete(self.storage.start())
+    self.assertIsNotNone(self.storage.reaper)
+    self.loop.run_until_complete(aio.asyncio.sleep(0.05, loop=self.loop))
+    self.assertEqual(self.storage.storage.request_tokens, {})
+    self.loop.run_until_complete(self.storage.stop())
+    self.assertIsNone(self.storage.reaper)
+
+  def test_provider_start_and_stop(self):
+    provider = aio.AsyncioOAuthProvider({}, storage=self.storage, loop=self.loop)
+    self.storage.storage.start = lambda: defer.succeed('started')
+    self.storage.storage.stop = lambda: defer.succeed('stopped')
+    self.assertEqual(self.loop.run_until_complete(provider.start()), 'started')
+    self.assertEqual(self.loop.run_until_complete(provider.stop()), 'stopped')
@@ -0,0 +1,108 @@
+from twisted.internet import defer
+from twisted.trial import unittest
+from cycloauth.storage import BaseStorage
+from cycloauth.storage.cache import CachingStorage
+from cycloauth.utils import MISSING
+
+
+class SlowStorage(BaseStorage):
+  "a BaseStorage whose consumer lookups wait until the test fires them"
+
+  def __init__(self, settings):
+    BaseStorage.__init__(self, settings)
+    self.pending = []
+    self.lookups = 0
+
+  def get_consumer(self, key):
+    self.lookups += 1
+    d = defer.Deferred()
+    self.pending.append((d, key))
+    return d
+
+  def get_consumers(self, keys):
+    self.lookups += 1
+    d = defer.Deferred()
+    self.pending.append((d, keys))
+    return d
+
+  def fire(self):
+    while self.pending:
+      d, key = self.pending.pop(0)
+      if isinstance(key, list):
+        d.callback(dict((k, self.consumers.get(k, None)) for k in key))
+      else:
+        d.callback(self.consumers.get(key, None))
+
+
+class CachingStorageTest(unittest.TestCase):
+  def setUp(self):
+    self.storage = CachingStorage({'oauth_cached_storage_factory': 'cycloauth.test.test_cache.SlowStorage'})
+    self.inner = self.storage.storage
+    self.consumer = self.inner.consumer_factory(key='ck', secret='secret')
+    self.inner.save_consumer(self.consumer)
+
+  def get(self, key):
+    ret = []
+    self.storage.get_consumer(key).addCallback(ret.append)
+    self.inner.fire()
+    return ret[0]
+
+  def test_cached(self):
+    self.assertEqual(self.get(self.consumer.key), self.consumer)
+    self.assertEqual(self.get(self.consumer.key), self.consumer)
+    self.assertEqual(self.inner.lookups, 1)
+
+  def test_unrelated_write_keeps_fill(self):
+    d = self.storage.get_consumer(self.consumer.key)
+    self.storage.add_request_token()
+    self.storage.save_consumer(self.inner.consumer_factory(key='other', secret='secret'))
+    self.inner.fire()
+    self.assertEqual(self.successResultOf(d), self.consumer)
+    self.assertEqual(self.get(self.consumer.key), self.consumer)
+    self.assertEqual(self.inner.lookups, 1)
+
+  def test_write_to_same_key_drops_fill(self):
+    d = self.storage.get_consumer(self.consumer.key)
+    self.storage.remove_consumer(self.consumer.key)
+    self.inner.fire()
+    self.successResultOf(d)
+    self.assertIdentical(self.get(self.consumer.key), None)
+    self.assertEqual(self.inner.lookups, 2)
+
+  def test_lookup_after_write_is_cached(self):
+    first = self.storage.get_consumer(self.consumer.key)
+    self.storage.save_consumer(self.consumer)
+    second = self.storage.get_consumer(self.consumer.key)
+    self.inner.fire()
+    self.successResultOf(first)
+    self.successResultOf(second)
+    self.assertEqual(self.inner.lookups, 1)
+    self.assertEqual(self.storage.in_flight, {})
+    self.assertEqual(self.storage.invalidated, {})
+
+  def test_failed_lookup_not_cached(self):
+    d = self.storage.get_consumer(self.consumer.key)
+    self.inner.pending.pop()[0].errback(ValueError('down'))
+    self.failureResultOf(d, ValueError)
+    self.assertEqual(self.storage.in_flight, {})
+    self.assertEqual(self.get(self.consumer.key), self.consumer)
+
+  def test_batch_lookup(self):
+    d = self.storage.get_consumers([self.consumer.key, 'unknown'])
+    self.storage.remove_consumer('unknown')
+    self.inner.fire()
+    self.assertEqual(self.successResultOf(d), {self.consumer.key: self.consumer, 'unknown': None})
+    self.assertEqual(self.get(self.consumer.key), self.consumer)
+    self.assertEqual(self.inner.lookups, 1)
+    self.assertEqual(self.storage.in_flight, {})
+
+  def test_nowait_answers_once_cached(self):
+    token = self.successResultOf(self.inner.add_access_token())
+    self.assertIdentical(self.storage.get_consumer_and_token_nowait(self.consumer.key, token.key), MISSING)
+    self.get(self.consumer.key)
+    self.assertIdentical(self.storage.get_consumer_and_token_nowait(self.consumer.key, token.key), MISSING)
+    self.successResultOf(self.storage.get_access_token(token.key))
+    self.assertEqual(self.storage.get_consumer_and_token_nowait(self.consumer.key, token.key),
+                     (self.consumer, token))
+    self.storage.remove_access_token(token.key)
+    self.assertIdentical(self.storage.get_consumer_and_token_nowait(self.consumer.key, token.key), MISSING)
@@ -0,0 +1,29 @@
+from twisted.trial import unittest
+from cycloauth.storage.compact import PackedStorage
+
+
+class PackedStorageTest(unittest.TestCase):
+  def setUp(self):
+    self.storage = PackedStorage({})
+
+  def test_consumer_fields(self):
+    consumer = self.successResultOf(self.storage.add_consumer(callback='http://example.com/cb', rsa_key='PEM'))
+    ret = self.successResultOf(self.storage.get_consumer(consumer.key))
+    self.assertEqual((ret.secret, ret.callback, ret.rsa_key), (consumer.secret, 'http://example.com/cb', 'PEM'))
+
+  def test_token_verifier(self):
+    token = self.successResultOf(self.storage.add_access_token(verifier='v'))
+    ret = self.successResultOf(self.storage.get_access_token(token.key))
+    self.assertEqual((ret.secret, ret.verifier), (token.secret, 'v'))
+
+  def test_replaced_fields(self):
+    consumer = self.successResultOf(self.storage.add_consumer(rsa_key='PEM'))
+    consumer.rsa_key = None
+    self.storage.save_consumer(consumer)
+    self.assertEqual(self.successResultOf(self.storage.get_consumer(consumer.key)).rsa_key, None)
+    self.storage.consumers.compact()
+    self.assertEqual(self.successResultOf(self.storage.get_consumer(consumer.key)).secret, consumer.secret)
+
+  def test_refuses_non_strings(self):
+    consumer = self.storage.consumer_factory(key='ck', secret='secret', rsa_key=object())
+    self.assertRaises(TypeError, self.storage.save_consumer, consumer)
@@ -0,0 +1,133 @@
+import time
+import oauth2
+from twisted.internet import defer
+from twisted.trial import unittest
+from cycloauth import core
+from cycloauth.errors import Error, NOnceReplayed
+from cycloauth.metrics import Metrics
+from cycloauth.nonce import MemoryNOnceStore
+from cycloauth.signatures import HMAC_SHA1
+from cycloauth.storage import BaseStorage, run_deferred, get_consumer_and_token, get_many
+from cycloauth.test import signed_request
+
+
+class SeparateStorage(object):
+  "a storage with only single-entity lookups, which wait until the test fires them"
+
+  def __init__(self):
+    self.pending = []
+
+  def get(self, kind, key):
+    d = defer.Deferred()
+    self.pending.append((d, (kind, key)))
+    return d
+
+  def get_consumer(self, key):
+    return self.get('consumer', key)
+
+  def get_access_token(self, key):
+    return self.get('access_token', key)
+
+  def fire(self):
+    while self.pending:
+      d, value = self.pending.pop(0)
+      d.callback(value)
+
+
+class GetConsumerAndTokenTest(unittest.TestCase):
+  def setUp(self):
+    self.storage = SeparateStorage()
+
+  def test_lookups_at_once(self):
+    d = run_deferred(core.get_consumer_and_token(self.storage, 'ck', 'tk'))
+    self.assertEqual(len(self.storage.pending), 2)
+    self.storage.fire()
+    self.assertEqual(self.successResultOf(d), (('consumer', 'ck'), ('access_token', 'tk')))
+
+  def test_failure(self):
+    d = run_deferred(core.get_consumer_and_token(self.storage, 'ck', 'tk'))
+    self.storage.pending.pop(1)[0].errback(ValueError('down'))
+    self.storage.fire()
+    self.failureResultOf(d, ValueError)
+
+  def test_metrics(self):
+    metrics = Metrics()
+    d = run_deferred(core.get_consumer_and_token(self.storage, 'ck', 'tk', metrics=metrics))
+    self.storage.fire()
+    self.successResultOf(d)
+    self.assertEqual(metrics.histograms['consumer_fetch'].count, 1)
+    self.assertEqual(metrics.histograms['token_fetch'].count, 1)
+
+  def test_storage_helpers(self):
+    d = get_consumer_and_token(self.storage, 'ck', 'tk')
+    self.assertEqual(len(self.storage.pending), 2)
+    self.storage.fire()
+    self.assertEqual(self.successResultOf(d), (('consumer', 'ck'), ('access_token', 'tk')))
+    d = get_many(self.storage, 'consumer', ['a', 'b'])
+    self.assertEqual(len(self.storage.pending), 2)
+    self.storage.fire()
+    self.assertEqual(self.successResultOf(d), {'a': ('consumer', 'a'), 'b': ('consumer', 'b')})
+
+
+class CountingHMAC_SHA1(oauth2.SignatureMethod_HMAC_SHA1):
+  "a python-oauth2 signature method, as applications wrote them"
+  checked = 0
+
+  def check(self, request, consumer, token, signature):
+    CountingHMAC_SHA1.checked += 1
+    return oauth2.SignatureMethod_HMAC_SHA1.check(self, request, consumer, token, signature)
+
+
+class OAuth2SignatureMethodTest(unittest.TestCase):
+  def setUp(self):
+    self.storage = BaseStorage({})
+    self.consumer = self.successResultOf(self.storage.add_consumer())
+    self.token = self.successResultOf(self.storage.add_access_token())
+    self.core = core.OAuthCore({}, self.storage, MemoryNOnceStore({}), {'HMAC-SHA1': CountingHMAC_SHA1()})
+    self.patch(CountingHMAC_SHA1, 'checked', 0)
+
+  def test_accepted(self):
+    parsed = signed_request(self.consumer, self.token, query='count=20&id=1&id=2')
+    self.assertEqual(core.run_sync(self.core.verify(parsed)), (self.consumer, self.token))
+    self.assertEqual(CountingHMAC_SHA1.checked, 1)
+
+  def test_forged(self):
+    forged = self.storage.consumer_factory(key=self.consumer.key, secret='wrong')
+    self.assertRaises(Error, core.run_sync, self.core.verify(signed_request(forged, self.token)))
+    self.assertEqual(CountingHMAC_SHA1.checked, 1)
+
+
+class CheckNonceTest(unittest.TestCase):
+  def setUp(self):
+    self.core = core.OAuthCore({}, BaseStorage({}), MemoryNOnceStore({}), {})
+
+  def test_replayed(self):
+    timestamp = str(int(time.time()))
+    core.run_sync(self.core.check_nonce('ck', 'n', timestamp))
+    self.assertRaises(NOnceReplayed, core.run_sync, self.core.check_nonce('ck', 'n', timestamp))
+    core.run_sync(self.core.check_nonce('other', 'n', timestamp))
+
+
+class VerifierTest(unittest.TestCase):
+  def test_matches(self):
+    self.assertTrue(core.verifier_matches('1234', '1234'))
+    self.assertTrue(core.verifier_matches('1234', u'1234'))
+    self.assertFalse(core.verifier_matches('1235', '1234'))
+    self.assertFalse(core.verifier_matches('123', '1234'))
+    self.assertFalse(core.verifier_matches('', None))
+
+  def test_compares_in_constant_time(self):
+    compared = []
+    def compare(a, b):
+      compared.append((a, b))
+      return a == b
+    self.patch(core, 'constant_time_compare', compare)
+    storage = BaseStorage({'oauth_request_token_reap_interval': 0})
+    consumer = self.successResultOf(storage.add_consumer())
+    token = self.successResultOf(storage.add_request_token())
+    verifier = self.successResultOf(storage.authorize_request_token(token.key)).verifier
+    c = core.OAuthCore({}, storage, MemoryNOnceStore({}), {'HMAC-SHA1': HMAC_SHA1()})
+    parsed = signed_request(consumer, token, oauth_verifier=verifier)
+    self.successResultOf(run_deferred(c.access_token(parsed)))
+    # by the core, then by the storage exchanging the token
+    self.assertEqual(compared, [(verifier, verifier)] * 2)
@@ -0,0 +1,102 @@
+import json, urllib
+import cyclone.web
+from cyclone.httputil import HTTPHeaders
+from cyclone.testing import Client
+from twisted.trial import unittest
+from cycloauth import provider
+from cycloauth.core import OAuthCore
+from cycloauth.nonce import MemoryNOnceStore
+from cycloauth.signatures import HMAC_SHA1
+from cycloauth.storage import BaseStorage, run_deferred
+from cycloauth.storage.cache import CachingStorage
+from cycloauth.storage.stateless import StatelessTokenStorage
+from cycloauth.test import signed_request
+from cycloauth.test.test_mongodb import fake_storage
+
+
+SETTINGS = {'oauth_token_master_keys': {'k1': 'master secret'}, 'oauth_request_token_reap_interval': 0}
+
+
+class IntrospectTest(unittest.TestCase):
+  storage_factory = StatelessTokenStorage
+
+  def setUp(self):
+    self.storage = self.storage_factory(SETTINGS)
+    self.core = OAuthCore(SETTINGS, self.storage, MemoryNOnceStore(SETTINGS), {'HMAC-SHA1': HMAC_SHA1()})
+    self.a = self.successResultOf(self.storage.add_consumer())
+    self.b = self.successResultOf(self.storage.add_consumer())
+    self.token = self.successResultOf(self.storage.add_access_token(consumer_key=self.a.key))
+
+  def introspect(self, *items):
+    return [r['valid'] for r in self.successResultOf(run_deferred(self.core.introspect(items)))]
+
+  def test_pairs_bound_to_consumer(self):
+    self.assertEqual(self.introspect((self.token.key, self.a.key), (self.token.key, self.b.key),
+                                     (self.token.key, None)), [True, False, True])
+
+  def test_requests_bound_to_consumer(self):
+    self.assertEqual(self.introspect(signed_request(self.a, self.token), signed_request(self.b, self.token)),
+                     [True, False])
+
+
+class BaseStorageIntrospectTest(IntrospectTest):
+  "tokens bound to their consumer by the in-memory storage"
+  storage_factory = BaseStorage
+
+
+class CachingStorageIntrospectTest(IntrospectTest):
+  storage_factory = CachingStorage
+
+
+class MongoIntrospectTest(IntrospectTest):
+  "tokens bound to their consumer by MongoDBStorage, on a fake database"
+  storage_factory = staticmethod(fake_storage)
+
+  def test_consumer_key_stored(self):
+    doc = self.storage._db.docs[self.storage.access_token_collection][0]
+    self.assertEqual(doc['consumer_key'], self.a.key)
+    self.assertEqual(self.successResultOf(self.storage.get_access_token(self.token.key)).consumer_key, self.a.key)
+
+  def test_legacy_tokens_in_one_pass(self):
+    docs = self.storage._db.docs[self.storage.access_token_collection]
+    del docs[0]['consumer_key']
+    del self.storage._db.calls[:]
+    self.assertEqual(self.introspect((self.token.key, self.a.key), (self.token.key, self.b.key)), [True, True])
+    self.assertEqual([op for op, c, spec, kwargs in self.storage._db.calls if c == self.storage.access_token_collection],
+                     ['find'])
+
+
+class Application(cyclone.web.Application, provider.OAuthApplicationMixin):
+  pass
+
+
+class IntrospectionHandlerTest(unittest.TestCase):
+  def setUp(self):
+    settings = dict(SETTINGS, oauth_storage_factory='cycloauth.storage.stateless.StatelessTokenStorage',
+                    oauth_introspection=True, oauth_introspection_secret='s3cret',
+                    oauth_introspection_max_body=4096)
+    self.app = Application(provider.handlers(settings), **settings)
+    self.client = Client(self.app)
+    storage = self.app.oauth_storage
+    self.consumer = self.successResultOf(storage.add_consumer())
+    self.token = self.successResultOf(storage.add_access_token(consumer_key=self.consumer.key))
+
+  def post(self, body, authorization='Bearer s3cret'):
+    headers = HTTPHeaders({'authorization': authorization})
+    return self.successResultOf(self.client.post('/oauth/introspect', headers=headers, body=body))
+
+  def test_requires_secret(self):
+    self.assertRaises(ValueError, provider.handlers, {'oauth_introspection': True})
+    self.assertEqual(self.post('{"items": []}', 'Bearer wrong').get_status(), 403)
+
+  def test_body_size(self):
+    body = json.dumps({'items': [{'token': self.token.key}] * 100})
+    self.assertEqual(self.post(body).get_status(), 413)
+
+  def test_request_headers_any_case(self):
+    oauth = signed_request(self.consumer, self.token).oauth
+    header = 'OAuth ' + ', '.join('%s="%s"' % (k, urllib.quote(v, safe='~')) for k, v in sorted(oauth.items()))
+    item = {'request': {'host': 'api.example.com', 'path': '/1/statuses.json', 'query': 'count=20',
+                        'headers': {'authorization': header}}}
+    response = self.post(json.dumps({'items': [item, {'token': self.token.key, 'consumer_key': self.consumer.key}]}))
+    self.assertEqual([r['valid'] for r in json.loads(response.content)['results']], [True, True])
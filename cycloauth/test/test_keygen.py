@@ -0,0 +1,25 @@
+import os
+from twisted.trial import unittest
+from cycloauth.keygen import KeyPool
+
+
+class KeyPoolTest(unittest.TestCase):
+  def test_never_repeats(self):
+    pool = KeyPool(size=64)
+    keys = [pool.get(32) for i in xrange(10)]
+    self.assertEqual(len(set(keys)), 10)
+    self.assertEqual(set(len(k) for k in keys), set([32]))
+
+  def test_fork_discards_buffer(self):
+    pool = KeyPool()
+    pool.get(32)
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+      os.write(write, pool.get(32))
+      os._exit(0)
+    os.waitpid(pid, 0)
+    child = os.read(read, 32)
+    os.close(read)
+    os.close(write)
+    self.assertNotEqual(child, pool.get(32))
@@ -0,0 +1,122 @@
+import os, shutil, tempfile
+from twisted.internet import defer
+from twisted.trial import unittest
+from cycloauth.storage.logfile import LogFile, LogStorage, KIND_CONSUMER, OP_PUT, OP_DELETE, INDEX_HEADER, \
+  INDEX_MAGIC
+
+
+class LogFileRecoveryTest(unittest.TestCase):
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.path)
+
+  def fill(self, log, n=200):
+    for i in xrange(n):
+      log.append(KIND_CONSUMER, OP_PUT, 'key%d' % i, 'value%d' % i)
+    log.append(KIND_CONSUMER, OP_PUT, 'key0', 'replaced')
+    log.append(KIND_CONSUMER, OP_DELETE, 'key1')
+
+  def assertRecovered(self, log, n=200):
+    self.assertEqual(log.lookup(KIND_CONSUMER, 'key0'), 'replaced')
+    self.assertEqual(log.lookup(KIND_CONSUMER, 'key1'), None)
+    for i in xrange(2, n):
+      self.assertEqual(log.lookup(KIND_CONSUMER, 'key%d' % i), 'value%d' % i)
+    self.assertEqual(sorted(log.keys(KIND_CONSUMER)), sorted('key%d' % i for i in xrange(n) if i != 1))
+
+  def test_rebuild_missing_index(self):
+    log = LogFile(self.path, index_slots=16)
+    self.fill(log)
+    log_size = log.log_size
+    log.close()
+    os.close(log.lock_fd)
+    os.unlink(log.index_path)
+    log = LogFile(self.path, index_slots=16)
+    # the records are indexed where they are, not appended again
+    self.assertEqual(log.log_size, log_size)
+    self.assertEqual(log.used, 200)
+    self.assertTrue(log.used * 10 <= log.slots * 7)
+    self.assertRecovered(log)
+    log.close()
+
+  def test_recover_uncommitted_records(self):
+    log = LogFile(self.path, index_slots=512)
+    log.append(KIND_CONSUMER, OP_PUT, 'key0', 'value0')
+    committed = log.log_size, log.used
+    self.fill(log)
+    log_size = log.log_size
+    # a crash after the records and their slots were written but before the header
+    INDEX_HEADER.pack_into(log.index_mm, 0, INDEX_MAGIC, log.generation, log.slots, committed[1], committed[0], 0)
+    log.close()
+    os.close(log.lock_fd)
+    log = LogFile(self.path, index_slots=512)
+    self.assertEqual(log.log_size, log_size)
+    self.assertEqual(log.used, 200)
+    self.assertRecovered(log)
+    log.close()
+
+  @defer.inlineCallbacks
+  def test_compaction_interrupted(self):
+    log = LogFile(self.path, index_slots=512)
+    self.fill(log)
+    for i in xrange(2, 100):
+      log.append(KIND_CONSUMER, OP_DELETE, 'key%d' % i)
+
+    def crash(path, buf):
+      raise IOError('crashed')
+    # the compacted log is in place but its index never was
+    self.patch(log, '_write_index', crash)
+    yield self.assertFailure(log.compact(), IOError)
+    log.close()
+    os.close(log.lock_fd)
+    self.assertRaises(IOError, LogFile, self.path, readonly=True)
+    log = LogFile(self.path, index_slots=512)
+    self.assertEqual(log.generation, 1)
+    self.assertEqual(log.lookup(KIND_CONSUMER, 'key0'), 'replaced')
+    self.assertEqual(sorted(log.keys(KIND_CONSUMER)), sorted(['key0'] + ['key%d' % i for i in xrange(100, 200)]))
+    reader = LogFile(self.path, readonly=True)
+    self.assertEqual(reader.lookup(KIND_CONSUMER, 'key150'), 'value150')
+    reader.close()
+    log.close()
+
+  @defer.inlineCallbacks
+  def test_reader_follows_compaction(self):
+    log = LogFile(self.path, index_slots=512)
+    self.fill(log)
+    reader = LogFile(self.path, readonly=True)
+    self.assertEqual(reader.lookup(KIND_CONSUMER, 'key2'), 'value2')
+    yield log.compact()
+    self.assertEqual((reader.generation, log.generation), (0, 1))
+    self.assertRecovered(reader)
+    self.assertEqual(reader.generation, 1)
+    log.append(KIND_CONSUMER, OP_PUT, 'new', 'value')
+    self.assertEqual(reader.lookup(KIND_CONSUMER, 'new'), 'value')
+    reader.close()
+    log.close()
+
+
+class LogStorageTest(unittest.TestCase):
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.path)
+    self.storage = self.open()
+
+  def open(self, readonly=False):
+    storage = LogStorage({'oauth_log_storage_path': self.path, 'oauth_log_storage_readonly': readonly,
+                          'oauth_request_token_reap_interval': 0})
+    self.addCleanup(storage.log.close)
+    return storage
+
+  def test_fields_kept(self):
+    consumer = self.successResultOf(self.storage.add_consumer(callback='http://example.com/cb',
+                                                              rsa_key='-----BEGIN PUBLIC KEY-----'))
+    token = self.successResultOf(self.storage.add_access_token())
+    token.verifier = 'verifier'
+    self.successResultOf(self.storage.save_access_token(token))
+    reader = self.open(readonly=True)
+    stored = reader.consumers[consumer.key]
+    self.assertEqual((stored.secret, stored.callback, stored.rsa_key),
+                     (consumer.secret, 'http://example.com/cb', '-----BEGIN PUBLIC KEY-----'))
+    stored = reader.access_tokens[token.key]
+    self.assertEqual((stored.secret, stored.verifier, stored.callback), (token.secret, 'verifier', None))
+    self.assertEqual(stored.created, token.created)
+    self.assertNotIn('unknown', reader.access_tokens)
@@ -0,0 +1,61 @@
+from cyclone.testing import Client
+from twisted.trial import unittest
+from cycloauth import core, provider
+from cycloauth.errors import Error
+from cycloauth.metrics import Histogram, Metrics
+from cycloauth.test import signed_request
+from cycloauth.test.test_provider import Application, SETTINGS
+
+
+class HistogramTest(unittest.TestCase):
+  def test_buckets(self):
+    h = Histogram((0.001, 0.01, 0.1))
+    for value in (0.0005, 0.001, 0.005, 0.05, 1.0):
+      h.observe(value)
+    self.assertEqual(h.cumulative(), [(0.001, 2), (0.01, 3), (0.1, 4), ('+Inf', 5)])
+    self.assertEqual((h.count, h.sum), (5, 1.0565))
+    self.assertEqual(h.quantile(0.5), 0.01)
+    self.assertEqual(h.quantile(1), '+Inf')
+    self.assertIdentical(Histogram().quantile(0.5), None)
+
+
+class MetricsTest(unittest.TestCase):
+  def setUp(self):
+    self.app = Application([], **dict(SETTINGS, oauth_metrics=True))
+    self.metrics = self.app.oauth_metrics
+    self.consumer = self.successResultOf(self.app.oauth_storage.add_consumer())
+    self.token = self.successResultOf(self.app.oauth_storage.add_access_token())
+
+  def test_disabled(self):
+    self.assertIdentical(Application([], **SETTINGS).oauth_metrics, None)
+
+  def test_stages_observed(self):
+    observed = []
+    self.metrics.add_hook(lambda stage, seconds: observed.append(stage))
+    core.run_sync(self.app.oauth_core.verify(signed_request(self.consumer, self.token)))
+    self.assertEqual(sorted(set(observed)), ['consumer_and_token_fetch', 'nonce', 'signature', 'timestamp', 'verify'])
+    self.assertEqual(self.metrics.summary()['verify']['count'], 1)
+
+  def test_failures_counted(self):
+    forged = self.app.oauth_storage.consumer_factory(key=self.consumer.key, secret='wrong')
+    self.assertRaises(Error, core.run_sync, self.app.oauth_core.verify(signed_request(forged)))
+    self.assertEqual(self.metrics.failures, {'Error': 1})
+    self.assertNotIn('verify', self.metrics.summary())
+
+  def test_prometheus_text(self):
+    self.metrics.observe('signature', 0.0003)
+    self.metrics.fail('Error')
+    text = self.metrics.prometheus_text()
+    self.assertIn('cycloauth_stage_seconds_bucket{stage="signature",le="0.0005"} 1\n', text)
+    self.assertIn('cycloauth_stage_seconds_count{stage="signature"} 1\n', text)
+    self.assertIn('cycloauth_verify_failures_total{reason="Error"} 1\n', text)
+
+
+class MetricsHandlerTest(unittest.TestCase):
+  def test_served(self):
+    settings = dict(SETTINGS, oauth_metrics=True)
+    app = Application(provider.handlers(settings), **settings)
+    app.oauth_metrics.observe('parse', 0.00001)
+    response = self.successResultOf(Client(app).get('/oauth/metrics', {}))
+    self.assertEqual(response.get_status(), 200)
+    self.assertIn('cycloauth_stage_seconds_count{stage="parse"} 1\n', response.content)
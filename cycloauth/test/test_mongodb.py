@@ -0,0 +1,495 @@
+import copy, datetime, time
+from pymongo.collection import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.results import BulkWriteResult, InsertManyResult, InsertOneResult, UpdateResult
+from twisted.internet import defer
+from twisted.trial import unittest
+from cycloauth.storage import mongodb
+from cycloauth.storage.mongodb import MongoDBStorage, MongoNOnceStore, ObjectId
+
+
+def matches(doc, spec):
+  "whether `doc` matches a query of equalities, $in, $gt, $lte and $or"
+  for k, cond in (spec or {}).iteritems():
+    if k == '$or':
+      if not any(matches(doc, s) for s in cond):
+        return False
+      continue
+    value = doc.get(k, None)
+    if isinstance(cond, dict) and cond and all(op.startswith('$') for op in cond):
+      for op, arg in cond.iteritems():
+        if op == '$in' and value not in arg:
+          return False
+        if op == '$gt' and (value is None or not value > arg):
+          return False
+        if op == '$lte' and (value is None or not value <= arg):
+          return False
+    elif value != cond:
+      return False
+  return True
+
+
+class FakeCollection(object):
+  """an in-memory collection with unique _id and key fields, recording index
+  operations and failing creation of indexes listed in `conflicts` once"""
+
+  def __init__(self, db, name):
+    self.db = db
+    self.name = name
+    self.docs = db.docs.setdefault(name, [])
+
+  def _check_unique(self, doc, ignore=None):
+    for other in self.docs:
+      if other is ignore:
+        continue
+      if other['_id'] == doc['_id'] or (doc.get('key', None) is not None and other.get('key', None) == doc['key']):
+        raise DuplicateKeyError('E11000 duplicate key error', 11000)
+
+  def insert_one(self, doc):
+    self.db.calls.append(('insert_one', self.name, None, {}))
+    doc = copy.deepcopy(doc)
+    doc.setdefault('_id', ObjectId())
+    self._check_unique(doc)
+    self.docs.append(doc)
+    return defer.succeed(InsertOneResult(doc['_id'], True))
+
+  def insert_many(self, docs, ordered=True):
+    self.db.calls.append(('insert_many', self.name, None, {'ordered': ordered}))
+    ret = []
+    for i, doc in enumerate(docs):
+      doc = copy.deepcopy(doc)
+      doc.setdefault('_id', ObjectId())
+      try:
+        self._check_unique(doc)
+      except DuplicateKeyError, e:
+        # like mongod, the documents before a collision stay inserted
+        raise BulkWriteError({'writeErrors': [{'index': i, 'code': e.code, 'errmsg': str(e)}]})
+      self.docs.append(doc)
+      ret.append(doc['_id'])
+    return defer.succeed(InsertManyResult(ret, True))
+
+  def find(self, spec=None, projection=None, **kwargs):
+    self.db.calls.append(('find', self.name, spec, {}))
+    return defer.succeed([copy.deepcopy(d) for d in self.docs if matches(d, spec)])
+
+  def find_one(self, spec=None, **kwargs):
+    found = [d for d in self.docs if matches(d, spec)]
+    return defer.succeed(copy.deepcopy(found[0]) if found else None)
+
+  def count(self, spec=None, **kwargs):
+    return defer.succeed(len([d for d in self.docs if matches(d, spec)]))
+
+  def _modify(self, spec, document, upsert):
+    "applies a $set update to the first match, returns (old, new) documents"
+    found = [d for d in self.docs if matches(d, spec)]
+    if found:
+      old = copy.deepcopy(found[0])
+      updated = dict(found[0], **document.get('$set', {}))
+      self._check_unique(updated, found[0])
+      found[0].update(document.get('$set', {}))
+      return old, found[0]
+    if not upsert:
+      return None, None
+    doc = dict((k, v) for k, v in spec.iteritems() if not isinstance(v, dict))
+    doc.update(document.get('$set', {}))
+    doc.setdefault('_id', ObjectId())
+    self._check_unique(doc)
+    self.docs.append(doc)
+    return None, doc
+
+  def update_one(self, spec, document, upsert=False):
+    self.db.calls.append(('update_one', self.name, spec, {'upsert': upsert}))
+    try:
+      self._modify(spec, document, upsert)
+    except OperationFailure:
+      return defer.fail()
+    return defer.succeed(UpdateResult({}, True))
+
+  def update_many(self, spec, document):
+    self.db.calls.append(('update_many', self.name, spec, {}))
+    for doc in [d for d in self.docs if matches(d, spec)]:
+      doc.update(document['$set'])
+    return defer.succeed(UpdateResult({}, True))
+
+  def bulk_write(self, requests, ordered=True):
+    self.db.calls.append(('bulk_write', self.name, None, {'ordered': ordered}))
+    upserted = []
+    for i, op in enumerate(requests):
+      old, doc = self._modify(op._filter, op._doc, op._upsert)
+      if old is None and doc is not None:
+        upserted.append({'index': i, '_id': doc['_id']})
+    return defer.succeed(BulkWriteResult({'upserted': upserted}, True))
+
+  def find_one_and_delete(self, spec, projection=None):
+    self.db.calls.append(('find_one_and_delete', self.name, spec, {}))
+    found = [d for d in self.docs if matches(d, spec)]
+    if found:
+      self.docs.remove(found[0])
+    return defer.succeed(found[0] if found else None)
+
+  def find_one_and_update(self, spec, update, projection=None, upsert=False,
+                          return_document=ReturnDocument.BEFORE):
+    self.db.calls.append(('find_one_and_update', self.name, spec, {}))
+    try:
+      old, doc = self._modify(spec, update, upsert)
+    except OperationFailure:
+      return defer.fail()
+    return defer.succeed(copy.deepcopy(doc if return_document == ReturnDocument.AFTER else old))
+
+  def delete_many(self, spec):
+    self.db.calls.append(('delete_many', self.name, spec, {}))
+    self.docs[:] = [d for d in self.docs if not matches(d, spec)]
+    return defer.succeed(True)
+
+  def create_index(self, fields, **kwargs):
+    orderby = [tuple(f) for f in fields['orderby']]
+    self.db.calls.append(('create_index', self.name, orderby, kwargs))
+    if (self.name, orderby) in self.db.conflicts:
+      self.db.conflicts.remove((self.name, orderby))
+      return defer.fail(OperationFailure('Index with name: key_1 already exists with different options', 85))
+    if (self.name, orderby) in self.db.broken:
+      return defer.fail(OperationFailure('E11000 duplicate key error', 11000))
+    return defer.succeed(True)
+
+  def options(self):
+    return defer.succeed(dict(self.db.options.get(self.name, {})))
+
+  def drop_index(self, fields):
+    self.db.calls.append(('drop_index', self.name, [tuple(f) for f in fields['orderby']], {}))
+    return defer.succeed(True)
+
+
+class FakeDatabase(object):
+  def __init__(self):
+    self.docs = {}
+    self.calls = []
+    self.conflicts = []
+    self.broken = []
+    self.options = {}
+    self.failures = {}
+
+  def __getattr__(self, name):
+    return FakeCollection(self, name)
+
+  def create_collection(self, name, options=None):
+    self.calls.append(('create_collection', name, None, options or {}))
+    if name in self.docs:
+      return defer.fail(OperationFailure('collection already exists', 48))
+    if name in self.failures:
+      return defer.fail(self.failures[name])
+    self.docs[name] = []
+    self.options[name] = dict(options or {})
+    return defer.succeed(FakeCollection(self, name))
+
+
+def fake_storage(settings=None):
+  "a MongoDBStorage connected to a FakeDatabase"
+  storage = MongoDBStorage(settings or {})
+  storage._db = FakeDatabase()
+  return storage
+
+
+class MongoIndexTest(unittest.TestCase):
+  def setUp(self):
+    self.storage = MongoDBStorage({})
+    self.storage._db = self.db = FakeDatabase()
+
+  def test_creates_indexes(self):
+    self.assertTrue(self.successResultOf(self.storage.ensure_indexes()))
+    created = [(c, fields, kwargs) for op, c, fields, kwargs in self.db.calls]
+    self.assertIn((self.storage.consumer_collection, [('key', 1)], {'unique': True}), created)
+
+  def test_conflicting_index_fails(self):
+    self.db.conflicts.append((self.storage.consumer_collection, [('key', 1)]))
+    self.failureResultOf(self.storage.ensure_indexes(), OperationFailure)
+    self.assertNotIn('drop_index', [op for op, c, fields, kwargs in self.db.calls])
+
+  def test_replaces_conflicting_index(self):
+    self.storage.settings['oauth_mongo_replace_conflicting_indexes'] = True
+    self.db.conflicts.append((self.storage.consumer_collection, [('key', 1)]))
+    self.successResultOf(self.storage.ensure_indexes())
+    consumers = [(op, kwargs) for op, c, fields, kwargs in self.db.calls if c == self.storage.consumer_collection]
+    self.assertEqual(consumers, [('create_index', {'unique': True}), ('drop_index', {}),
+                                 ('create_index', {'unique': True})])
+
+  def test_failure_is_not_swallowed(self):
+    self.db.broken.append((self.storage.consumer_collection, [('key', 1)]))
+    self.failureResultOf(self.storage.ensure_indexes(), OperationFailure)
+
+
+class FakePool(object):
+  def __init__(self, **kwargs):
+    self.kwargs = kwargs
+    self.oauth = FakeDatabase()
+    self.disconnected = False
+
+  def disconnect(self):
+    self.disconnected = True
+
+
+class LifecycleTest(unittest.TestCase):
+  def setUp(self):
+    self.connecting = []
+    self.patch(mongodb, 'MongoConnectionPool', self.connect)
+    self.storage = MongoDBStorage({'oauth_mongo_pool_size': 3})
+
+  def connect(self, **kwargs):
+    d = defer.Deferred()
+    self.connecting.append((d, FakePool(**kwargs)))
+    return d
+
+  def test_connects_once(self):
+    started = [self.storage.start(), self.storage.start(), self.storage.get_consumer('ck')]
+    self.assertEqual(len(self.connecting), 1)
+    d, pool = self.connecting[0]
+    self.assertEqual(pool.kwargs['pool_size'], 3)
+    d.callback(pool)
+    self.assertIdentical(self.successResultOf(started[0]), pool.oauth)
+    self.assertIdentical(self.successResultOf(started[1]), pool.oauth)
+    self.assertIdentical(self.successResultOf(started[2]), None)
+    self.assertIdentical(self.successResultOf(self.storage.start()), pool.oauth)
+    self.assertEqual(len(self.connecting), 1)
+
+  def test_warms_pool(self):
+    self.storage.start()
+    d, pool = self.connecting[0]
+    d.callback(pool)
+    stats = self.storage.pool_stats()
+    # one query per connection on top of creating the indexes and stamping request tokens
+    self.assertEqual(stats['operations'], len(self.storage.indexes) + 1 + 3)
+    self.assertEqual((stats['connect_waits'], stats['waits'], stats['in_flight'], stats['connected']),
+                     (1, 0, 0, True))
+
+  def test_failed_start(self):
+    started = self.storage.start()
+    d, pool = self.connecting[0]
+    pool.oauth.broken.append((self.storage.consumer_collection, [('key', 1)]))
+    d.callback(pool)
+    self.failureResultOf(started, OperationFailure)
+    self.flushLoggedErrors(OperationFailure)
+    self.assertTrue(pool.disconnected)
+    self.assertFalse(self.storage.pool_stats()['connected'])
+    self.storage.start()
+    self.assertEqual(len(self.connecting), 2)
+
+  def test_waits_for_indexes(self):
+    creating = []
+    self.patch(FakeCollection, 'create_index', lambda collection, fields, **kwargs: creating.append(
+      defer.Deferred()) or creating[-1])
+    self.storage.start()
+    d, pool = self.connecting[0]
+    d.callback(pool)
+    # the first index is still being created
+    again, lookup = self.storage.start(), self.storage.get_consumer('ck')
+    self.assertNoResult(again)
+    self.assertNoResult(lookup)
+    self.assertFalse(self.storage.pool_stats()['connected'])
+    while len(creating) < len(self.storage.indexes):
+      creating[-1].callback(True)
+    creating[-1].callback(True)
+    self.assertIdentical(self.successResultOf(again), pool.oauth)
+    self.assertIdentical(self.successResultOf(lookup), None)
+
+  def test_indexes_registered_while_warming(self):
+    warming = []
+    self.patch(FakeCollection, 'find_one', lambda collection, spec=None, **kwargs: warming.append(
+      defer.Deferred()) or warming[-1])
+    started = self.storage.start()
+    d, pool = self.connecting[0]
+    d.callback(pool)
+    self.assertEqual(len(warming), 3)
+    nonces = MongoNOnceStore({}, self.storage)
+    for w in warming:
+      w.callback(None)
+    self.successResultOf(started)
+    self.successResultOf(nonces.indexed)
+    self.assertIn(('create_index', nonces.collection, [('expires', 1)], {'expireAfterSeconds': 0}),
+                  pool.oauth.calls)
+
+  def test_stop(self):
+    self.storage.start()
+    d, pool = self.connecting[0]
+    d.callback(pool)
+    self.successResultOf(self.storage.stop())
+    self.assertTrue(pool.disconnected)
+    self.assertFalse(self.storage.pool_stats()['connected'])
+
+
+class PoolStatsTest(unittest.TestCase):
+  def setUp(self):
+    self.storage = fake_storage({'oauth_mongo_pool_size': 2})
+    self.running = []
+    self.patch(FakeCollection, 'find_one', lambda collection, spec=None, **kwargs: self.running.append(
+      defer.Deferred()) or self.running[-1])
+
+  def test_waits_for_a_connection(self):
+    lookups = [self.storage.get_consumer(key) for key in ('a', 'b', 'c', 'd', 'e')]
+    # one operation per connection, the others queue
+    self.assertEqual(len(self.running), 2)
+    stats = self.storage.pool_stats()
+    self.assertEqual((stats['in_flight'], stats['queued'], stats['utilization']), (5, 3, 1.0))
+    self.running[0].callback(None)
+    self.assertEqual(len(self.running), 3)
+    self.assertEqual(self.storage.pool_stats()['waits'], 1)
+    while len(self.running) < 5:
+      self.running[len(self.running) - 2].callback(None)
+    for d in self.running[-2:]:
+      d.callback(None)
+    for lookup in lookups:
+      self.assertIdentical(self.successResultOf(lookup), None)
+    stats = self.storage.pool_stats()
+    self.assertEqual((stats['in_flight'], stats['queued'], stats['utilization'], stats['waits']), (0, 0, 0.0, 3))
+    self.assertTrue(stats['wait_time_max'] >= 0 and stats['wait_time_total'] >= stats['wait_time_max'])
+
+  def test_failures_free_the_connection(self):
+    failed = self.storage.get_consumer('a')
+    queued = [self.storage.get_consumer('b'), self.storage.get_consumer('c')]
+    self.running[0].errback(OperationFailure('boom'))
+    self.failureResultOf(failed, OperationFailure)
+    self.assertEqual(len(self.running), 3)
+    self.assertEqual(self.storage.pool_stats()['queued'], 0)
+
+
+class MongoNOnceStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.storage = fake_storage()
+    self.nonces = MongoNOnceStore({}, self.storage)
+
+  def test_replay(self):
+    self.assertTrue(self.successResultOf(self.nonces.check_and_add('ck', 'n', '1000000000')))
+    self.assertFalse(self.successResultOf(self.nonces.check_and_add('ck', 'n', '1000000000')))
+    self.assertTrue(self.successResultOf(self.nonces.check_and_add('other', 'n', '1000000000')))
+
+  def test_shared_by_every_store(self):
+    other = MongoNOnceStore({}, self.storage)
+    self.successResultOf(self.nonces.check_and_add('ck', 'n', '1000000000'))
+    self.assertFalse(self.successResultOf(other.check_and_add('ck', 'n', '1000000000')))
+
+  def test_expiry_index(self):
+    self.assertIn((self.nonces.collection, {'expires': 1}, {'expireAfterSeconds': 0}), self.storage.indexes)
+
+  def test_expiry_index_failure_logged(self):
+    self.storage._db.broken.append(('other_nonces', [('expires', 1)]))
+    nonces = MongoNOnceStore({'oauth_nonce_collection': 'other_nonces'}, self.storage)
+    self.successResultOf(nonces.indexed)
+    self.assertEqual(len(self.flushLoggedErrors(OperationFailure)), 1)
+
+
+class MongoConsumerAndTokenTest(unittest.TestCase):
+  def test_get_consumer_and_token(self):
+    storage = fake_storage()
+    consumer = self.successResultOf(storage.add_consumer())
+    token = self.successResultOf(storage.add_access_token())
+    consumer_and_token = self.successResultOf(storage.get_consumer_and_token(consumer.key, token.key))
+    self.assertEqual([e.key for e in consumer_and_token], [consumer.key, token.key])
+    self.assertEqual(self.successResultOf(storage.get_consumer_and_token('unknown', token.key))[0], None)
+
+
+class MongoInsertNewTest(unittest.TestCase):
+  def test_generated_key_collision_retried(self):
+    storage = fake_storage()
+    self.successResultOf(storage.add_consumer(key='taken', secret='secret'))
+    keys = iter(['a', 'taken', 'c', 'd', 'e'])
+    self.patch(mongodb, 'generate_key', lambda: next(keys))
+    consumers = self.successResultOf(storage.add_consumers(3))
+    self.assertEqual(sorted(c.key for c in consumers), ['a', 'd', 'e'])
+    self.assertEqual(len(storage._db.docs[storage.consumer_collection]), 4)
+
+  def test_given_key_collision_raised(self):
+    storage = fake_storage()
+    self.successResultOf(storage.add_consumer(key='taken', secret='secret'))
+    self.failureResultOf(storage.add_consumer(key='taken', secret='other'), BulkWriteError)
+
+
+class MongoSaveManyTest(unittest.TestCase):
+  def setUp(self):
+    self.storage = fake_storage()
+
+  def test_saves_over_existing_keys(self):
+    existing = self.successResultOf(self.storage.add_consumer(secret='old'))
+    again = self.storage.consumer_factory(key=existing.key, secret='new')
+    new = self.storage.consumer_factory(key='new', secret='secret')
+    saved = self.successResultOf(self.storage.save_consumers([again, new]))
+    self.assertEqual([c.m_id for c in saved], [existing.m_id, new.m_id])
+    self.assertTrue(new.m_id)
+    self.assertEqual(self.successResultOf(self.storage.get_consumer(existing.key)).secret, 'new')
+    self.assertEqual(len(self.storage._db.docs[self.storage.consumer_collection]), 2)
+
+  def test_one_write(self):
+    tokens = self.successResultOf(self.storage.add_access_tokens(3))
+    for t in tokens:
+      t.secret = 'changed'
+    del self.storage._db.calls[:]
+    self.successResultOf(self.storage.save_access_tokens(tokens))
+    self.assertEqual([c[0] for c in self.storage._db.calls], ['bulk_write'])
+    self.assertEqual(self.successResultOf(self.storage.get_access_token(tokens[0].key)).secret, 'changed')
+
+
+class MongoRequestTokenTest(unittest.TestCase):
+  def setUp(self):
+    self.storage = fake_storage()
+    self.docs = self.storage._db.docs.setdefault(self.storage.request_token_collection, [])
+
+  def test_without_created(self):
+    self.docs.append({'_id': ObjectId(), 'key': 'legacy', 'secret': 'secret'})
+    self.assertEqual(self.successResultOf(self.storage.get_request_token('legacy')).key, 'legacy')
+    self.assertEqual(self.successResultOf(self.storage.request_token_stats())['live'], 1)
+
+  def test_stamped(self):
+    self.docs.append({'_id': ObjectId(), 'key': 'legacy', 'secret': 'secret'})
+    self.successResultOf(self.storage.stamp_request_tokens())
+    self.assertTrue(self.docs[0]['created'])
+    token = self.successResultOf(self.storage.get_request_token('legacy'))
+    self.assertApproximates(token.created, time.time(), 5)
+
+  def test_expired(self):
+    token = self.successResultOf(self.storage.add_request_token())
+    self.docs[0]['created'] -= datetime.timedelta(seconds=self.storage.request_token_ttl + 1)
+    self.assertIdentical(self.successResultOf(self.storage.get_request_token(token.key)), None)
+
+  def test_authorize_and_exchange(self):
+    token = self.successResultOf(self.storage.add_request_token())
+    del self.storage._db.calls[:]
+    authorized = self.successResultOf(self.storage.authorize_request_token(token.key, 'verifier'))
+    self.assertEqual(authorized.verifier, 'verifier')
+    self.assertIdentical(self.successResultOf(self.storage.authorize_request_token(token.key)), None)
+    self.assertIdentical(self.successResultOf(self.storage.exchange_request_token(token.key, 'wrong')), None)
+    self.assertEqual(self.successResultOf(self.storage.exchange_request_token(token.key, 'verifier')).key, token.key)
+    self.assertIdentical(self.successResultOf(self.storage.exchange_request_token(token.key, 'verifier')), None)
+    # one round trip each
+    self.assertEqual([c[0] for c in self.storage._db.calls], ['find_one_and_update'] * 2 + ['find_one_and_delete'] * 3)
+    self.assertEqual(self.docs, [])
+
+
+class MongoUpsertTest(unittest.TestCase):
+  def setUp(self):
+    self.storage = fake_storage()
+    self.db = self.storage._db
+
+  def test_returns_the_entity(self):
+    token = self.successResultOf(self.storage.add_request_token(callback='http://example.com/cb'))
+    token.set_verifier('verifier')
+    del self.db.calls[:]
+    self.assertIdentical(self.successResultOf(self.storage.save_request_token(token)), token)
+    self.assertEqual([c[0] for c in self.db.calls], ['update_one'])
+    stored = self.successResultOf(self.storage.get_request_token(token.key))
+    self.assertEqual((stored.verifier, stored.callback), ('verifier', 'http://example.com/cb'))
+
+  def test_sets_fields_only(self):
+    consumer = self.successResultOf(self.storage.add_consumer())
+    self.db.docs[self.storage.consumer_collection][0]['owner'] = 'someone'
+    consumer.secret = 'changed'
+    self.successResultOf(self.storage.save_consumer(consumer))
+    doc = self.db.docs[self.storage.consumer_collection][0]
+    self.assertEqual((doc['secret'], doc['owner'], doc['_id']), ('changed', 'someone', consumer.m_id))
+
+  def test_new_entity_gets_its_id(self):
+    token = self.storage.access_token_factory(key='key', secret='secret')
+    saved = self.successResultOf(self.storage.save_access_token(token))
+    self.assertIdentical(saved, token)
+    self.assertEqual([c[0] for c in self.db.calls], ['find_one_and_update'])
+    self.assertEqual(token.m_id, self.db.docs[self.storage.access_token_collection][0]['_id'])
+    again = self.storage.access_token_factory(key='key', secret='other')
+    self.successResultOf(self.storage.save_access_token(again))
+    self.assertEqual(again.m_id, token.m_id)
+    self.assertEqual(len(self.db.docs[self.storage.access_token_collection]), 1)
@@ -0,0 +1,160 @@
+import os, tempfile, time
+from twisted.trial import unittest
+from cycloauth import core
+from cycloauth.errors import Error, NOnceStoreFull
+from cycloauth.nonce import MemoryNOnceStore, SharedMemoryNOnceStore
+from cycloauth.signatures import HMAC_SHA1
+from cycloauth.storage import BaseStorage
+from cycloauth.utils import NOnceStore, nonce_expiry
+from cycloauth.test import signed_request
+
+
+FAR_FUTURE = '2147483647'
+
+
+class NOnceStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.now = 1000000000.0
+    self.patch(time, 'time', lambda: self.now)
+
+  def test_replay(self):
+    store = NOnceStore(window=360)
+    self.assertTrue(store.check_and_add('ck', 'n', self.now))
+    self.assertFalse(store.check_and_add('ck', 'n', self.now))
+    self.assertTrue(store.check_and_add('other', 'n', self.now))
+
+  def test_future_timestamp_expires_within_window(self):
+    store = NOnceStore(window=360)
+    store.check_and_add('ck', 'n', FAR_FUTURE)
+    self.now += 361
+    self.assertTrue(store.check_and_add('ck', 'n', FAR_FUTURE))
+
+  def test_reject_recovers_after_window(self):
+    store = NOnceStore(max_size=100, window=360, eviction='reject')
+    store.check_and_add('ck', 'pinned', FAR_FUTURE)
+    for i in xrange(99):
+      store.check_and_add('ck', 'n%d' % i, self.now)
+    self.assertRaises(NOnceStoreFull, store.check_and_add, 'ck', 'full', self.now)
+    self.now += 361
+    self.assertTrue(store.check_and_add('ck', 'later', self.now))
+
+  def test_entries_expire_by_timestamp(self):
+    store = NOnceStore(max_size=2, window=360, eviction='reject')
+    started = self.now
+    store.check_and_add('ck', 'first', self.now)
+    self.now += 100
+    # recorded later, expires sooner
+    store.check_and_add('ck', 'old', started - 200)
+    self.assertRaises(NOnceStoreFull, store.check_and_add, 'ck', 'full', self.now)
+    self.now = started + 161
+    self.assertTrue(store.check_and_add('ck', 'new', self.now))
+    self.assertEqual(len(store), 2)
+    self.assertFalse(store.check_and_add('ck', 'first', started))
+
+  def test_same_expiry_as_shared_stores(self):
+    store = NOnceStore(window=360)
+    timestamp = self.now - 300
+    store.check_and_add('ck', 'n', timestamp)
+    self.now = nonce_expiry(timestamp, 360, self.now) - 1
+    self.assertFalse(store.check_and_add('ck', 'n', timestamp))
+    self.now += 1
+    self.assertTrue(store.check_and_add('ck', 'n', timestamp))
+
+  def test_oldest_evicts_closest_to_expiring(self):
+    store = NOnceStore(max_size=2, window=360, eviction='oldest')
+    store.check_and_add('ck', 'first', self.now)
+    store.check_and_add('ck', 'old', self.now - 200)
+    store.check_and_add('ck', 'new', self.now)
+    self.assertFalse(store.check_and_add('ck', 'first', self.now))
+    self.assertIn(('ck', 'new'), store)
+    self.assertNotIn(('ck', 'old'), store)
+
+
+class MemoryNOnceStoreTest(unittest.TestCase):
+  def test_check_and_add(self):
+    store = MemoryNOnceStore({})
+    self.assertTrue(self.successResultOf(store.check_and_add('ck', 'n', time.time())))
+    self.assertFalse(store.check_and_add_nowait('ck', 'n', time.time()))
+    self.assertEqual(len(store), 1)
+
+
+class SharedMemoryNOnceStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.path = os.path.join(tempfile.mkdtemp(), 'nonces')
+    self.store = self.open('reject')
+
+  def open(self, eviction):
+    store = SharedMemoryNOnceStore({'oauth_nonce_shm_path': self.path, 'nonce_cache_size': 10,
+                                    'oauth_nonce_eviction': eviction})
+    self.addCleanup(store.close)
+    return store
+
+  def test_shared_between_stores(self):
+    other = self.open('reject')
+    self.assertTrue(self.successResultOf(self.store.check_and_add('ck', 'n', time.time())))
+    self.assertFalse(self.successResultOf(other.check_and_add('ck', 'n', time.time())))
+    self.assertTrue(other.check_and_add_nowait('other', 'n', time.time()))
+
+  def test_shared_with_forked_workers(self):
+    pid = os.fork()
+    if not pid:
+      os._exit(0 if self.store.check_and_add_nowait('ck', 'n', time.time()) else 1)
+    self.assertEqual(os.waitpid(pid, 0)[1], 0)
+    self.assertFalse(self.store.check_and_add_nowait('ck', 'n', time.time()))
+
+  def test_full_table(self):
+    # 20 slots for 10 nonces, every probe sequence covers the whole table
+    for i in xrange(self.store.slots):
+      self.assertTrue(self.store.check_and_add_nowait('ck', 'n%d' % i, time.time()))
+    self.assertRaises(NOnceStoreFull, self.store.check_and_add_nowait, 'ck', 'full', time.time())
+    self.failureResultOf(self.store.check_and_add('ck', 'full', time.time()), NOnceStoreFull)
+    self.assertTrue(self.open('oldest').check_and_add_nowait('ck', 'full', time.time()))
+
+  def test_not_a_nonce_store(self):
+    with open(self.path, 'r+b') as f:
+      f.write('NOTNONCE')
+    self.assertRaises(ValueError, self.open, 'reject')
+
+  def test_future_timestamp_expires_within_window(self):
+    now = time.time()
+    self.assertTrue(self.store.check_and_add_nowait('ck', 'n', FAR_FUTURE))
+    self.assertFalse(self.store.check_and_add_nowait('ck', 'n', FAR_FUTURE))
+    self.patch(time, 'time', lambda: now + self.store.window + 1)
+    self.assertTrue(self.store.check_and_add_nowait('ck', 'n', FAR_FUTURE))
+
+
+class CoreNOnceTest(unittest.TestCase):
+  def setUp(self):
+    self.storage = BaseStorage({})
+    self.consumer = self.storage.add_consumer().result
+    self.nonces = MemoryNOnceStore({'nonce_cache_size': 100, 'oauth_nonce_eviction': 'reject'})
+    self.core = core.OAuthCore({}, self.storage, self.nonces, {'HMAC-SHA1': HMAC_SHA1()})
+
+  def verify(self, parsed):
+    return core.run_sync(self.core.verify(parsed))
+
+  def test_future_timestamp_rejected(self):
+    parsed = signed_request(self.consumer, oauth_timestamp=FAR_FUTURE)
+    self.assertRaises(Error, self.verify, parsed)
+    self.assertEqual(len(self.nonces), 0)
+
+  def test_small_skew_accepted(self):
+    parsed = signed_request(self.consumer, oauth_timestamp=str(int(time.time()) + 30))
+    self.assertEqual(self.verify(parsed)[0], self.consumer)
+
+  def test_unknown_consumer_not_recorded(self):
+    unknown = self.storage.consumer_factory(key='unknown', secret='secret')
+    for i in xrange(200):
+      self.assertRaises(Error, self.verify, signed_request(unknown))
+    self.assertEqual(len(self.nonces), 0)
+
+  def test_bad_signature_not_recorded(self):
+    forged = self.storage.consumer_factory(key=self.consumer.key, secret='wrong')
+    self.assertRaises(Error, self.verify, signed_request(forged, oauth_nonce='n'))
+    self.assertEqual(len(self.nonces), 0)
+    self.assertEqual(self.verify(signed_request(self.consumer, oauth_nonce='n'))[0], self.consumer)
+
+  def test_replay_rejected(self):
+    parsed = signed_request(self.consumer)
+    self.verify(parsed)
+    self.assertRaises(Error, self.verify, parsed)
@@ -0,0 +1,214 @@
+import cyclone.web
+from cyclone.httputil import HTTPHeaders
+from cyclone.testing import Client
+from twisted.internet import defer
+from twisted.trial import unittest
+from cycloauth import provider
+from cycloauth.errors import Error, NOnceReplayed
+from cycloauth.storage import BaseStorage, run_deferred
+from cycloauth.utils import MISSING
+from cycloauth.test import signed_request
+
+
+SETTINGS = {'oauth_request_token_reap_interval': 0}
+
+
+class DelayedStorage(BaseStorage):
+  "an in-memory storage whose single lookups wait, once `delaying`, until the test fires them"
+  get_consumer_and_token = None
+
+  def __init__(self, settings):
+    BaseStorage.__init__(self, settings)
+    self.pending = []
+    self.delaying = False
+
+  def get_consumer_and_token_nowait(self, consumer_key, token_key, token_type='access'):
+    return MISSING
+
+  def delayed(self, value):
+    if not self.delaying:
+      return defer.succeed(value)
+    d = defer.Deferred()
+    self.pending.append((d, value))
+    return d
+
+  def get_consumer(self, key):
+    return self.delayed(self.consumers.get(key, None))
+
+  def get_access_token(self, key):
+    return self.delayed(self.access_tokens.get(key, None))
+
+  def fire(self):
+    while self.pending:
+      d, value = self.pending.pop(0)
+      d.callback(value)
+
+
+class ProtectedHandler(cyclone.web.RequestHandler, provider.OAuthRequestHandlerMixin):
+  @provider.oauth_authenticated
+  def get(self):
+    self.write(self.oauth_consumer.key)
+    self.finish()
+
+
+class Application(cyclone.web.Application, provider.OAuthApplicationMixin):
+  pass
+
+
+def authorization(parsed):
+  return 'OAuth ' + ', '.join('%s="%s"' % (k, v) for k, v in sorted(parsed.oauth.items()))
+
+
+class ProtectedHandlerTest(unittest.TestCase):
+  def setUp(self):
+    settings = dict(SETTINGS, oauth_storage_factory='cycloauth.test.test_provider.DelayedStorage')
+    self.app = Application([('/1/statuses.json', ProtectedHandler)], **settings)
+    self.client = Client(self.app)
+    self.storage = self.app.oauth_storage
+    self.consumer = self.successResultOf(self.storage.add_consumer())
+    self.token = self.successResultOf(self.storage.add_access_token())
+    self.storage.delaying = True
+
+  def get(self, parsed):
+    headers = HTTPHeaders({'Authorization': authorization(parsed)})
+    return self.client.get('/1/statuses.json', {'count': '20'}, headers=headers, host='api.example.com')
+
+  def test_lookups_at_once(self):
+    d = self.get(signed_request(self.consumer, self.token))
+    self.assertEqual(len(self.storage.pending), 2)
+    self.storage.fire()
+    response = self.successResultOf(d)
+    self.assertEqual((response.get_status(), response.content), (200, self.consumer.key))
+
+  def test_unknown_token(self):
+    unknown = self.storage.access_token_factory(key='unknown', secret='secret')
+    d = self.get(signed_request(self.consumer, unknown))
+    self.storage.fire()
+    self.assertEqual(self.successResultOf(d).get_status(), 403)
+    self.flushLoggedErrors(Error)
+
+
+class FastPathTest(unittest.TestCase):
+  def setUp(self):
+    self.app = Application([], **SETTINGS)
+    self.consumer = self.successResultOf(self.app.oauth_storage.add_consumer())
+    self.token = self.successResultOf(self.app.oauth_storage.add_access_token())
+
+  def test_in_memory_is_synchronous(self):
+    ret = provider.run_maybe_deferred(self.app.oauth_core.verify(signed_request(self.consumer, self.token)))
+    self.assertEqual(ret, (self.consumer, self.token))
+
+  def test_error_raised(self):
+    forged = self.app.oauth_storage.consumer_factory(key=self.consumer.key, secret='wrong')
+    self.assertRaises(Error, provider.run_maybe_deferred, self.app.oauth_core.verify(signed_request(forged)))
+
+  def test_falls_back_to_deferred(self):
+    settings = dict(SETTINGS, oauth_storage_factory='cycloauth.test.test_provider.DelayedStorage')
+    app = Application([], **settings)
+    storage = app.oauth_storage
+    consumer = self.successResultOf(storage.add_consumer())
+    storage.delaying = True
+    ret = provider.run_maybe_deferred(app.oauth_core.verify(signed_request(consumer)))
+    self.assertIsInstance(ret, defer.Deferred)
+    storage.fire()
+    self.assertEqual(self.successResultOf(ret)[0], consumer)
+
+
+class ExchangeTest(unittest.TestCase):
+  def setUp(self):
+    settings = dict(SETTINGS, oauth_storage_factory='cycloauth.test.test_provider.DelayedStorage')
+    self.app = Application([], **settings)
+    self.storage = self.app.oauth_storage
+    self.consumer = self.successResultOf(self.storage.add_consumer(callback='http://example.com/cb'))
+    self.request_token = self.successResultOf(self.storage.add_request_token())
+    self.verifier = self.successResultOf(run_deferred(self.app.oauth_core.authorize(self.request_token.key))).verifier
+
+  def exchange(self):
+    parsed = signed_request(self.consumer, self.request_token, oauth_verifier=self.verifier)
+    return run_deferred(self.app.oauth_core.access_token(parsed))
+
+  def test_exchanged_once(self):
+    self.storage.delaying = True
+    first, second = self.exchange(), self.exchange()
+    # both have read the request token before either exchanges it
+    self.storage.fire()
+    access_token = self.successResultOf(first)
+    self.assertIn(access_token.key, self.storage.access_tokens)
+    self.assertEqual(self.failureResultOf(second, Error).value.log_message,
+                     'The oauth_token has already been exchanged.')
+    self.assertEqual(len(self.storage.access_tokens), 1)
+
+  def test_authorized_once(self):
+    self.failureResultOf(run_deferred(self.app.oauth_core.authorize(self.request_token.key)), Error)
+
+
+class DelayedNOnceStore(object):
+  "a nonce store with no synchronous answer, whose checks wait until the test fires them"
+
+  def __init__(self, settings, storage):
+    self.pending = []
+
+  def check_and_add(self, consumer_key, nonce, timestamp):
+    d = defer.Deferred()
+    self.pending.append(d)
+    return d
+
+
+class Checks(provider.OAuthRequestHandlerMixin):
+  "the mixin's checks without a request, for the request parsed as `parsed`"
+
+  def __init__(self, app, parsed):
+    self._oauth_core = app.oauth_core
+    self._oauth_request_parameters = parsed
+
+
+class CheckHooksTest(unittest.TestCase):
+  def setUp(self):
+    self.app = Application([], **SETTINGS)
+    self.consumer = self.successResultOf(self.app.oauth_storage.add_consumer())
+
+  def test_raises(self):
+    checks = Checks(self.app, signed_request(self.consumer))
+    checks._check_signature(self.consumer, None)
+    self.assertRaises(NOnceReplayed, checks._check_signature, self.consumer, None)
+    self.assertRaises(NOnceReplayed, checks._check_nonce, checks.oauth_request_parameters.oauth['oauth_nonce'])
+    forged = self.app.oauth_storage.consumer_factory(key=self.consumer.key, secret='wrong')
+    self.assertRaises(Error, Checks(self.app, signed_request(forged))._check_signature, self.consumer, None)
+
+  def test_deferred(self):
+    checks = Checks(self.app, signed_request(self.consumer))
+    self.successResultOf(checks._deferred_check_signature(self.consumer, None))
+    self.failureResultOf(checks._deferred_check_signature(self.consumer, None), NOnceReplayed)
+    self.failureResultOf(checks._deferred_check_nonce(checks.oauth_request_parameters.oauth['oauth_nonce']),
+                         NOnceReplayed)
+
+  def test_raises_when_it_would_wait(self):
+    app = Application([], **dict(SETTINGS, oauth_nonce_store_factory='cycloauth.test.test_provider.DelayedNOnceStore'))
+    consumer = self.successResultOf(app.oauth_storage.add_consumer())
+    checks = Checks(app, signed_request(consumer))
+    self.assertRaises(Error, checks._check_signature, consumer, None)
+    self.assertRaises(Error, checks._check_nonce, 'n')
+    d = checks._deferred_check_signature(consumer, None)
+    app.oauth_nonce_list.pending[-1].callback(False)
+    self.failureResultOf(d, NOnceReplayed)
+
+
+class BaseStorageTest(unittest.TestCase):
+  def test_get_consumer_and_token(self):
+    storage = BaseStorage(SETTINGS)
+    consumer = self.successResultOf(storage.add_consumer())
+    access = self.successResultOf(storage.add_access_token())
+    request = self.successResultOf(storage.add_request_token())
+    self.assertEqual(self.successResultOf(storage.get_consumer_and_token(consumer.key, access.key)),
+                     (consumer, access))
+    self.assertEqual(storage.get_consumer_and_token_nowait(consumer.key, request.key, 'request'),
+                     (consumer, request))
+    self.assertEqual(storage.get_consumer_and_token_nowait('unknown', access.key), (None, access))
+
+
+class StartOAuthTest(unittest.TestCase):
+  def test_starts_storage(self):
+    app = Application([], **SETTINGS)
+    self.successResultOf(app.start_oauth())
+    self.assertIsInstance(app.oauth_storage, BaseStorage)
+    self.assertEqual(app.oauth_nonce_list.__class__.__name__, 'MemoryNOnceStore')
@@ -0,0 +1,83 @@
+import binascii, hashlib
+from twisted.trial import unittest
+from cycloauth import core
+from cycloauth.errors import Error, PartialOAuthRequest
+from cycloauth.nonce import MemoryNOnceStore
+from cycloauth.request import BodyHasher, OAuthRequestParameters
+from cycloauth.signatures import HMAC_SHA1
+from cycloauth.storage import BaseStorage, run_deferred
+from cycloauth.test import signed_request
+
+
+BODY = '{"status": "%s"}' % ('x' * 10000)
+JSON = 'application/json'
+FORM = 'application/x-www-form-urlencoded'
+
+
+def body_hash(body, algorithm=hashlib.sha1):
+  return binascii.b2a_base64(algorithm(body).digest())[:-1]
+
+
+class BodyHasherTest(unittest.TestCase):
+  def test_chunks(self):
+    hasher = BodyHasher('HMAC-SHA1')
+    for i in xrange(0, len(BODY), 1000):
+      hasher.update(BODY[i:i + 1000])
+    self.assertEqual(hasher.size, len(BODY))
+    self.assertEqual(hasher.digest('HMAC-SHA1'), body_hash(BODY))
+
+  def test_method_unknown_up_front(self):
+    hasher = BodyHasher()
+    hasher.update(BODY[:10])
+    hasher.update(BODY[10:])
+    self.assertEqual(hasher.digest('HMAC-SHA1'), body_hash(BODY))
+    self.assertEqual(hasher.digest('HMAC-SHA256'), body_hash(BODY, hashlib.sha256))
+
+  def test_from_parts_with_hasher(self):
+    parts = ('POST', 'http', 'api.example.com', '/1/statuses.json', 'count=20',
+             {'Authorization': 'OAuth oauth_consumer_key="ck", oauth_body_hash="x"', 'Content-Type': JSON})
+    hasher = BodyHasher()
+    for i in xrange(0, len(BODY), 4096):
+      hasher.update(BODY[i:i + 4096])
+    streamed = OAuthRequestParameters.from_parts(*(parts + (None, hasher)))
+    buffered = OAuthRequestParameters.from_parts(*(parts + (BODY,)))
+    self.assertEqual(streamed.body_type, 'other')
+    self.assertEqual(streamed.body_hash, buffered.body_hash)
+
+
+class BodyHashTest(unittest.TestCase):
+  def setUp(self):
+    self.storage = BaseStorage({'oauth_request_token_reap_interval': 0})
+    self.consumer = self.successResultOf(self.storage.add_consumer())
+    self.token = self.successResultOf(self.storage.add_access_token())
+
+  def verify(self, parsed, **settings):
+    c = core.OAuthCore(settings, self.storage, MemoryNOnceStore({}), {'HMAC-SHA1': HMAC_SHA1()})
+    return run_deferred(c.verify(parsed))
+
+  def test_matching(self):
+    parsed = signed_request(self.consumer, self.token, method='POST', body=BODY, content_type=JSON,
+                            oauth_body_hash=body_hash(BODY))
+    consumer, token = self.successResultOf(self.verify(parsed))
+    self.assertEqual(token.key, self.token.key)
+
+  def test_mismatched(self):
+    parsed = signed_request(self.consumer, self.token, method='POST', body=BODY, content_type=JSON,
+                            oauth_body_hash=body_hash(BODY + ' '))
+    f = self.failureResultOf(self.verify(parsed), Error)
+    self.assertEqual(f.value.log_message, 'Invalid oauth_body_hash.')
+
+  def test_not_on_form_bodies(self):
+    parsed = signed_request(self.consumer, self.token, method='POST', body='status=hello', content_type=FORM,
+                            oauth_body_hash=body_hash('status=hello'))
+    f = self.failureResultOf(self.verify(parsed), Error)
+    self.assertIn('form encoded', f.value.log_message)
+
+  def test_required(self):
+    parsed = signed_request(self.consumer, self.token, method='POST', body=BODY, content_type=JSON)
+    self.successResultOf(self.verify(parsed))
+    parsed = signed_request(self.consumer, self.token, method='POST', body=BODY, content_type=JSON)
+    self.failureResultOf(self.verify(parsed, oauth_require_body_hash=True), PartialOAuthRequest)
+    # form encoded bodies are signed as parameters and don't need one
+    parsed = signed_request(self.consumer, self.token, method='POST', body='status=hello', content_type=FORM)
+    self.successResultOf(self.verify(parsed, oauth_require_body_hash=True))
@@ -0,0 +1,101 @@
+import functools, os, time, urllib
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from cycloauth.errors import Error
+from cycloauth.keygen import random_hex
+from cycloauth.request import OAuthRequestParameters
+from cycloauth.signatures import SignatureProcessPool, rsa_available
+from cycloauth.storage import run_deferred
+from cycloauth.test import signed_request
+from cycloauth.test.test_provider import Application
+if rsa_available:
+  from Crypto.PublicKey import RSA
+  from Crypto.Signature import PKCS1_v1_5
+  from Crypto.Hash import SHA
+
+
+class SignatureProcessPoolTest(unittest.TestCase):
+  def setUp(self):
+    self.pool = SignatureProcessPool(1)
+    self.addCleanup(self.pool.close)
+
+  def submit(self, check):
+    d = defer.Deferred()
+    self.pool.submit(check, lambda ok, result: reactor.callFromThread(d.callback, (ok, result)))
+    return d
+
+  @defer.inlineCallbacks
+  def test_runs_in_worker(self):
+    ok, pid = yield self.submit(functools.partial(os.getpid))
+    self.assertTrue(ok)
+    self.assertNotEqual(pid, os.getpid())
+
+  @defer.inlineCallbacks
+  def test_closure_runs_here(self):
+    ok, pid = yield self.submit(lambda: os.getpid())
+    self.assertEqual((ok, pid), (True, os.getpid()))
+    self.assertIdentical(self.pool.pool, None)
+
+  @defer.inlineCallbacks
+  def test_error(self):
+    ok, e = yield self.submit(functools.partial(int, 'x'))
+    self.assertFalse(ok)
+    self.assertIsInstance(e, RuntimeError)
+    self.assertIn('ValueError', str(e))
+
+  @defer.inlineCallbacks
+  def test_timeout(self):
+    self.pool.timeout = 0.2
+    ok, e = yield self.submit(functools.partial(time.sleep, 5))
+    self.assertFalse(ok)
+    self.assertIn('timed out', str(e))
+
+  def test_close_fails_pending(self):
+    results = []
+    self.pool.submit(functools.partial(time.sleep, 5), lambda ok, result: results.append((ok, result)))
+    self.pool.close()
+    self.assertEqual(len(results), 1)
+    self.assertFalse(results[0][0])
+    self.assertIn('closed', str(results[0][1]))
+
+
+def rsa_signed_request(consumer, private_key, **oauth):
+  "the parameters of a request signed with RSA-SHA1 by `consumer`'s `private_key`"
+  params = signed_request(consumer).oauth
+  params.update(oauth_signature_method='RSA-SHA1', oauth_nonce=random_hex(16), **oauth)
+  params.pop('oauth_signature')
+  parts = ('GET', 'http', 'api.example.com', '/1/statuses.json', 'count=20')
+  header = lambda: {'Authorization': 'OAuth ' + ', '.join(
+    '%s="%s"' % (k, urllib.quote(v, safe='~')) for k, v in sorted(params.items()))}
+  base = OAuthRequestParameters.from_parts(*(parts + (header(), None))).base_string()
+  params['oauth_signature'] = PKCS1_v1_5.new(private_key).sign(SHA.new(base)).encode('base64').replace('\n', '')
+  return OAuthRequestParameters.from_parts(*(parts + (header(), None)))
+
+
+class RSAProcessTest(unittest.TestCase):
+  if not rsa_available:
+    skip = 'RSA-SHA1 needs PyCrypto'
+
+  def setUp(self):
+    self.app = Application([], oauth_signature_processes=1, oauth_request_token_reap_interval=0)
+    self.addCleanup(self.app.oauth_signature_process_pool.close)
+    self.private_key = RSA.generate(1024)
+    storage = self.app.oauth_storage
+    self.consumer = self.successResultOf(storage.add_consumer(rsa_key=self.private_key.publickey().exportKey()))
+
+  @defer.inlineCallbacks
+  def test_checked_in_worker(self):
+    consumer, token = yield run_deferred(self.app.oauth_core.verify(rsa_signed_request(self.consumer, self.private_key)))
+    self.assertEqual(consumer.key, self.consumer.key)
+    self.assertNotIdentical(self.app.oauth_signature_process_pool.pool, None)
+
+  @defer.inlineCallbacks
+  def test_forged(self):
+    forged = rsa_signed_request(self.consumer, RSA.generate(1024))
+    yield self.assertFailure(run_deferred(self.app.oauth_core.verify(forged)), Error)
+
+  @defer.inlineCallbacks
+  def test_signature_above_modulus(self):
+    parsed = rsa_signed_request(self.consumer, self.private_key)
+    parsed.oauth['oauth_signature'] = ('\xff' * 128).encode('base64').replace('\n', '')
+    yield self.assertFailure(run_deferred(self.app.oauth_core.verify(parsed)), Error)
@@ -0,0 +1,143 @@
+import time
+from twisted.trial import unittest
+from cycloauth.core import OAuthCore
+from cycloauth.nonce import MemoryNOnceStore
+from cycloauth.signatures import HMAC_SHA1
+from cycloauth.storage import stateless, run_deferred
+from cycloauth.storage.stateless import TokenCodec, StatelessTokenStorage
+from cycloauth.test import signed_request
+from cycloauth.test.test_mongodb import FakeDatabase
+
+
+SETTINGS = {'oauth_token_master_keys': {'k1': 'master secret'}, 'oauth_request_token_reap_interval': 0}
+
+
+class TokenCodecTest(unittest.TestCase):
+  def setUp(self):
+    self.codec = TokenCodec({'k1': 'master secret'})
+
+  def test_round_trip(self):
+    key, secret = self.codec.issue(u'ck')
+    consumer_key, issued, expires, decoded_secret = self.codec.decode(key)
+    self.assertEqual((consumer_key, decoded_secret), (u'ck', secret))
+
+  def test_forged_mac(self):
+    key, secret = self.codec.issue(u'ck')
+    raw = stateless._b64decode(key.partition('.')[2])
+    forged = 'k1.' + stateless._b64encode(raw[:-1] + chr(ord(raw[-1]) ^ 1))
+    self.assertEqual(self.codec.decode(forged), None)
+
+  def test_compares_in_constant_time(self):
+    compared = []
+    def compare(a, b):
+      compared.append((a, b))
+      return a == b
+    self.patch(stateless, 'constant_time_compare', compare)
+    self.codec.decode(self.codec.issue(u'ck')[0])
+    self.assertEqual(len(compared), 1)
+
+  def test_expired(self):
+    key, secret = self.codec.issue(u'ck', now=1000000000)
+    self.assertEqual(self.codec.decode(key, now=1000000000 + self.codec.ttl - 1)[0], u'ck')
+    self.assertEqual(self.codec.decode(key, now=1000000000 + self.codec.ttl), None)
+
+
+class StatelessTokenStorageTest(unittest.TestCase):
+  def setUp(self):
+    self.storage = self.start(SETTINGS)
+    self.a = self.successResultOf(self.storage.add_consumer())
+    self.b = self.successResultOf(self.storage.add_consumer())
+    self.token = self.successResultOf(self.storage.add_access_token(consumer_key=self.a.key))
+
+  def start(self, settings):
+    storage = StatelessTokenStorage(settings)
+    self.successResultOf(storage.start())
+    self.addCleanup(storage.stop)
+    return storage
+
+  def verify(self, storage, consumer, token):
+    core = OAuthCore({}, storage, MemoryNOnceStore({}), {'HMAC-SHA1': HMAC_SHA1()})
+    return run_deferred(core.verify(signed_request(consumer, token)))
+
+  def test_verifies(self):
+    consumer, token = self.successResultOf(self.verify(self.storage, self.a, self.token))
+    self.assertEqual((consumer, token.key), (self.a, self.token.key))
+    self.assertEqual(self.successResultOf(self.storage.get_access_token(self.token.key)).consumer_key, self.a.key)
+
+  def test_other_consumer(self):
+    self.assertEqual(self.successResultOf(self.storage.get_consumer_and_token(self.b.key, self.token.key)),
+                     (self.b, None))
+    self.assertEqual(self.storage.get_consumer_and_token_nowait(self.b.key, self.token.key), (self.b, None))
+    self.failureResultOf(self.verify(self.storage, self.b, self.token))
+
+  def test_expired(self):
+    key, secret = self.storage.codec.issue(self.a.key, now=time.time() - self.storage.codec.ttl - 1)
+    self.assertEqual(self.successResultOf(self.storage.get_access_token(key)), None)
+    expired = self.storage.access_token_factory(key=key, secret=secret)
+    self.failureResultOf(self.verify(self.storage, self.a, expired))
+
+  def test_revoked(self):
+    self.successResultOf(self.storage.remove_access_token(self.token.key))
+    self.assertEqual(self.successResultOf(self.storage.get_access_token(self.token.key)), None)
+    self.assertEqual(self.successResultOf(self.storage.get_consumer_and_token(self.a.key, self.token.key)),
+                     (self.a, None))
+    self.failureResultOf(self.verify(self.storage, self.a, self.token))
+    # other tokens of the consumer stay valid
+    other = self.successResultOf(self.storage.add_access_token(consumer_key=self.a.key))
+    self.successResultOf(self.verify(self.storage, self.a, other))
+
+  def test_revocations_purged_once_expired(self):
+    revocations = self.storage.revocations
+    revocations.revoke([('gone', time.time() - 1), (self.token.key, time.time() + 60)])
+    revocations.purge(time.time())
+    self.assertEqual(revocations.revoked.keys(), [self.token.key])
+
+  def test_rotation(self):
+    keys = {'k1': 'master secret', 'k2': 'new master secret'}
+    rotated = self.start(dict(SETTINGS, oauth_token_master_keys=keys, oauth_token_key_id='k2'))
+    self.successResultOf(rotated.save_consumer(self.a))
+    # sealed under the old key, still verified while it is configured
+    self.assertTrue(self.token.key.startswith('k1.'))
+    self.assertEqual(self.successResultOf(self.verify(rotated, self.a, self.token))[1].key, self.token.key)
+    new = self.successResultOf(rotated.add_access_token(consumer_key=self.a.key))
+    self.assertTrue(new.key.startswith('k2.'))
+    self.successResultOf(self.verify(rotated, self.a, new))
+    # the old storage doesn't know the new key
+    self.assertEqual(self.successResultOf(self.storage.get_access_token(new.key)), None)
+    # and once the old key is dropped its tokens are gone
+    retired = self.start(dict(SETTINGS, oauth_token_master_keys={'k2': keys['k2']}))
+    self.assertEqual(self.successResultOf(retired.get_access_token(self.token.key)), None)
+    self.assertEqual(self.successResultOf(retired.get_access_token(new.key)).key, new.key)
+
+
+class MongoRevocationListTest(unittest.TestCase):
+  "revocations shared by two processes through the same (fake) MongoDB"
+
+  def setUp(self):
+    self.db = FakeDatabase()
+    self.a, self.b = self.process(), self.process()
+    self.consumer = self.successResultOf(self.a.add_consumer())
+    self.token = self.successResultOf(self.a.add_access_token(consumer_key=self.consumer.key))
+
+  def process(self):
+    "a started storage, as another process on the same database would have"
+    settings = dict(SETTINGS, oauth_cached_storage_factory='cycloauth.storage.mongodb.MongoDBStorage',
+                    oauth_revocation_list_factory='cycloauth.storage.mongodb.MongoRevocationList',
+                    oauth_revocation_poll_interval=60)
+    storage = StatelessTokenStorage(settings)
+    storage.storage._db = self.db
+    self.successResultOf(storage.start())
+    self.addCleanup(storage.stop)
+    return storage
+
+  def test_revoked_everywhere_after_poll(self):
+    self.assertEqual(self.successResultOf(self.b.get_access_token(self.token.key)).key, self.token.key)
+    self.successResultOf(self.a.remove_access_token(self.token.key))
+    self.assertEqual(self.successResultOf(self.a.get_access_token(self.token.key)), None)
+    self.successResultOf(self.b.revocations.poll())
+    self.assertEqual(self.successResultOf(self.b.get_access_token(self.token.key)), None)
+
+  def test_revocations_outlive_restarts(self):
+    self.successResultOf(self.a.remove_access_token(self.token.key))
+    # start() loads them
+    self.assertEqual(self.successResultOf(self.process().get_access_token(self.token.key)), None)
@@ -0,0 +1,51 @@
+import time
+from twisted.trial import unittest
+from cycloauth.storage import BaseStorage
+
+
+class RequestTokenReaperTest(unittest.TestCase):
+  def setUp(self):
+    self.now = 1000000000.0
+    self.patch(time, 'time', lambda: self.now)
+    self.storage = BaseStorage({'oauth_request_token_ttl': 60, 'oauth_request_token_reap_interval': 0})
+
+  def test_saved_without_created(self):
+    token = self.storage.request_token_factory(key='legacy', secret='secret')
+    token.created = None
+    self.successResultOf(self.storage.save_request_token(token))
+    self.assertEqual(token.created, self.now)
+
+  def test_unknown_age_does_not_block(self):
+    legacy = self.successResultOf(self.storage.add_request_token())
+    legacy.created = None
+    expired = [self.successResultOf(self.storage.add_request_token()) for i in xrange(3)]
+    self.now += 61
+    self.assertEqual(self.storage.reap_request_tokens(), 3)
+    self.assertEqual(self.storage.request_tokens.keys(), [legacy.key])
+    # it expires a ttl after the reaper first saw it
+    self.now += 61
+    self.assertEqual(self.storage.reap_request_tokens(), 1)
+    self.assertIdentical(self.successResultOf(self.storage.get_request_token(expired[0].key)), None)
+
+
+class RequestTokenTransitionTest(unittest.TestCase):
+  def setUp(self):
+    self.storage = BaseStorage({'oauth_request_token_ttl': 60, 'oauth_request_token_reap_interval': 0})
+    self.token = self.successResultOf(self.storage.add_request_token())
+
+  def test_authorized_once(self):
+    token = self.successResultOf(self.storage.authorize_request_token(self.token.key, 'verifier'))
+    self.assertEqual(token.verifier, 'verifier')
+    self.assertIdentical(self.successResultOf(self.storage.authorize_request_token(self.token.key)), None)
+
+  def test_exchanged_once(self):
+    self.assertIdentical(self.successResultOf(self.storage.exchange_request_token(self.token.key, None)), None)
+    verifier = self.successResultOf(self.storage.authorize_request_token(self.token.key)).verifier
+    self.assertIdentical(self.successResultOf(self.storage.exchange_request_token(self.token.key, 'wrong')), None)
+    self.assertEqual(self.successResultOf(self.storage.exchange_request_token(self.token.key, verifier)).key,
+                     self.token.key)
+    self.assertIdentical(self.successResultOf(self.storage.exchange_request_token(self.token.key, verifier)), None)
+
+  def test_expired(self):
+    self.token.created -= 61
+    self.assertIdentical(self.successResultOf(self.storage.authorize_request_token(self.token.key)), None)
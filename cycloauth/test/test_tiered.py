@@ -0,0 +1,99 @@
+import time
+from twisted.internet import defer
+from twisted.trial import unittest
+from pymongo.errors import OperationFailure
+from cycloauth.storage.tiered import TieredStorage
+from cycloauth.test.test_mongodb import FakeDatabase
+from cycloauth.utils import MISSING
+
+
+def node(db, **settings):
+  "a TieredStorage in front of a MongoDBStorage connected to the shared fake `db`"
+  storage = TieredStorage(dict({'oauth_invalidation_poll_interval': 60}, **settings))
+  storage.mongo._db = db
+  return storage
+
+
+class TieredStorageTest(unittest.TestCase):
+  def setUp(self):
+    self.db = FakeDatabase()
+    self.a = node(self.db)
+    self.b = node(self.db)
+    for storage in (self.a, self.b):
+      self.successResultOf(storage.start())
+      self.addCleanup(storage.stop)
+    self.consumer = self.successResultOf(self.a.add_consumer())
+    self.token = self.successResultOf(self.a.add_access_token())
+
+  def operations(self, storage):
+    return storage.mongo.pool_stats()['operations']
+
+  def test_capped_collection(self):
+    created = [(name, options) for op, name, spec, options in self.db.calls if op == 'create_collection']
+    self.assertEqual(created[0], (self.a.collection, {'capped': True, 'size': self.a.collection_size}))
+    # the second node finds it there
+    self.assertEqual(len(created), 2)
+
+  def test_uncapped_collection_fails_start(self):
+    db = FakeDatabase()
+    db.docs['oauth_invalidations'] = []
+    self.failureResultOf(node(db).start(), ValueError)
+
+  def test_create_collection_errors_fail_start(self):
+    db = FakeDatabase()
+    db.failures['oauth_invalidations'] = OperationFailure('not authorized on oauth to execute command', 13)
+    self.failureResultOf(node(db).start(), OperationFailure)
+
+  def test_steady_state_reads_without_network(self):
+    self.successResultOf(self.b.get_consumer_and_token(self.consumer.key, self.token.key))
+    before = self.operations(self.b)
+    for i in xrange(3):
+      consumer, token = self.successResultOf(self.b.get_consumer_and_token(self.consumer.key, self.token.key))
+      self.assertEqual((consumer.key, token.key), (self.consumer.key, self.token.key))
+    self.assertEqual(self.b.get_consumer_and_token_nowait(self.consumer.key, self.token.key)[1].key, self.token.key)
+    self.assertEqual(self.operations(self.b), before)
+
+  def test_publishes_revocations(self):
+    self.successResultOf(self.a.remove_access_token(self.token.key))
+    docs = self.db.docs[self.a.collection]
+    self.assertEqual((docs[-1]['kind'], docs[-1]['keys'], docs[-1]['node']),
+                     ('access_token', [self.token.key], self.a.node_id))
+    # a node skips its own invalidations
+    self.successResultOf(self.a.poll())
+    self.assertEqual(self.a.invalidation_metrics['received'], 0)
+
+  def test_revocation_seen_after_poll(self):
+    self.successResultOf(self.b.poll())
+    self.assertEqual(self.successResultOf(self.b.get_access_token(self.token.key)).key, self.token.key)
+    self.successResultOf(self.a.remove_access_token(self.token.key))
+    # until it polls, the other node answers from its cache
+    self.assertEqual(self.successResultOf(self.b.get_access_token(self.token.key)).key, self.token.key)
+    received = self.b.invalidation_metrics['received']
+    self.successResultOf(self.b.poll())
+    self.assertEqual(self.b.invalidation_metrics['received'], received + 1)
+    self.assertIdentical(self.successResultOf(self.b.get_access_token(self.token.key)), None)
+
+  def test_each_invalidation_applied_once(self):
+    self.successResultOf(self.b.poll())
+    received = self.b.invalidation_metrics['received']
+    self.successResultOf(self.a.remove_access_token(self.token.key))
+    self.successResultOf(self.b.poll())
+    self.successResultOf(self.b.poll())
+    self.assertEqual(self.b.invalidation_metrics['received'], received + 1)
+
+  def test_stale_poll_flushes(self):
+    self.successResultOf(self.b.get_access_token(self.token.key))
+    self.successResultOf(self.a.remove_access_token(self.token.key))
+    # polls fail, as when the invalidations collection can't be reached
+    mongo_call = self.b.mongo.mongo_call
+    self.b.mongo.mongo_call = lambda *args, **kwargs: defer.fail(IOError('unreachable'))
+    self.successResultOf(self.b.poll())
+    self.b.mongo.mongo_call = mongo_call
+    self.assertEqual(len(self.flushLoggedErrors(IOError)), 1)
+    self.assertEqual(self.b.invalidation_metrics['poll_errors'], 1)
+    self.b.last_poll = time.time() - self.b.max_delay - 1
+    # the revocation is seen within oauth_invalidation_max_delay all the same
+    self.assertIdentical(self.b.get_consumer_and_token_nowait(self.consumer.key, self.token.key), MISSING)
+    self.assertIdentical(self.successResultOf(self.b.get_access_token(self.token.key)), None)
+    self.assertEqual(self.b.invalidation_metrics['flushes'], 1)
+    self.assertEqual(len(self.b.cache), 0)
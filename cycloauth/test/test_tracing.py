@@ -0,0 +1,75 @@
+from cyclone.httputil import HTTPHeaders
+from cyclone.testing import Client
+from twisted.internet import defer
+from twisted.trial import unittest
+from cycloauth.storage import BaseStorage
+from cycloauth.storage.tracing import TracingStorage
+from cycloauth.test import signed_request
+from cycloauth.test.test_mongodb import FakeDatabase
+from cycloauth.test.test_provider import Application, ProtectedHandler, SETTINGS, authorization
+
+
+class FailingStorage(BaseStorage):
+  "a BaseStorage whose consumer lookups fail"
+
+  def get_consumer(self, key):
+    return defer.fail(ValueError('down'))
+
+
+class TracingStorageTest(unittest.TestCase):
+  def tracer(self, factory='cycloauth.storage.BaseStorage', **settings):
+    return TracingStorage(dict(SETTINGS, oauth_traced_storage_factory=factory, **settings))
+
+  def test_calls_by_endpoint(self):
+    tracer = self.tracer()
+    self.successResultOf(tracer.add_access_tokens(3))
+    consumer = self.successResultOf(tracer.bind('api').add_consumer())
+    self.successResultOf(tracer.bind('api').get_consumer(consumer.key))
+    self.successResultOf(tracer.bind('api').get_consumer('unknown'))
+    calls = tracer.trace_stats()['calls']
+    self.assertEqual(calls[None]['add_access_tokens']['results'], 3)
+    self.assertEqual(sorted(calls['api']), ['add_consumer', 'get_consumer'])
+    self.assertEqual((calls['api']['get_consumer']['calls'], calls['api']['get_consumer']['results']), (2, 1))
+
+  def test_errors(self):
+    tracer = self.tracer('cycloauth.test.test_tracing.FailingStorage')
+    self.failureResultOf(tracer.get_consumer('ck'), ValueError)
+    self.successResultOf(tracer.get_access_token('tk'))
+    stats = tracer.trace_stats()['calls'][None]
+    self.assertEqual((stats['get_consumer']['errors'], stats['get_consumer']['error_rate']), (1, 1.0))
+    self.assertEqual(stats['get_access_token']['errors'], 0)
+
+  def test_slow_log(self):
+    tracer = self.tracer(oauth_trace_slow_threshold=0, oauth_trace_slow_log_size=2)
+    for key in ('a', 'b', 'c'):
+      tracer.bind('api').get_consumer(key)
+    self.successResultOf(tracer.add_consumer(secret='secret'))
+    slow = tracer.trace_stats()['slow']
+    self.assertEqual([(c['endpoint'], c['method'], c['key']) for c in slow],
+                     [('api', 'get_consumer', 'c'), (None, 'add_consumer', None)])
+
+  def test_hidden_and_mongo_calls(self):
+    tracer = self.tracer('cycloauth.storage.mongodb.MongoDBStorage')
+    tracer.storage._db = FakeDatabase()
+    consumer = self.successResultOf(tracer.add_consumer())
+    token = self.successResultOf(tracer.add_access_token())
+    self.successResultOf(tracer.get_consumer_and_token(consumer.key, token.key))
+    stats = tracer.trace_stats()
+    # MongoDBStorage looks both up with its own single lookups
+    self.assertEqual(stats['hidden'], {'get_consumer': 1, 'get_access_token': 1})
+    self.assertEqual(stats['mongo']['oauth_consumers.insert_many']['calls'], 1)
+    self.assertEqual(stats['mongo']['oauth_consumers.find_one']['calls'], 1)
+
+
+class TracedHandlerTest(unittest.TestCase):
+  def test_attributed_to_handler(self):
+    settings = dict(SETTINGS, oauth_storage_factory='cycloauth.storage.tracing.TracingStorage')
+    app = Application([('/1/statuses.json', ProtectedHandler)], **settings)
+    consumer = self.successResultOf(app.oauth_storage.add_consumer())
+    token = self.successResultOf(app.oauth_storage.add_access_token())
+    headers = HTTPHeaders({'Authorization': authorization(signed_request(consumer, token))})
+    response = self.successResultOf(Client(app).get('/1/statuses.json', {'count': '20'}, headers=headers,
+                                                    host='api.example.com'))
+    self.assertEqual(response.get_status(), 200)
+    calls = app.oauth_storage.trace_stats()['calls']
+    self.assertEqual(calls['ProtectedHandler']['get_consumer_and_token_nowait']['results'], 2)
@@ -214,4 +214,5 @@ class Application(cyclone.web.Application, cycloauth.provider.OAuthApplicationMi
     settings = dict(debug=True, oauth_storage_factory='cycloauth.storage.mongodb.MongoDBStorage')
     handlers += cycloauth.provider.handlers(settings)
     cyclone.web.Application.__init__(self, handlers, **settings)
+    self.start_oauth()
 
@@ -1,20 +1,19 @@
-import urlparse
+import urllib, urlparse, time
 from twisted.internet import defer
 from oauth2 import Token as OAuthToken
-from cycloauth.utils import generate_string
+from cycloauth.keygen import generate_verifier
 
-class Token(OAuthToken):
-  def __init__(self, key, secret, callback=None, verifier=None, **kwargs):
-    self.key = key
-    self.secret = secret
-    self.verifier_generator = kwargs.get('verifier_generator', lambda: generate_string(32))
 
-    if self.key is None or self.secret is None:
-      raise ValueError("Key and secret must be set.")
-    if callback is not None:
-      self.set_callback(callback)
-    if verifier is not None:
-      self.set_verifier(verifier)
+class TokenMixin(object):
+  "token behaviour shared by the oauth2 based Token and slotted token classes"
+  __slots__ = ()
+
+  # shared by every token, tokens only get their own when one is passed in
+  verifier_generator = staticmethod(generate_verifier)
+
+  def set_callback(self, callback):
+    self.callback = callback
+    self.callback_confirmed = 'true'
 
   def set_verifier(self, verifier=None):
     if verifier is not None:
@@ -33,3 +32,48 @@ class Token(OAuthToken):
         query = "oauth_token=%s&oauth_verifier=%s" % (self.key, self.verifier)
       return urlparse.urlunparse((scheme, netloc, path, params, query, fragment))
     return self.callback
+
+  def to_string(self):
+    data = {'oauth_token': self.key, 'oauth_token_secret': self.secret}
+    if self.callback_confirmed is not None:
+      data['oauth_callback_confirmed'] = self.callback_confirmed
+    return urllib.urlencode(data)
+
+
+class Token(TokenMixin, OAuthToken):
+  def __init__(self, key, secret, callback=None, verifier=None, **kwargs):
+    self.key = key
+    self.secret = secret
+    if 'verifier_generator' in kwargs:
+      self.verifier_generator = kwargs['verifier_generator']
+    self.created = kwargs.get('created', None) or time.time()
+    # the consumer an access token was issued to
+    self.consumer_key = kwargs.get('consumer_key', None)
+
+    if self.key is None or self.secret is None:
+      raise ValueError("Key and secret must be set.")
+    if callback is not None:
+      self.set_callback(callback)
+    if verifier is not None:
+      self.set_verifier(verifier)
+
+
+class CompactToken(TokenMixin):
+  """A token without a per-instance __dict__, for stores holding very many tokens.
+
+  Custom verifier generators are set on a subclass rather than per token.
+  """
+  __slots__ = ('key', 'secret', 'callback', 'callback_confirmed', 'verifier', 'created', 'consumer_key')
+
+  def __init__(self, key, secret, callback=None, verifier=None, created=None, consumer_key=None, **kwargs):
+    if key is None or secret is None:
+      raise ValueError("Key and secret must be set.")
+    self.key = key
+    self.secret = secret
+    self.callback = self.callback_confirmed = self.verifier = None
+    self.created = created or time.time()
+    self.consumer_key = consumer_key
+    if callback is not None:
+      self.set_callback(callback)
+    if verifier is not None:
+      self.set_verifier(verifier)
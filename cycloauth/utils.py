@@ -1,16 +1,18 @@
-import os, random, string
-import urllib
-from collections import deque
+import os, random, string, time, heapq
+from collections import deque, OrderedDict
 from cStringIO import StringIO
 from oauth2 import Error, Request
+from cycloauth.errors import NOnceStoreFull
+from cycloauth import keygen
 
 
-__all__ = ['generate_string', 'random_word', 'get_normalized_parameters', 'NOnceList']
+__all__ = ['generate_string', 'random_word', 'NOnceList', 'NOnceStore', 'nonce_window', 'nonce_expiry',
+           'LRUCache', 'MISSING', 'import_object']
 
 
 def generate_string(n=32):
   """Generate random hash *like* strings"""
-  return ''.join([ random.choice(string.hexdigits) for x in xrange(n) ])
+  return keygen.pool.get(n)
 
 def random_word():
   """flipped out of:
@@ -35,16 +37,12 @@ def random_word():
       word = wrds[1]
   return word
 
-def get_normalized_parameters(request):
-  """Return a string that contains the parameters that must be signed."""
-  items = [(k, v) for k, v in request.params.iteritems() if k != 'oauth_signature']
-  encoded_str = urllib.urlencode(sorted(items))
-  # Encode signature parameters per Oauth Core 1.0 protocol
-  # spec draft 7, section 3.6
-  # (http://tools.ietf.org/html/draft-hammer-oauth-07#section-3.6)
-  # Spaces must be encoded with "%20" instead of "+"
-  return encoded_str.replace('+', '%20')
-
+def import_object(name):
+  """Import an object from its full dot-notated path, eg `cycloauth.storage.BaseStorage`"""
+  mod = __import__('.'.join(name.split('.')[:-1]), globals(), locals(), [], -1)
+  for part in name.split('.')[1:]:
+    mod = getattr(mod, part)
+  return mod
 
 def oauth_request(cyclone_req):
   "returns an oauth2.Request object from a cyclone request"
@@ -81,3 +79,128 @@ class NOnceList(deque):
     deque.append(self, v)
     if len(self) > self.max_size:
       self.popleft()
+
+
+def nonce_window(settings):
+  """how long nonces are remembered: as long as their requests can pass the
+  timestamp check, `oauth_timestamp_threshold` seconds after a timestamp which
+  may be up to `oauth_timestamp_skew` seconds ahead of the clock"""
+  return settings.get('oauth_timestamp_threshold', 300) + settings.get('oauth_timestamp_skew', 60)
+
+
+def nonce_expiry(timestamp, window, now):
+  """when a nonce may be forgotten: `window` seconds after its timestamp, but
+  never more than `window` seconds from now so far future timestamps can't
+  keep an entry alive"""
+  return min(int(timestamp), now) + window
+
+
+class NOnceStore(object):
+  """A bounded, time-windowed set of nonce values scoped per consumer.
+
+  An entry expires `window` seconds after its request's timestamp, as
+  computed by nonce_expiry, like the shared nonce stores. Membership is an
+  O(1) dict lookup and expiries are kept in a heap, so expired entries are
+  dropped in expiry order on insertion. When `max_size` live entries are held
+  the `eviction` policy decides what happens to a new nonce: 'oldest' drops
+  the entry closest to expiring to make room, 'reject' refuses the new nonce
+  so no still-valid entry is forgotten.
+  """
+  eviction_policies = ('oldest', 'reject')
+
+  def __init__(self, max_size=20000, window=300, eviction='oldest'):
+    if eviction not in self.eviction_policies:
+      raise ValueError('Unknown nonce eviction policy %r' % eviction)
+    self.max_size = max_size
+    self.window = window
+    self.eviction = eviction
+    # (consumer_key, nonce) -> expiry
+    self._entries = {}
+    # (expiry, (consumer_key, nonce)), including pairs of entries since dropped or replaced
+    self._expiries = []
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, item):
+    expires = self._entries.get(item, None)
+    return expires is not None and expires > time.time()
+
+  def _pop(self):
+    "drops the entry closest to expiring, returns its expiry"
+    while True:
+      expires, k = heapq.heappop(self._expiries)
+      if self._entries.get(k, None) == expires:
+        del self._entries[k]
+        return expires
+
+  def expire(self, now=None):
+    "drops entries whose timestamp has fallen outside of the window"
+    if now is None:
+      now = time.time()
+    expiries = self._expiries
+    while expiries and expiries[0][0] <= now:
+      expires, k = heapq.heappop(expiries)
+      if self._entries.get(k, None) == expires:
+        del self._entries[k]
+
+  def check_and_add(self, consumer_key, nonce, timestamp):
+    "returns True and records the nonce if it is fresh, False if it has been seen"
+    now = time.time()
+    k = (consumer_key, nonce)
+    expires = self._entries.get(k, None)
+    if expires is not None:
+      if expires > now:
+        return False
+      del self._entries[k]
+    self.expire(now)
+    if len(self._entries) >= self.max_size:
+      # every entry left is live
+      if self.eviction == 'reject':
+        raise NOnceStoreFull('Too many recent nonce values, try again later.')
+      self._pop()
+    expires = nonce_expiry(timestamp, self.window, now)
+    self._entries[k] = expires
+    heapq.heappush(self._expiries, (expires, k))
+    return True
+
+
+MISSING = object()
+
+
+class LRUCache(object):
+  """A bounded least-recently-used mapping whose entries expire after a ttl.
+
+  `get` returns `MISSING` rather than None for absent or expired keys so that
+  None can itself be cached.
+  """
+
+  def __init__(self, max_size=10000, ttl=300):
+    self.max_size = max_size
+    self.ttl = ttl
+    # key -> (expiry, value), most recently used last
+    self._entries = OrderedDict()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get(self, key, default=MISSING):
+    entry = self._entries.pop(key, None)
+    if entry is None:
+      return default
+    if entry[0] <= time.time():
+      return default
+    self._entries[key] = entry
+    return entry[1]
+
+  def set(self, key, value, ttl=None):
+    self._entries.pop(key, None)
+    if len(self._entries) >= self.max_size:
+      self._entries.popitem(last=False)
+    self._entries[key] = (time.time() + (self.ttl if ttl is None else ttl), value)
+
+  def delete(self, key):
+    self._entries.pop(key, None)
+
+  def clear(self):
+    self._entries.clear()